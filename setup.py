@@ -61,6 +61,7 @@ setup(
         gc = vee.commands.gc:gc
         list = vee.commands.list:list_
         repackage = vee.commands.repackage:repackage
+        stats = vee.commands.stats:stats
 
         # Manifest.
         install = vee.commands.install:install
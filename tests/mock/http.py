@@ -1,5 +1,6 @@
 from io import BytesIO, StringIO
 import fnmatch
+import hashlib
 import json
 import os
 import re
@@ -71,11 +72,24 @@ class MockHTTPHandler(BaseHTTPRequestHandler):
             }).encode())
             return
 
-        # Files which exist.
+        # Files which exist (and can be fetched by range).
         path = os.path.join(_root, url_path.strip('/'))
         if os.path.exists(path):
             content = open(path, 'rb').read()
-            self.send_response(200)
+            etag = '"%s"' % hashlib.md5(content).hexdigest()
+            m = re.match(r'bytes=(\d+)-$', self.headers.get('Range') or '')
+            if m and self.headers.get('If-Range') in (None, etag):
+                start = int(m.group(1))
+                if start >= len(content):
+                    self.send_response(416)
+                    self.end_headers()
+                    return
+                self.send_response(206)
+                self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, len(content) - 1, len(content)))
+                content = content[start:]
+            else:
+                self.send_response(200)
+            self.send_header('ETag', etag)
             self.send_header('Content-Length', str(len(content)))
             self.end_headers()
             self.wfile.write(content)
@@ -0,0 +1,57 @@
+from . import *
+
+from unittest import mock
+
+from vee.buildcache import BuildCache, parse_size
+
+
+class TestBuildCache(TestCase):
+
+    def test_parse_size(self):
+        self.assertEqual(parse_size('0'), 0)
+        self.assertEqual(parse_size('512'), 512)
+        self.assertEqual(parse_size('2k'), 2048)
+        self.assertEqual(parse_size('1.5M'), 1536 * 1024)
+        self.assertEqual(parse_size('10GB'), 10 * 1024 ** 3)
+
+    def test_opt_in(self):
+        home = self.home()
+        self.assertIsNone(BuildCache.from_environ(home, {}))
+        self.assertIsNone(BuildCache.from_environ(home, {'VEE_BUILD_CACHE_SIZE': '0'}))
+        cache = BuildCache.from_environ(home, {'VEE_BUILD_CACHE_SIZE': '1G'})
+        self.assertEqual(cache.path, home._abs_path('cache', 'builds'))
+        self.assertEqual(cache.max_size, 1024 ** 3)
+        cache = BuildCache.from_environ(home, {'VEE_BUILD_CACHE': '/tmp/builds'})
+        self.assertEqual(cache.path, '/tmp/builds')
+        self.assertEqual(cache.max_size, parse_size('10G'))
+
+    @mock.patch.dict(os.environ, {'VEE_BUILD_CACHE_SIZE': '1G'})
+    def test_restore_instead_of_build(self):
+
+        home = self.home()
+
+        pkg = self.package('foo', 'c_configure_make_install')
+        pkg.render_commit()
+
+        home.main(['install', pkg.git_url, '--make-install'])
+        rows = home.db.execute('SELECT install_path FROM packages WHERE name = ?', [pkg.name]).fetchall()
+        install_path = rows[0]['install_path']
+        self.assertExists(os.path.join(install_path, 'bin', 'foo'))
+
+        archives = []
+        for dir_path, _, file_names in os.walk(home.build_cache.path):
+            archives.extend(os.path.join(dir_path, x) for x in file_names)
+        self.assertEqual(len(archives), 1)
+
+        # Throw away the install; it should come back without a build.
+        shutil.rmtree(install_path)
+        home.db.execute('DELETE FROM packages')
+        home.main(['install', pkg.git_url, '--make-install'])
+        self.assertExists(os.path.join(install_path, 'bin', 'foo'))
+
+        builds = home.db.execute('SELECT count(1) FROM pipeline_timings WHERE name = ? AND step = ?', [pkg.name, 'build']).fetchone()[0]
+        self.assertEqual(builds, 1)
+
+        # Evicting down to nothing empties it.
+        home.build_cache.evict(0)
+        self.assertFalse(os.path.exists(archives[0]))
@@ -0,0 +1,253 @@
+from . import *
+
+import threading
+import time
+from unittest import mock
+
+from vee import database
+from vee.database import Session
+from vee.environment import Environment
+
+
+class TestDatabase(TestCase):
+
+    def populate(self, home, count=20000):
+        con = home.db.connect()
+        with con:
+            con.executemany('INSERT INTO packages (url, name, install_name, install_path) VALUES (?, ?, ?, ?)', [
+                ('git+https://example.com/pkg%d' % i, 'pkg%d' % (i % 1000), 'pkg%d/%d' % (i % 1000, i), '/installs/%d' % i)
+                for i in range(count)
+            ])
+            env_id = con.execute("INSERT INTO environments (name, path) VALUES ('env', '/env')").lastrowid
+            con.executemany('INSERT INTO links (environment_id, package_id) VALUES (?, ?)', [
+                (env_id, i) for i in range(1, count + 1, 2)
+            ])
+            con.executemany('INSERT INTO package_dependencies (depender_id, dependee_id) VALUES (?, ?)', [
+                (i, i + 1) for i in range(1, count)
+            ])
+            con.executemany('INSERT INTO shared_libraries (package_id, name, path) VALUES (?, ?, ?)', [
+                (i, 'libpkg%d.dylib' % i, '/installs/%d/lib/libpkg%d.dylib' % (i, i)) for i in range(1, count + 1)
+            ])
+        return con
+
+    def assertUsesIndex(self, con, query, params, index):
+        plan = ' / '.join(row[-1] for row in con.execute('EXPLAIN QUERY PLAN ' + query, params))
+        self.assertIn('INDEX %s' % index, plan)
+        # Timing is logged (with -v) for comparison against an unindexed home.
+        start = time.time()
+        for _ in range(100):
+            con.execute(query, params).fetchall()
+        log.debug('%.3fms: %s' % ((time.time() - start) * 10, plan), name='vee.tests')
+
+    def test_lookup_indexes(self):
+
+        home = self.home()
+        con = self.populate(home)
+
+        # Package.resolve_existing
+        self.assertUsesIndex(con, '''
+            SELECT * FROM packages
+            WHERE install_path IS NOT NULL AND url = ? AND name = ? AND install_name = ?
+            ORDER BY packages.created_at DESC
+        ''', ['git+https://example.com/pkg1234', 'pkg234', 'pkg234/1234'], 'packages_by_name')
+        self.assertUsesIndex(con, '''
+            SELECT packages.*, links.id as link_id FROM packages
+            LEFT OUTER JOIN links ON packages.id = links.package_id
+            WHERE install_path IS NOT NULL AND name = ? AND links.environment_id = ?
+            ORDER BY links.created_at DESC, packages.created_at DESC
+        ''', ['pkg234', 1], 'links_by_environment')
+
+        # Package._assert_unlinked
+        self.assertUsesIndex(con, 'SELECT id FROM links WHERE package_id = ? AND environment_id = ?', [1235, 1], 'links_by_')
+
+        # Package._load_dependencies
+        self.assertUsesIndex(con, 'SELECT dependee_id from package_dependencies WHERE depender_id = ?', [1234], 'package_dependencies_by_depender')
+
+        # libs.get_installed_shared_libraries, and relocation
+        self.assertUsesIndex(con, 'SELECT path FROM shared_libraries WHERE package_id = ?', [1234], 'shared_libraries_by_package')
+        self.assertUsesIndex(con, 'SELECT path FROM shared_libraries WHERE name = ? ORDER BY created_at DESC', ['libpkg1234.dylib'], 'shared_libraries_by_name')
+
+        # Environment.resolve_existing
+        self.assertUsesIndex(con, 'SELECT * FROM environments WHERE path = ?', ['/env'], 'environments_by_path')
+
+    def test_drop_column_keeps_indexes(self):
+
+        home = self.home()
+        con = home.db.connect()
+        with con:
+            con.execute('''CREATE TABLE things (
+                id INTEGER PRIMARY KEY,
+                doomed TEXT,
+                name TEXT
+            )''')
+            con.execute('CREATE INDEX things_by_doomed ON things (doomed)')
+            con.execute('CREATE INDEX things_by_name ON things (name)')
+            con.drop_column('things', 'doomed')
+
+        indexes = set(row[0] for row in con.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = 'things'"))
+        self.assertEqual(indexes, set(['things_by_name']))
+
+    def test_connection_per_thread(self):
+
+        home = self.home()
+        con = home.db.connect()
+        self.assertIs(home.db.connect(), con)
+
+        other = []
+        thread = threading.Thread(target=lambda: other.append(home.db.connect()))
+        thread.start()
+        thread.join()
+        self.assertIsNot(other[0], con)
+
+    def test_journal_mode(self):
+
+        # Left alone, unless asked for.
+        home = self.home()
+        self.assertEqual(home.db.connect().execute('PRAGMA journal_mode').fetchone()[0], 'delete')
+
+        with mock.patch.dict(os.environ, {'VEE_DB_JOURNAL_MODE': 'wal'}):
+            home = self.home(self.sandbox('wal'))
+            self.assertEqual(home.db.connect().execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+
+    @mock.patch.dict(os.environ, {'VEE_DB_JOURNAL_MODE': 'WAL'})
+    def test_read_while_writing(self):
+
+        home = self.home()
+        con = home.db.connect()
+        self.assertEqual(con.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+
+        def read():
+            reader = home.db.connect()
+            seen.append(reader.execute('SELECT count(1) FROM environments').fetchone()[0])
+
+        seen = []
+        with con:
+            con.execute("INSERT INTO environments (name, path) VALUES ('env', '/env')")
+            # Another thread (so another connection) is not blocked, and
+            # doesn't see the uncommitted write.
+            thread = threading.Thread(target=read)
+            thread.start()
+            thread.join()
+        thread = threading.Thread(target=read)
+        thread.start()
+        thread.join()
+
+        self.assertEqual(seen, [0, 1])
+
+    def test_session(self):
+
+        home = self.home()
+        con = home.db.connect()
+        package_ids = [
+            con.execute("INSERT INTO packages (url, name) VALUES ('url', ?)", ['pkg%d' % i]).lastrowid
+            for i in range(100)
+        ]
+
+        session = Session(home.db)
+        env = Environment('session', home=home)
+        session.add(env)
+        for package_id in package_ids:
+            session.insert('links', {'environment_id': env, 'package_id': package_id})
+        self.assertIsNone(env.id)
+
+        statements = []
+        con.set_trace_callback(statements.append)
+        try:
+            session.flush()
+        finally:
+            con.set_trace_callback(None)
+
+        self.assertIsNotNone(env.id)
+        self.assertFalse(session.pending)
+        self.assertEqual(con.execute('SELECT count(1) FROM links WHERE environment_id = ?', [env.id]).fetchone()[0], 100)
+
+        # All in one transaction.
+        self.assertEqual(len([x for x in statements if x.startswith('BEGIN')]), 1)
+        self.assertEqual(len([x for x in statements if x.startswith('COMMIT')]), 1)
+
+        # Failures roll back, including the IDs.
+        env = Environment('session-failed', home=home)
+        session.add(env)
+        session.insert('links', {'environment_id': env, 'package_id': 123456789})
+        self.assertRaises(Exception, session.flush)
+        self.assertIsNone(env.id)
+        self.assertIsNone(con.execute("SELECT id FROM environments WHERE name = 'session-failed'").fetchone())
+
+        # ... but everything is still queued, so it may be tried again.
+        self.assertTrue(session.pending)
+        with con:
+            con.execute("INSERT INTO packages (id, url, name) VALUES (123456789, 'url', 'late')")
+        session.flush()
+        self.assertIsNotNone(env.id)
+        self.assertEqual(con.execute('SELECT package_id FROM links WHERE environment_id = ?', [env.id]).fetchone()[0], 123456789)
+
+        session.insert('links', {'environment_id': env, 'package_id': 987654321})
+        self.assertRaises(Exception, session.flush)
+        session.discard()
+        self.assertFalse(session.pending)
+
+    def test_dependency_graph(self):
+
+        home = self.home()
+        con = home.db.connect()
+        with con:
+            a, b, c, d, e = [
+                con.execute("INSERT INTO packages (url, name) VALUES ('url', ?)", [name]).lastrowid
+                for name in 'abcde'
+            ]
+            # a -> b -> c -> b (a cycle), and d -> c; e is on its own.
+            con.executemany('INSERT INTO package_dependencies (depender_id, dependee_id) VALUES (?, ?)', [
+                (a, b), (b, c), (c, b), (d, c),
+            ])
+            env_id = con.execute("INSERT INTO environments (name, path) VALUES ('env', '/env')").lastrowid
+            con.execute('INSERT INTO links (environment_id, package_id) VALUES (?, ?)', [env_id, a])
+
+        db = home.db
+        self.assertEqual(len(db.get_dependencies()), 4)
+        self.assertEqual(db.get_dependencies([a], transitive=False), [(a, b)])
+        self.assertEqual(db.get_dependencies([a]), [(a, b), (b, c), (c, b)])
+        self.assertEqual(db.get_dependencies([e]), [])
+        self.assertEqual(sorted(db.get_dependents([c])), sorted([(b, c), (d, c), (a, b), (c, b)]))
+        self.assertEqual(db.get_dependents([a]), [])
+        self.assertEqual(sorted(db.get_environment_packages()), [(env_id, a), (env_id, b), (env_id, c)])
+        self.assertEqual(db.get_environment_packages([env_id + 1]), [])
+
+    def test_cascade_deletes(self):
+
+        home = self.home()
+        con = self.populate(home, 100)
+
+        # The rebuilt tables kept their indexes and triggers.
+        names = set(row[0] for row in con.execute("SELECT name FROM sqlite_master WHERE tbl_name = 'links'"))
+        self.assertIn('links_by_package', names)
+        self.assertIn('on_insert_links', names)
+
+        with con:
+            con.execute('DELETE FROM packages WHERE id = 1')
+            con.execute('DELETE FROM environments')
+        for table, column in (('package_dependencies', 'depender_id'), ('package_dependencies', 'dependee_id'), ('shared_libraries', 'package_id')):
+            self.assertEqual(con.execute('SELECT count(1) FROM %s WHERE %s = 1' % (table, column)).fetchone()[0], 0)
+        self.assertEqual(con.execute('SELECT count(1) FROM links').fetchone()[0], 0)
+
+    def test_migration_version(self):
+
+        home = self.home()
+        db = home.db
+        con = db.connect()
+        self.assertEqual(con.execute('PRAGMA user_version').fetchone()[0], len(database._migrations))
+
+        statements = []
+        con.set_trace_callback(statements.append)
+        try:
+            db._migrate()
+        finally:
+            con.set_trace_callback(None)
+        self.assertEqual(statements, ['PRAGMA user_version'])
+
+        # Homes from before the version are brought up to date, without
+        # migrations being run again.
+        con.execute('PRAGMA user_version = 0')
+        applied = con.execute('SELECT count(1) FROM migrations').fetchone()[0]
+        db._migrate()
+        self.assertEqual(con.execute('PRAGMA user_version').fetchone()[0], len(database._migrations))
+        self.assertEqual(con.execute('SELECT count(1) FROM migrations').fetchone()[0], applied)
@@ -0,0 +1,83 @@
+from . import *
+
+from vee.environment import Environment
+from vee.shebang import ShebangCache
+
+
+class TestEnvironment(TestCase):
+
+    def test_clone_from(self):
+
+        home = self.home()
+
+        install = self.sandbox('installs', 'foo')
+        makedirs(os.path.join(install, 'bin'))
+        makedirs(os.path.join(install, 'share', 'foo'))
+        with open(os.path.join(install, 'bin', 'foo'), 'wb') as fh:
+            fh.write(b'#!/usr/bin/python\nprint("foo")\n')
+        os.chmod(os.path.join(install, 'bin', 'foo'), 0o755)
+
+        old = Environment('clone-old', home=home)
+        old.link_directory(install)
+
+        # Something binary which mentions the old environment.
+        with open(os.path.join(old.path, 'binary'), 'wb') as fh:
+            fh.write(b'\0' + old.path.encode())
+        os.symlink(os.path.join(old.path, 'bin', 'foo'), os.path.join(old.path, 'foo'))
+
+        new = Environment('clone-new', home=home)
+        new.clone_from(old)
+
+        self.assertExists(os.path.join(new.path, 'bin', 'python'))
+        self.assertEqual(os.readlink(os.path.join(new.path, 'share')), os.path.join(install, 'share'))
+        self.assertEqual(os.readlink(os.path.join(new.path, 'foo')), os.path.join(new.path, 'bin', 'foo'))
+
+        with open(os.path.join(new.path, 'bin', 'foo'), 'rb') as fh:
+            self.assertEqual(fh.readline(), b'#!' + os.path.join(new.path, 'bin', 'python').encode() + b'\n')
+        self.assertTrue(os.stat(os.path.join(new.path, 'bin', 'foo')).st_mode & 0o111)
+
+        with open(os.path.join(new.path, 'binary'), 'rb') as fh:
+            self.assertEqual(fh.read(), b'\0' + old.path.encode())
+
+        # And it can go away as it came.
+        new.unlink_directory(install)
+        self.assertFalse(os.path.lexists(os.path.join(new.path, 'share')))
+        self.assertFalse(os.path.lexists(os.path.join(new.path, 'bin', 'foo')))
+        self.assertExists(os.path.join(old.path, 'bin', 'foo'))
+
+        with self.assertRaises(ValueError):
+            new.clone_from(old)
+
+    def test_rewrite_shebang(self):
+
+        home = self.home()
+        env = Environment('rewrite', home=home)
+        env.create_if_not_exists()
+
+        dir_ = self.sandbox('scripts')
+        makedirs(dir_)
+        src = os.path.join(dir_, 'big')
+        body = b''.join(b'# line %d\n' % i for i in range(100000))
+        with open(src, 'wb') as fh:
+            fh.write(b'#!/usr/bin/python -u\n')
+            fh.write(body)
+        os.chmod(src, 0o755)
+
+        dst = os.path.join(env.path, 'bin', 'big')
+        self.assertTrue(env.rewrite_shebang(src, dst))
+        with open(dst, 'rb') as fh:
+            self.assertEqual(fh.readline(), b'#!' + os.path.join(env.path, 'bin', 'python').encode() + b' -u\n')
+            self.assertEqual(fh.read(), body)
+
+        # It is remembered until the file changes.
+        shebangs = ShebangCache(home.db)
+        shebangs.preload(dir_)
+        self.assertEqual(shebangs.get(src).interpreter, b'python')
+        self.assertEqual(shebangs.reads, 0)
+
+        with open(src, 'wb') as fh:
+            fh.write(b'#!/bin/sh\n')
+        self.assertEqual(shebangs.get(src).interpreter, b'sh')
+        self.assertEqual(shebangs.reads, 1)
+        self.assertFalse(env.rewrite_shebang(src, dst, shebangs))
+        self.assertEqual(shebangs.reads, 1)
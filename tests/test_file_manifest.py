@@ -0,0 +1,112 @@
+from . import *
+
+import stat
+import tarfile
+
+from vee import libs
+from vee.filemanifest import FileManifest
+from vee.utils import archive_tree
+
+
+class TestFileManifest(TestCase):
+
+    def make_tree(self):
+
+        root = self.sandbox()
+        if os.path.exists(root):
+            shutil.rmtree(root)
+
+        for dir_ in ('bin', 'lib/sub', 'share/doc', 'Foo.framework'):
+            makedirs(os.path.join(root, dir_))
+        def write(path, content, mode=0o644):
+            path = os.path.join(root, path)
+            with open(path, 'wb') as fh:
+                fh.write(content)
+            os.chmod(path, mode)
+        write('bin/tool', b'#!/usr/bin/env python\n', 0o777)
+        write('bin/elf', b'\x7fELF more', 0o755)
+        write('Foo.framework/Foo', b'\xcf\xfa\xed\xfe more')
+        write('lib/libfoo.so', b'\x7fELF more')
+        write('lib/libbar.dylib', b'\xcf\xfa\xed\xfe more')
+        write('lib/sub/data.txt', b'hello')
+        write('share/doc/README', b'\xcf\xfa\xed\xfe not in a bin')
+        os.symlink('libfoo.so', os.path.join(root, 'lib', 'libfoo.so.1'))
+        os.symlink('doc', os.path.join(root, 'share', 'docs'))
+        os.symlink('missing', os.path.join(root, 'lib', 'broken'))
+
+        return root
+
+    def test_scan(self):
+
+        root = self.make_tree()
+        manifest = FileManifest.scan(root)
+
+        self.assertEqual(manifest.get('bin').type, 'd')
+        self.assertEqual(manifest.get('bin/tool').mode, 0o777)
+        self.assertEqual(manifest.get('bin/elf').binary, 'elf')
+        self.assertEqual(manifest.get('lib/sub/data.txt').size, 5)
+        self.assertIsNone(manifest.get('lib/sub/data.txt').binary)
+        self.assertEqual(manifest.get('lib/libfoo.so.1')[1:], ('l', manifest.get('lib/libfoo.so.1').mode, 0, 'libfoo.so', None))
+        self.assertEqual(manifest.get('share/docs').type, 'ld')
+
+        # It walks just like os.walk does.
+        def walk(iter_):
+            return sorted((dir_path, sorted(dir_names), sorted(file_names)) for dir_path, dir_names, file_names in iter_)
+        self.assertEqual(walk(manifest.walk()), walk(os.walk(root)))
+
+        # Including pruning.
+        seen = []
+        for dir_path, dir_names, file_names in manifest.walk():
+            seen.append(dir_path)
+            dir_names[:] = [x for x in dir_names if x != 'lib']
+        self.assertNotIn(os.path.join(root, 'lib', 'sub'), seen)
+        self.assertIn(os.path.join(root, 'share', 'doc'), seen)
+
+        # Round trip.
+        manifest.save()
+        loaded = FileManifest.load(root)
+        self.assertEqual(list(loaded), list(manifest))
+        self.assertIsNone(FileManifest.load(os.path.join(root, 'bin')))
+
+        # The same libraries are found with and without it.
+        found = sorted(libs.find_shared_libraries(root))
+        os.unlink(loaded.path)
+        self.assertEqual(found, sorted(libs.find_shared_libraries(root)))
+        self.assertIn(os.path.join(root, 'lib', 'libbar.dylib'), found)
+        self.assertIn(os.path.join(root, 'Foo.framework', 'Foo'), found)
+        self.assertNotIn(os.path.join(root, 'share', 'doc', 'README'), found)
+
+    def test_chmod_and_archive(self):
+
+        root = self.make_tree()
+        manifest = FileManifest.scan(root)
+        manifest.chmod('o-w')
+        manifest.save()
+
+        self.assertEqual(stat.S_IMODE(os.stat(os.path.join(root, 'bin', 'tool')).st_mode), 0o775)
+        self.assertEqual(FileManifest.load(root).get('bin/tool').mode, 0o775)
+
+        path = self.sandbox('archive.tgz')
+        with tarfile.open(path, 'w:gz') as archive:
+            archive_tree(archive, root, manifest=FileManifest.load(root))
+        with tarfile.open(path) as archive:
+            names = set(archive.getnames())
+        self.assertIn('.vee-files.json', names)
+        self.assertIn('lib/sub/data.txt', names)
+        self.assertIn('share/docs', names)
+
+    def test_recorded_at_install(self):
+
+        home = self.home()
+        pkg = self.package('foo')
+        pkg.render_commit()
+        home.main(['install', pkg.git_url, '--install-name', 'foo/1.0.0', '--make-install'])
+
+        install_path = home._abs_path('installs', 'foo/1.0.0')
+        manifest = FileManifest.load(install_path)
+        self.assertIsNotNone(manifest)
+        self.assertEqual(manifest.get('bin/foo').type, 'f')
+
+        home.main(['link', '-e', 'manifest-env', pkg.git_url, '--install-name', 'foo/1.0.0', '--make-install'])
+        self.assertExists(home._abs_path('environments', 'manifest-env', 'bin', 'foo'))
+        self.assertFalse(os.path.lexists(home._abs_path('environments', 'manifest-env', '.vee-files.json')))
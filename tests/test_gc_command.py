@@ -0,0 +1,56 @@
+from . import *
+
+
+class TestGcCommand(TestCase):
+
+    def test_prune_packages(self):
+
+        home = self.home()
+        root = self.sandbox()
+
+        def install(name):
+            path = os.path.join(root, 'installs', name)
+            makedirs(path)
+            return path
+
+        con = home.db.connect()
+        with con:
+            ids = {}
+            for name, install_path in (
+                ('linked', install('linked')),
+                ('dependee', install('dependee')),
+                ('unused', install('unused')),
+                ('missing', os.path.join(root, 'installs', 'missing')),
+                ('duplicate', install('linked')),
+            ):
+                ids[name] = con.execute('INSERT INTO packages (url, name, install_path, build_path, created_at) VALUES (?, ?, ?, ?, ?)', [
+                    'url', name, install_path, os.path.join(root, 'builds', name),
+                    '2000-01-01' if name == 'duplicate' else '2001-01-01',
+                ]).lastrowid
+            makedirs(os.path.join(root, 'builds', 'unused'))
+            con.execute('INSERT INTO package_dependencies (depender_id, dependee_id) VALUES (?, ?)', [ids['linked'], ids['dependee']])
+            con.execute('INSERT INTO package_dependencies (depender_id, dependee_id) VALUES (?, ?)', [ids['unused'], ids['dependee']])
+            env_path = os.path.join(root, 'environments', 'env')
+            makedirs(env_path)
+            env_id = con.execute("INSERT INTO environments (name, path) VALUES ('env', ?)", [env_path]).lastrowid
+            gone_id = con.execute("INSERT INTO environments (name, path) VALUES ('gone', ?)", [env_path + '-gone']).lastrowid
+            con.execute('INSERT INTO links (environment_id, package_id) VALUES (?, ?)', [env_id, ids['linked']])
+            con.execute('INSERT INTO links (environment_id, package_id) VALUES (?, ?)', [gone_id, ids['unused']])
+
+        self.assertFalse(home.main(['gc', '--prune-packages', '--dry-run']))
+        self.assertEqual(con.execute('SELECT count(1) FROM packages').fetchone()[0], 5)
+        self.assertEqual(con.execute('SELECT count(1) FROM environments').fetchone()[0], 2)
+
+        self.assertFalse(home.main(['gc', '--prune-packages', '--jobs', '4']))
+
+        remaining = set(row[0] for row in con.execute('SELECT name FROM packages'))
+        self.assertEqual(remaining, set(['linked', 'dependee']))
+        self.assertEqual([row[0] for row in con.execute('SELECT name FROM environments')], ['env'])
+        self.assertFalse(os.path.exists(os.path.join(root, 'installs', 'unused')))
+        self.assertFalse(os.path.exists(os.path.join(root, 'builds', 'unused')))
+        self.assertExists(os.path.join(root, 'installs', 'linked'))
+        self.assertExists(os.path.join(root, 'installs', 'dependee'))
+
+        # Everything else went with them.
+        self.assertEqual(con.execute('SELECT count(1) FROM links').fetchone()[0], 1)
+        self.assertEqual([tuple(x) for x in con.execute('SELECT depender_id, dependee_id FROM package_dependencies').fetchall()], [(ids['linked'], ids['dependee'])])
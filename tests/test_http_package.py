@@ -1,5 +1,10 @@
 from . import *
 
+import hashlib
+import json
+
+from vee.pipeline.http import download
+
 
 class TestHttpManager(TestCase):
 
@@ -42,3 +47,63 @@ class TestHttpManager(TestCase):
         self.assertExists(sandbox('vee/installs/baz/1.0.0/bin/baz'))
 
 
+
+    def test_resume_download(self):
+
+        root = self.sandbox()
+        makedirs(root)
+        src = os.path.join(root, 'big.bin')
+        content = os.urandom(100000)
+        with open(src, 'wb') as fh:
+            fh.write(content)
+        url = mock_url(os.path.relpath(src, sandbox()))
+        dst = os.path.join(root, 'downloads', 'big.bin')
+
+        download(url, dst)
+        with open(dst, 'rb') as fh:
+            self.assertEqual(fh.read(), content)
+        self.assertFalse(os.path.exists(dst + '.downloading.json'))
+
+        def interrupted(prefix, etag):
+            os.unlink(dst)
+            with open(dst + '.downloading', 'wb') as fh:
+                fh.write(prefix)
+            with open(dst + '.downloading.json', 'w') as fh:
+                json.dump({'url': url, 'etag': etag, 'last_modified': None}, fh)
+
+        # What we already have is kept (even if it were wrong, which is how
+        # we know it was resumed).
+        etag = '"%s"' % hashlib.md5(content).hexdigest()
+        interrupted(b'x' * 1000, etag)
+        download(url, dst)
+        with open(dst, 'rb') as fh:
+            self.assertEqual(fh.read(), b'x' * 1000 + content[1000:])
+
+        # The file has changed, so it is all fetched again.
+        interrupted(b'x' * 1000, '"something-else"')
+        download(url, dst)
+        with open(dst, 'rb') as fh:
+            self.assertEqual(fh.read(), content)
+
+        # Too much is restarted.
+        interrupted(content + b'extra', etag)
+        download(url, dst)
+        with open(dst, 'rb') as fh:
+            self.assertEqual(fh.read(), content)
+
+        # Servers which don't do ranges send it all.
+        pkg = MockPackage('test_resume_download', 'c_configure_make_install')
+        pkg.render_commit()
+        url = mock_url('packages/test_resume_download.tgz')
+        dst = os.path.join(root, 'downloads', 'test_resume_download.tgz')
+        partial = dst + '.downloading'
+        makedirs(os.path.dirname(dst))
+        with open(partial, 'wb') as fh:
+            fh.write(b'x' * 10)
+        with open(dst + '.downloading.json', 'w') as fh:
+            json.dump({'url': url, 'etag': '"whatever"'}, fh)
+        download(url, dst)
+        with open(dst, 'rb') as fh:
+            self.assertEqual(fh.read(2), b'\x1f\x8b')
+
+        self.assertRaises(ValueError, download, mock_url('does/not/exist'), os.path.join(root, 'missing'))
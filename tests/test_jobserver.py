@@ -0,0 +1,52 @@
+from . import *
+
+import threading
+
+from vee.jobserver import Jobserver, default_jobs
+
+
+class TestJobserver(TestCase):
+
+    def test_default_jobs(self):
+        self.assertEqual(default_jobs({'VEE_MAKE_JOBS': '3'}), 3)
+        self.assertGreaterEqual(default_jobs({}), 1)
+
+    def test_bounded_across_makes(self):
+
+        root = self.sandbox()
+        makedirs(root)
+        with open(os.path.join(root, 'Makefile'), 'w') as fh:
+            fh.write(dedent('''
+                all: a b c d
+                a b c d:
+                \t@mkdir $@.running
+                \t@ls -d ../*/*.running | wc -l >> $@.seen
+                \t@sleep 0.2
+                \t@rmdir $@.running
+            '''))
+
+        jobserver = Jobserver(2)
+
+        def build(i):
+            kwargs = {'cwd': os.path.join(root, str(i))}
+            makedirs(kwargs['cwd'])
+            jobserver.prepare(kwargs)
+            token = jobserver.acquire()
+            try:
+                call(['make', '-f', '../Makefile'], **kwargs)
+            finally:
+                jobserver.release(token)
+
+        threads = [threading.Thread(target=build, args=(i, )) for i in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        seen = []
+        for i in range(2):
+            for name in 'abcd':
+                with open(os.path.join(root, str(i), name + '.seen')) as fh:
+                    seen.extend(int(x) for x in fh.read().split())
+        self.assertEqual(len(seen), 8)
+        self.assertLessEqual(max(seen), 2)
@@ -0,0 +1,199 @@
+from . import *
+
+import errno
+from unittest import mock
+
+from vee.environment import Environment
+from vee.exceptions import LinkConflict
+from vee.filemanifest import FileManifest
+from vee.linkplan import LinkPlan
+from vee.pipeline.make import MakeBuilder
+
+
+class TestLinkPlan(TestCase):
+
+    def make_install(self, name, files):
+        root = self.sandbox('installs', name)
+        for path, content in files.items():
+            path = os.path.join(root, path)
+            makedirs(os.path.dirname(path))
+            with open(path, 'wb') as fh:
+                fh.write(content)
+            if content.startswith(b'#!'):
+                os.chmod(path, 0o755)
+        FileManifest.scan(root).save()
+        return root
+
+    def test_shared_directories(self):
+
+        home = self.home()
+        env = Environment('plan', home=home)
+
+        foo = self.make_install('foo', {
+            'lib/python/site-packages/foo/__init__.py': b'',
+            'share/foo/README': b'foo',
+            'share/doc/CONFLICT': b'foo',
+        })
+        bar = self.make_install('bar', {
+            'lib/python/site-packages/bar/__init__.py': b'',
+            'bin/bar': b'#!/usr/bin/python\nprint("bar")\n',
+            'share/doc/CONFLICT': b'bar',
+        })
+
+        plan = LinkPlan(env)
+        plan.add(foo)
+        plan.add(bar)
+        plan.apply()
+
+        site_packages = os.path.join(env.path, 'lib', 'python', 'site-packages')
+        self.assertFalse(os.path.islink(site_packages))
+        self.assertEqual(os.readlink(os.path.join(site_packages, 'foo')), os.path.join(foo, 'lib/python/site-packages/foo'))
+        self.assertEqual(os.readlink(os.path.join(site_packages, 'bar')), os.path.join(bar, 'lib/python/site-packages/bar'))
+
+        # Nothing else wanted share/foo, so it is linked whole.
+        self.assertEqual(os.readlink(os.path.join(env.path, 'share', 'foo')), os.path.join(foo, 'share/foo'))
+
+        # The first to link wins.
+        with open(os.path.join(env.path, 'share', 'doc', 'CONFLICT'), 'rb') as fh:
+            self.assertEqual(fh.read(), b'foo')
+
+        # Scripts get a shebang to the environment (and so are not links).
+        script = os.path.join(env.path, 'bin', 'bar')
+        self.assertFalse(os.path.islink(script))
+        with open(script, 'rb') as fh:
+            self.assertEqual(fh.readline(), b'#!' + os.path.join(env.path, 'bin', 'python').encode() + b'\n')
+
+        self.assertEqual(plan.count, 2)
+        self.assertLess(plan.calls, plan.naive_calls)
+
+    def test_same_as_one_at_a_time(self):
+
+        home = self.home()
+        env = Environment('existing', home=home)
+
+        foo = self.make_install('foo', {
+            'share/foo/a': b'a',
+            'share/foo/sub/b': b'b',
+        })
+        baz = self.make_install('baz', {
+            'share/foo/c': b'c',
+            'share/foo/sub/d': b'd',
+        })
+
+        # The first is linked whole (and on disk), so the second must
+        # replace that link with a directory.
+        env.link_directory(foo)
+        self.assertTrue(os.path.islink(os.path.join(env.path, 'share')))
+        env.link_directory(baz)
+
+        share = os.path.join(env.path, 'share')
+        self.assertFalse(os.path.islink(share))
+        self.assertFalse(os.path.islink(os.path.join(share, 'foo', 'sub')))
+        for name in ('a', 'sub/b', 'c', 'sub/d'):
+            self.assertExists(os.path.join(share, 'foo', name))
+
+        # Doing it again changes nothing.
+        plan = LinkPlan(env)
+        plan.add(foo)
+        plan.add(baz)
+        plan.apply()
+        self.assertEqual(sorted(os.listdir(os.path.join(share, 'foo'))), ['a', 'c', 'sub'])
+
+        env.unlink_directory(baz)
+        self.assertEqual(sorted(os.listdir(os.path.join(share, 'foo'))), ['a', 'sub'])
+        self.assertEqual(os.listdir(os.path.join(share, 'foo', 'sub')), ['b'])
+
+    def test_conflicts(self):
+
+        home = self.home()
+        foo = self.make_install('foo', {
+            'share/doc/CONFLICT': b'foo',
+            'share/foo/README': b'foo',
+        })
+        bar = self.make_install('bar', {
+            'share/doc/CONFLICT': b'bar',
+            'share/bar/README': b'bar',
+        })
+
+        def read(env):
+            with open(os.path.join(env.path, 'share', 'doc', 'CONFLICT'), 'rb') as fh:
+                return fh.read()
+
+        env = Environment('first', home=home)
+        plan = LinkPlan(env)
+        plan.add(foo)
+        plan.add(bar)
+        self.assertEqual([c.path for c in plan.conflicts], ['share/doc/CONFLICT'])
+        self.assertEqual(plan.conflicts[0].existing, os.path.join(foo, 'share/doc/CONFLICT'))
+        self.assertEqual(plan.conflicts[0].new, os.path.join(bar, 'share/doc/CONFLICT'))
+        plan.apply()
+        self.assertEqual(read(env), b'foo')
+
+        env = Environment('last', home=home)
+        plan = LinkPlan(env, 'last')
+        plan.add(foo)
+        plan.add(bar)
+        plan.apply()
+        self.assertEqual(read(env), b'bar')
+
+        # Including over what is already on disk.
+        plan = LinkPlan(env, 'last')
+        plan.add(foo)
+        plan.apply()
+        self.assertEqual(read(env), b'foo')
+
+        # Nothing of a conflicting install is linked.
+        env = Environment('error', home=home)
+        plan = LinkPlan(env, 'error')
+        plan.add(foo)
+        self.assertRaises(LinkConflict, plan.add, bar)
+        plan.apply()
+        self.assertEqual(read(env), b'foo')
+        self.assertExists(os.path.join(env.path, 'share', 'foo', 'README'))
+        self.assertFalse(os.path.lexists(os.path.join(env.path, 'share', 'bar')))
+
+        # Linking the same install again is not a conflict.
+        plan = LinkPlan(env, 'error')
+        plan.add(foo)
+        plan.apply()
+        self.assertEqual(plan.conflicts, [])
+
+        self.assertRaises(ValueError, LinkPlan, env, 'bogus')
+
+    def test_failed_apply_records_nothing(self):
+
+        home = self.home()
+        pkg = self.package('foo', 'c_configure_make_install')
+        pkg.render_commit()
+
+        failure = OSError(errno.EACCES, 'Permission denied')
+        with mock.patch.object(LinkPlan, 'apply', side_effect=failure):
+            try:
+                home.main(['link', '-e', 'failed-apply', pkg.git_url, '--make-install'])
+            except OSError:
+                pass
+
+        # It was installed, but not linked.
+        con = home.db.connect()
+        self.assertEqual(con.execute('SELECT count(1) FROM packages').fetchone()[0], 1)
+        self.assertEqual(con.execute('SELECT count(1) FROM links').fetchone()[0], 0)
+
+        home.main(['link', '-e', 'failed-apply', pkg.git_url, '--make-install'])
+        self.assertEqual(con.execute('SELECT count(1) FROM links').fetchone()[0], 1)
+        self.assertExists(os.path.join(home._abs_path('environments', 'failed-apply'), 'bin', 'foo'))
+
+    def test_failed_package_into_new_environment(self):
+
+        home = self.home()
+        pkg = self.package('foo', 'c_configure_make_install')
+        pkg.render_commit()
+
+        def broken(self, pkg):
+            raise RuntimeError('broken build')
+
+        # The failure is reported per package, and there is nothing to link.
+        with mock.patch.object(MakeBuilder, 'build', broken):
+            home.main(['link', '-e', 'never-made', pkg.git_url, '--make-install'])
+
+        self.assertFalse(os.path.lexists(home._abs_path('environments', 'never-made')))
+        self.assertEqual(home.db.execute('SELECT count(1) FROM links').fetchone()[0], 0)
@@ -0,0 +1,67 @@
+from . import *
+
+import sqlite3
+import time
+
+from vee.packagerecord import PackageRecord
+
+
+class TestListCommand(TestCase):
+
+    def test_records(self):
+
+        home = self.home()
+
+        pkg = self.package('foo', 'c_configure_make_install')
+        pkg.render_commit()
+        home.main(['install', pkg.git_url, '--install-name', 'foo/1.2.3', '--make-install'])
+
+        record = PackageRecord.find(home, name='foo')
+        # Git packages are pinned to their commit.
+        self.assertEqual(len(record.version), 8)
+        self.assertEqual(str(record), '%s --install-name=foo/1.2.3 --name=foo --version=%s' % (record.url, record.version))
+        self.assertRaises(AttributeError, setattr, record, 'name', 'bar')
+        self.assertEqual(record.dependencies, [])
+
+        full = record.to_package()
+        self.assertEqual(full.id, record.id)
+        self.assertEqual(full.install_path, record.install_path)
+        self.assertTrue(full.pipeline.has_run('init'))
+
+        self.assertFalse(home.main(['list']))
+        self.assertFalse(home.main(['list', 'foo']))
+        self.assertFalse(home.main(['list', '--dependents', 'foo']))
+        self.assertTrue(home.main(['list', 'does-not-exist']))
+
+    def test_load_all(self):
+
+        home = self.home()
+        con = home.db.connect()
+        with con:
+            con.executemany('INSERT INTO packages (url, name, provides, install_path) VALUES (?, ?, ?, ?)', [
+                ('git+https://example.com/pkg%d' % i, 'pkg%d' % i, 'version=1.%d' % i, '/installs/%d' % i)
+                for i in range(20000)
+            ])
+            con.executemany('INSERT INTO package_dependencies (depender_id, dependee_id) VALUES (?, ?)', [
+                (i, i + 1) for i in range(1, 20000, 2)
+            ])
+
+        start = time.time()
+        records = PackageRecord.load_all(home)
+        log.debug('Loaded %d records in %.3fs' % (len(records), time.time() - start), name='vee.tests')
+
+        self.assertEqual(len(records), 20000)
+        by_id = dict((r.id, r) for r in records)
+        self.assertEqual([d.id for d in by_id[1].dependencies], [2])
+        self.assertEqual(by_id[1].dependencies[0].version, '1.1')
+        self.assertEqual(by_id[2].dependencies, [])
+
+        # More than SQLite allows in one query (on older builds, at least).
+        if hasattr(con, 'setlimit'):
+            con.setlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER, 999)
+        ids = list(range(1, 2001))
+        self.assertEqual(sorted(r.id for r in PackageRecord.load(home, ids)), ids)
+        closure = PackageRecord.load_closure(home, range(1, 2001, 2))
+        self.assertEqual(len(closure), 2000)
+        self.assertEqual([d.id for d in closure[0].dependencies], [2])
+        self.assertEqual(len(home.db.get_dependents(range(2, 2001, 2))), 1000)
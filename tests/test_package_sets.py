@@ -1,7 +1,11 @@
 from . import *
 
+from unittest import mock
+
 from vee.manifest import Manifest
+from vee.package import Package
 from vee.packageset import PackageSet
+from vee.utils import guess_name
 
 class TestPackageSets(TestCase):
 
@@ -27,3 +31,67 @@ class TestPackageSets(TestCase):
         env = second.fresh_environ()
 
         self.assertEqual(env['FIRST'], '/path/to/first')
+
+    def test_bulk_resolve_existing(self):
+
+        home = self.home()
+
+        foo = self.package('foo')
+        foo.render_commit()
+        home.main(['install', foo.git_url, '--install-name', 'foo/1.0.0', '--make-install'])
+
+        reqs = Manifest(home=home)
+        reqs.parse_file([
+            '%s --install-name foo/1.0.0 --make-install' % foo.git_url,
+            '%s --install-name foo/2.0.0 --make-install' % foo.git_url.replace('foo', 'bar'),
+        ])
+
+        # Everything is resolved in bulk; never per-package.
+        with mock.patch.object(Package, 'resolve_existing', side_effect=AssertionError('not in bulk')):
+            pkgs = PackageSet(home=home)
+            pkgs.resolve_set(reqs)
+
+        self.assertIsNotNone(pkgs['foo'].id)
+        self.assertEqual(pkgs['foo'].install_path, home._abs_path('installs', 'foo/1.0.0'))
+        self.assertIsNone(pkgs['bar'].id)
+
+        # It agrees with resolving them one at a time.
+        for req in reqs.iter_packages():
+            pkg = req.copy()
+            pkg.name = pkg.name or guess_name(pkg.url)
+            found = pkg.resolve_existing()
+            self.assertEqual(pkg.id, pkgs[pkg.name].id)
+            self.assertEqual(bool(found), pkg.name == 'foo')
+
+    def test_resolve_by_provisions(self):
+
+        home = self.home()
+
+        foo = self.package('foo')
+        foo.render_commit()
+        for python in ('3.9', '3.10'):
+            home.main(['install', foo.git_url, '--provides', 'python=' + python, '--install-name', 'foo/py' + python, '--make-install'])
+
+        rows = home.db.execute('''
+            SELECT packages.install_name, package_provisions.name, value FROM package_provisions
+            JOIN packages ON packages.id = package_id
+        ''').fetchall()
+        self.assertIn(('foo/py3.10', 'python', '3.10'), [tuple(row) for row in rows])
+
+        for python in ('3.9', '3.10', '3.11'):
+
+            reqs = Manifest(home=home)
+            reqs.parse_file(['%s --provides python=%s --make-install' % (foo.git_url, python)])
+            pkgs = PackageSet(home=home)
+            pkgs.resolve_set(reqs)
+
+            pkg = next(reqs.iter_packages()).copy()
+            pkg.name = 'foo'
+            found = pkg.resolve_existing()
+
+            if python == '3.11':
+                self.assertIsNone(pkgs['foo'].id)
+                self.assertFalse(found)
+            else:
+                self.assertEqual(pkgs['foo'].install_name, 'foo/py' + python)
+                self.assertEqual(pkg.id, pkgs['foo'].id)
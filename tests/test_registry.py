@@ -0,0 +1,57 @@
+from . import *
+
+import json
+
+from vee import registry
+
+
+class TestRegistry(TestCase):
+
+    def setUp(self):
+        self.path = self.sandbox('registry.json')
+        makedirs(os.path.dirname(self.path))
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self._environ = os.environ.get('VEE_REGISTRY_CACHE')
+        os.environ['VEE_REGISTRY_CACHE'] = self.path
+
+    def tearDown(self):
+        if self._environ is None:
+            os.environ.pop('VEE_REGISTRY_CACHE', None)
+        else:
+            os.environ['VEE_REGISTRY_CACHE'] = self._environ
+
+    def test_cache_roundtrip(self):
+
+        scanned = registry._load()
+        self.assertTrue(os.path.exists(self.path))
+
+        steps = dict((x[0], x) for x in scanned['groups']['vee_pipeline_steps'])
+        self.assertEqual(steps['git'][1], 'vee.pipeline.git:GitTransport')
+        self.assertEqual(steps['git'][2]['factory_steps'], ['init'])
+        self.assertEqual(steps['generic'][2]['factory_priority'], 0)
+        self.assertNotIn('factory_steps', steps['generic'][2])
+
+        commands = [x[0] for x in scanned['groups']['vee_commands']]
+        self.assertIn('install', commands)
+
+        # Comes back from the cache.
+        with open(self.path) as fh:
+            cached = json.load(fh)
+        cached['groups']['vee_commands'].append(['fake', 'vee.fake:fake', {}])
+        with open(self.path, 'w') as fh:
+            json.dump(cached, fh)
+        loaded = registry._load()
+        self.assertEqual(loaded['groups']['vee_commands'][-1][0], 'fake')
+
+        # Is thrown out when the fingerprint doesn't match.
+        cached['fingerprint'] = 'nope'
+        with open(self.path, 'w') as fh:
+            json.dump(cached, fh)
+        loaded = registry._load()
+        self.assertNotIn('fake', [x[0] for x in loaded['groups']['vee_commands']])
+
+    def test_entry_point_load(self):
+        from vee.pipeline.git import GitTransport
+        ep = registry.EntryPoint('git', 'vee.pipeline.git:GitTransport')
+        self.assertIs(ep.load(), GitTransport)
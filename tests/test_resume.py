@@ -0,0 +1,44 @@
+from . import *
+
+import json
+from unittest import mock
+
+from vee.pipeline.make import MakeBuilder
+
+
+class TestResume(TestCase):
+
+    def test_resume_after_failed_install(self):
+
+        home = self.home()
+
+        pkg = self.package('foo', 'c_configure_make_install')
+        pkg.render_commit()
+
+        def interrupted(self, pkg):
+            raise RuntimeError('interrupted')
+
+        with mock.patch.object(MakeBuilder, 'install', interrupted):
+            home.main(['install', pkg.git_url, '--make-install'])
+
+        rows = home.db.execute('SELECT steps, state FROM pipeline_checkpoints').fetchall()
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0]['steps'], 'extract,build')
+        build_path = json.loads(rows[0]['state'])['build_path']
+        self.assertTrue(os.path.exists(build_path))
+
+        home.main(['install', pkg.git_url, '--make-install'])
+
+        def count(step):
+            return home.db.execute('SELECT count(1) FROM pipeline_timings WHERE name = ? AND step = ?', [pkg.name, step]).fetchone()[0]
+        self.assertEqual(count('extract'), 1)
+        self.assertEqual(count('build'), 1)
+        self.assertEqual(count('install'), 2)
+
+        row = home.db.execute('SELECT build_path, install_path FROM packages WHERE name = ?', [pkg.name]).fetchone()
+        self.assertEqual(row['build_path'], build_path)
+        self.assertExists(os.path.join(row['install_path'], 'bin', 'foo'))
+
+        # Done with it.
+        rows = home.db.execute('SELECT steps FROM pipeline_checkpoints').fetchall()
+        self.assertEqual(len(rows), 0)
@@ -0,0 +1,45 @@
+from . import *
+
+import contextlib
+import io
+
+
+class TestStatsCommand(TestCase):
+
+    def test_timings_recorded(self):
+
+        home = self.home()
+
+        pkg = self.package('foo', 'c_configure_make_install')
+        pkg.render_commit()
+
+        home.main(['install', pkg.path, '--make-install'])
+
+        rows = home.db.execute('SELECT step, wall_time, cpu_time FROM pipeline_timings WHERE name = ?', [pkg.name]).fetchall()
+        steps = [row['step'] for row in rows]
+        for step in ('init', 'fetch', 'extract', 'build', 'install'):
+            self.assertIn(step, steps)
+
+        build = next(row for row in rows if row['step'] == 'build')
+        self.assertGreater(build['wall_time'], 0)
+        self.assertGreater(build['cpu_time'], 0)
+
+        def stats(*args):
+            out = io.StringIO()
+            with contextlib.redirect_stdout(out):
+                home.main(['stats'] + list(args))
+            return strip_ansi(out.getvalue())
+
+        out = stats()
+        self.assertIn('Slowest packages', out)
+        # One run of foo, with its mean and last being the same.
+        self.assertRegex(out, r'(?m)^  foo\s+1\s+(\S+)\s+\1\s+\S+\s+\S+$')
+        self.assertRegex(out, r'(?m)^  foo\s+build\s+make\s+1\s+\d+\.\ds\s+\d+\.\ds\s+\d+\.\ds$')
+        self.assertRegex(out, r'(?m)^  install\s+\d+\.\ds\s+\d+\.\ds\s+\d+(\.\d)?[kMG]?B$')
+
+        out = stats('--step', 'build')
+        self.assertRegex(out, r'(?m)^  foo\s+build\s')
+        self.assertNotRegex(out, r'(?m)^  foo\s+install\s')
+        self.assertNotRegex(out, r'(?m)^  install\s')
+
+        self.assertIn('No timings recorded.', stats('does-not-exist'))
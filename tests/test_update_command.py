@@ -1,5 +1,10 @@
 from . import *
 
+from unittest import mock
+
+from vee.environment import Environment
+from vee.environmentrepo import EnvironmentRepo
+
 
 class TestUpdateCommand(TestCase):
 
@@ -38,3 +43,264 @@ class TestUpdateCommand(TestCase):
         self.assertExists(os.path.join(VEE, 'environments', repo.name, default_branch, 'bin/tr_basics_bar'))
         self.assertExists(os.path.join(VEE, 'environments', repo.name, 'commits', commit, 'bin/tr_basics_bar'))
 
+
+    def test_parallel_upgrade(self):
+
+        repo = MockRepo('tr_parallel')
+        for name in ('tr_parallel_foo', 'tr_parallel_bar', 'tr_parallel_baz'):
+            MockPackage(name, 'c_configure_make_install').render_commit()
+            repo.add_requirements('packages/%s --install-name %s/1.0.0 --make-install' % (name, name))
+
+        vee(['repo', 'clone', repo.path, repo.name])
+        vee(['upgrade', '--repo', repo.name, '--jobs', '3'])
+
+        for name in ('tr_parallel_foo', 'tr_parallel_bar', 'tr_parallel_baz'):
+            self.assertExists(os.path.join(VEE, 'installs', name, '1.0.0/bin', name))
+            self.assertExists(os.path.join(VEE, 'environments', repo.name, default_branch, 'bin', name))
+
+    def test_incremental_upgrade(self):
+
+        repo = MockRepo('tr_incremental')
+        for name in ('tr_incremental_foo', 'tr_incremental_bar', 'tr_incremental_baz'):
+            MockPackage(name, 'c_configure_make_install').render_commit()
+            repo.add_requirements('packages/%s --install-name %s/1.0.0 --make-install' % (name, name))
+
+        vee(['repo', 'clone', repo.path, repo.name])
+        vee(['upgrade', '--repo', repo.name])
+        first = os.path.join(VEE, 'environments', repo.name, 'commits', repo.rev_list()[0][:8])
+
+        # Bump foo, and drop bar.
+        repo.add_requirements('packages/tr_incremental_foo --install-name tr_incremental_foo/1.0.1 --make-install', commit=False)
+        path = os.path.join(repo.path, 'manifest.txt')
+        with open(path) as fh:
+            lines = [line for line in fh if 'tr_incremental_bar' not in line]
+        with open(path, 'w') as fh:
+            fh.writelines(lines)
+        repo.commit('bump foo, drop bar')
+
+        vee(['update', '--repo', repo.name])
+        vee(['upgrade', '--repo', repo.name])
+        second = os.path.join(VEE, 'environments', repo.name, 'commits', repo.rev_list()[0][:8])
+
+        self.assertNotEqual(first, second)
+        self.assertEqual(os.readlink(os.path.join(second, 'bin', 'tr_incremental_foo')),
+            os.path.join(VEE, 'installs/tr_incremental_foo/1.0.1/bin/tr_incremental_foo'))
+        self.assertExists(os.path.join(second, 'bin', 'tr_incremental_baz'))
+        self.assertFalse(os.path.lexists(os.path.join(second, 'bin', 'tr_incremental_bar')))
+        self.assertExists(os.path.join(second, 'bin', 'python'))
+
+        # The previous environment is untouched.
+        self.assertEqual(os.readlink(os.path.join(first, 'bin', 'tr_incremental_foo')),
+            os.path.join(VEE, 'installs/tr_incremental_foo/1.0.0/bin/tr_incremental_foo'))
+        self.assertExists(os.path.join(first, 'bin', 'tr_incremental_bar'))
+
+        # Links were carried over for the unchanged packages.
+        con = home.db.connect()
+        names = set(row[0] for row in con.execute('''
+            SELECT packages.name FROM links
+            JOIN packages ON packages.id = links.package_id
+            JOIN environments ON environments.id = links.environment_id
+            WHERE environments.path = ?
+        ''', [second]))
+        self.assertEqual(names, set(['tr_incremental_foo', 'tr_incremental_baz']))
+
+    def test_derive_checks_installs_and_dependencies(self):
+
+        repo = MockRepo('tr_derive')
+        for name in ('tr_derive_foo', 'tr_derive_bar', 'tr_derive_baz'):
+            MockPackage(name, 'c_configure_make_install').render_commit()
+            repo.add_requirements('packages/%s --install-name %s/1.0.0 --make-install' % (name, name))
+
+        vee(['repo', 'clone', repo.path, repo.name])
+        vee(['upgrade', '--repo', repo.name])
+        first = os.path.join(VEE, 'environments', repo.name, 'commits', repo.rev_list()[0][:8])
+
+        # Give bar and baz each a dependency which isn't in the manifest.
+        con = home.db.connect()
+        env_id = con.execute('SELECT id FROM environments WHERE path = ?', [first]).fetchone()[0]
+        for depender in ('tr_derive_bar', 'tr_derive_baz'):
+            name = depender + '_dep'
+            install_path = self.sandbox('installs', name)
+            makedirs(os.path.join(install_path, 'share', name))
+            with open(os.path.join(install_path, 'share', name, 'README'), 'w') as fh:
+                fh.write(name)
+            Environment(first, home=home).link_directory(install_path)
+            with con:
+                dep_id = con.execute('INSERT INTO packages (name, url, install_path) VALUES (?, ?, ?)',
+                    [name, 'file:' + install_path, install_path]).lastrowid
+                depender_id = con.execute('SELECT id FROM packages WHERE name = ?', [depender]).fetchone()[0]
+                con.execute('INSERT INTO package_dependencies (depender_id, dependee_id) VALUES (?, ?)', [depender_id, dep_id])
+                con.execute('INSERT INTO links (environment_id, package_id) VALUES (?, ?)', [env_id, dep_id])
+
+        # Lose foo's install, and drop bar.
+        shutil.rmtree(os.path.join(VEE, 'installs/tr_derive_foo/1.0.0'))
+        path = os.path.join(repo.path, 'manifest.txt')
+        with open(path) as fh:
+            lines = [line for line in fh if 'tr_derive_bar' not in line]
+        with open(path, 'w') as fh:
+            fh.writelines(lines)
+        repo.commit('drop bar')
+
+        vee(['update', '--repo', repo.name])
+        vee(['upgrade', '--repo', repo.name])
+        second = os.path.join(VEE, 'environments', repo.name, 'commits', repo.rev_list()[0][:8])
+
+        # Foo was installed (and linked) again.
+        self.assertExists(os.path.join(VEE, 'installs/tr_derive_foo/1.0.0/bin/tr_derive_foo'))
+        self.assertExists(os.path.join(second, 'bin', 'tr_derive_foo'))
+
+        # Only the dependency of what is still there is.
+        self.assertFalse(os.path.lexists(os.path.join(second, 'share', 'tr_derive_bar_dep')))
+        self.assertExists(os.path.join(second, 'share', 'tr_derive_baz_dep', 'README'))
+        names = set(row[0] for row in con.execute('''
+            SELECT packages.name FROM links
+            JOIN packages ON packages.id = links.package_id
+            JOIN environments ON environments.id = links.environment_id
+            WHERE environments.path = ?
+        ''', [second]))
+        self.assertEqual(names, set(['tr_derive_foo', 'tr_derive_baz', 'tr_derive_baz_dep']))
+
+    def test_noop_upgrade(self):
+
+        repo = MockRepo('tr_noop')
+        MockPackage('tr_noop_foo', 'c_configure_make_install').render_commit()
+        repo.add_requirements('packages/tr_noop_foo --install-name tr_noop_foo/1.0.0 --make-install')
+
+        vee(['repo', 'clone', repo.path, repo.name])
+        vee(['upgrade', '--repo', repo.name])
+
+        # Nothing changed, so the manifest is never even loaded.
+        with mock.patch.object(EnvironmentRepo, 'load_manifest', side_effect=AssertionError('loaded manifest')):
+            vee(['upgrade', '--repo', repo.name])
+            self.assertRaises(AssertionError, vee, ['upgrade', '--repo', repo.name, '--check'])
+
+        # A missing install forces the full check, which reinstalls it.
+        install_path = os.path.join(VEE, 'installs/tr_noop_foo/1.0.0')
+        shutil.rmtree(install_path)
+        with mock.patch.object(EnvironmentRepo, 'load_manifest', side_effect=AssertionError('loaded manifest')):
+            self.assertRaises(AssertionError, vee, ['upgrade', '--repo', repo.name])
+        vee(['upgrade', '--repo', repo.name])
+        self.assertExists(os.path.join(install_path, 'bin', 'tr_noop_foo'))
+
+    def test_upgrade_follows_branch(self):
+
+        pkg = MockPackage('tr_branch_foo', 'c_configure_make_install')
+        pkg.render_commit()
+        repo = MockRepo('tr_branch')
+        # Written as is, since parsing it would resolve the branch.
+        with open(os.path.join(repo.path, 'manifest.txt'), 'w') as fh:
+            fh.write('%s --version %s --make-install\n' % (pkg.git_url, default_branch))
+        repo.commit('follow a branch')
+
+        vee(['repo', 'clone', repo.path, repo.name])
+        vee(['upgrade', '--repo', repo.name])
+
+        def installed():
+            return os.path.join(VEE, 'installs', 'tr_branch_foo', pkg.rev_list()[0][:8], 'bin', 'tr_branch_foo')
+        self.assertExists(installed())
+
+        # The manifest is the same, but the branch has moved. (Rendering
+        # keeps the template's mtime, and the size is the same, so git would
+        # not always notice.)
+        pkg.render()
+        os.utime(os.path.join(pkg.path, 'tr_branch_foo.c'))
+        pkg.commit()
+        vee(['upgrade', '--repo', repo.name])
+        self.assertExists(installed())
+
+    def test_shared_environment(self):
+
+        repo = MockRepo('tr_shared')
+        MockPackage('tr_shared_foo', 'c_configure_make_install').render_commit()
+        repo.add_requirements('packages/tr_shared_foo --install-name tr_shared_foo/1.0.0 --make-install')
+
+        vee(['repo', 'clone', repo.path, repo.name])
+        vee(['upgrade', '--repo', repo.name])
+        first = os.path.join(VEE, 'environments', repo.name, 'commits', repo.rev_list()[0][:8])
+
+        # Only a comment changes, so the packages are the same.
+        with open(os.path.join(repo.path, 'manifest.txt'), 'a') as fh:
+            fh.write('# Nothing to see here.\n')
+        repo.commit('just a comment')
+
+        vee(['update', '--repo', repo.name])
+        vee(['upgrade', '--repo', repo.name])
+        second = os.path.join(VEE, 'environments', repo.name, 'commits', repo.rev_list()[0][:8])
+
+        self.assertNotEqual(first, second)
+        self.assertEqual(os.readlink(second), os.path.realpath(first))
+        self.assertExists(os.path.join(second, 'bin', 'tr_shared_foo'))
+
+        con = home.db.connect()
+        rows = con.execute('SELECT path, content_hash FROM environments WHERE path IN (?, ?)', [first, second]).fetchall()
+        self.assertEqual(len(rows), 2)
+        self.assertEqual(rows[0]['content_hash'], rows[1]['content_hash'])
+        self.assertTrue(rows[0]['content_hash'])
+        count = con.execute('''
+            SELECT count(1) FROM links
+            JOIN environments ON environments.id = links.environment_id
+            WHERE environments.path = ?
+        ''', [second]).fetchone()[0]
+        self.assertEqual(count, 1)
+
+        # The first may be old, but the second still needs it.
+        vee(['gc', '--prune-environments', '--keep-latest', '1'])
+        self.assertExists(os.path.join(first, 'bin', 'python'))
+        self.assertExists(os.path.join(second, 'bin', 'tr_shared_foo'))
+
+    def test_unshare_before_linking(self):
+
+        repo = MockRepo('tr_unshare')
+        MockPackage('tr_unshare_foo', 'c_configure_make_install').render_commit()
+        repo.add_requirements('packages/tr_unshare_foo --install-name tr_unshare_foo/1.0.0 --make-install')
+
+        vee(['repo', 'clone', repo.path, repo.name])
+        vee(['upgrade', '--repo', repo.name])
+        first = os.path.join(VEE, 'environments', repo.name, 'commits', repo.rev_list()[0][:8])
+
+        with open(os.path.join(repo.path, 'manifest.txt'), 'a') as fh:
+            fh.write('# Nothing to see here.\n')
+        repo.commit('just a comment')
+        vee(['update', '--repo', repo.name])
+        vee(['upgrade', '--repo', repo.name])
+        second = os.path.join(VEE, 'environments', repo.name, 'commits', repo.rev_list()[0][:8])
+        self.assertTrue(os.path.islink(second))
+
+        def snapshot():
+            con = home.db.connect()
+            row = con.execute('SELECT id, manifest, content_hash FROM environments WHERE path = ?', [first]).fetchone()
+            links = con.execute('SELECT package_id FROM links WHERE environment_id = ? ORDER BY package_id', [row['id']]).fetchall()
+            tree = []
+            for dir_path, dir_names, file_names in os.walk(first):
+                for name in sorted(dir_names + file_names):
+                    path = os.path.join(dir_path, name)
+                    tree.append((path, os.readlink(path) if os.path.islink(path) else None))
+            return tuple(row), [tuple(x) for x in links], sorted(tree)
+
+        before = snapshot()
+
+        # Relinking gives it a tree of its own first.
+        vee(['upgrade', '--repo', repo.name, '--relink'])
+        self.assertFalse(os.path.islink(second))
+        self.assertExists(os.path.join(second, 'bin', 'tr_unshare_foo'))
+        self.assertEqual(snapshot(), before)
+
+        # As does linking something else into one.
+        with open(os.path.join(repo.path, 'manifest.txt'), 'a') as fh:
+            fh.write('# Nor here.\n')
+        repo.commit('another comment')
+        vee(['update', '--repo', repo.name])
+        vee(['upgrade', '--repo', repo.name])
+        third = os.path.join(VEE, 'environments', repo.name, 'commits', repo.rev_list()[0][:8])
+        self.assertTrue(os.path.islink(third))
+
+        bar = self.sandbox('installs', 'tr_unshare_bar')
+        makedirs(os.path.join(bar, 'share', 'bar'))
+        with open(os.path.join(bar, 'share', 'bar', 'README'), 'w') as fh:
+            fh.write('bar')
+
+        vee(['link', '--directory', third, '--raw', bar])
+        self.assertFalse(os.path.islink(third))
+        self.assertExists(os.path.join(third, 'share', 'bar', 'README'))
+        self.assertFalse(os.path.lexists(os.path.join(first, 'share', 'bar')))
+        self.assertEqual(snapshot(), before)
@@ -1,8 +1,11 @@
+import errno
 import stat
 
 from . import *
 
-from vee.utils import guess_name, chmod
+from unittest import mock
+
+from vee.utils import guess_name, chmod, copy_range
 from vee.git import normalize_git_url
 
 
@@ -74,3 +77,31 @@ class TestChmod(TestCase):
             chmod(path, spec)
             mode = stat.S_IMODE(os.stat(path).st_mode)
             self.assertEqual(oct(mode), oct(end))
+
+
+class TestCopyRange(TestCase):
+
+    def test_copy_range(self):
+
+        dir_ = self.sandbox()
+        makedirs(dir_)
+        src = os.path.join(dir_, 'src')
+        with open(src, 'wb') as fh:
+            fh.write(os.urandom(3 * 1024 * 1024))
+        with open(src, 'rb') as fh:
+            content = fh.read()
+
+        def copy(path):
+            with open(src, 'rb') as src_fh, open(path, 'wb') as dst_fh:
+                dst_fh.write(b'header')
+                copy_range(src_fh, dst_fh, 10, len(content) - 10)
+            with open(path, 'rb') as fh:
+                return fh.read()
+
+        self.assertEqual(copy(os.path.join(dir_, 'kernel')), b'header' + content[10:])
+
+        # When the kernel can't do it.
+        unsupported = OSError(errno.EXDEV, 'nope')
+        with mock.patch.object(os, 'copy_file_range', side_effect=unsupported, create=True), \
+             mock.patch.object(os, 'sendfile', side_effect=unsupported, create=True):
+            self.assertEqual(copy(os.path.join(dir_, 'python')), b'header' + content[10:])
@@ -0,0 +1,197 @@
+"""Content-addressed cache of built packages.
+
+A package whose inputs (source, version, build options, environment,
+and the installs of its dependencies) have been built before does not need
+to be built again; we keep a tarball of what was installed after
+``post_install``, keyed by a hash of those inputs, and unpack that instead of
+building. Relocation and linking still happen as usual.
+
+The cache is only used if ``$VEE_BUILD_CACHE`` or ``$VEE_BUILD_CACHE_SIZE`` is
+set. It lives in ``$VEE_BUILD_CACHE`` (default ``$VEE/cache/builds``), which
+may be shared between hosts with the same ``$VEE``, and is trimmed back to
+``$VEE_BUILD_CACHE_SIZE`` (default ``10G``; ``0`` disables it) by evicting the
+least recently used builds.
+
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import sys
+import tarfile
+
+from vee import log
+from vee.cli import style_note
+from vee.filemanifest import FileManifest
+from vee.pipeline.generic import GenericBuilder
+from vee.subproc import call
+from vee.utils import makedirs, archive_tree
+
+
+DEFAULT_MAX_SIZE = '10G'
+
+_size_units = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+
+
+def parse_size(value):
+    """Parse sizes like ``"500M"`` or ``"10G"`` into bytes."""
+    value = value.strip().upper().rstrip('B')
+    unit = value[-1:] if value[-1:] in _size_units else ''
+    return int(float(value[:len(value) - len(unit)]) * _size_units[unit])
+
+
+class BuildCache(object):
+
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+
+    @classmethod
+    def from_environ(cls, home, environ=None):
+        environ = os.environ if environ is None else environ
+        path = environ.get('VEE_BUILD_CACHE')
+        size = environ.get('VEE_BUILD_CACHE_SIZE')
+        # Opt-in, since it can take a lot of space.
+        if not (path or size):
+            return
+        max_size = parse_size(size or DEFAULT_MAX_SIZE)
+        if not max_size:
+            return
+        path = os.path.expanduser(path) if path else home._abs_path('cache', 'builds')
+        return cls(path, max_size)
+
+    def is_cacheable(self, pkg):
+
+        # Only our own builders install into a path that we control; Homebrew
+        # and friends put things wherever they like. (We can't look at the
+        # install step yet, since builders pick it once they have built.)
+        if pkg.virtual or pkg.pseudo_homebrew:
+            return False
+        if not isinstance(pkg.pipeline.load('build'), GenericBuilder):
+            return False
+
+        # Local files may change without their URL changing.
+        if pkg.url.startswith('file:') and not (pkg.checksum or pkg.etag):
+            return False
+
+        return True
+
+    def get_key(self, pkg):
+        """Hash the inputs of a build, or return None if it can't be cached.
+
+        This must be called before building, since building tends to modify
+        the package (e.g. its ``build_subdir``).
+
+        """
+
+        if not self.is_cacheable(pkg):
+            return
+
+        pkg._assert_paths(install=True)
+
+        dependencies = []
+        for dep in pkg.dependencies:
+            dependencies.append('%s %s' % (dep.name, dep.install_path or dep.url))
+
+        # The requirement covers the url, version, config, and environ. We
+        # include the install path since builds tend to embed their prefix.
+        blob = json.dumps({
+            'platform': sys.platform,
+            'machine': os.uname()[4],
+            'requirement': pkg.to_args(),
+            'install_path': pkg.install_path,
+            'dependencies': sorted(dependencies),
+        }, sort_keys=True)
+
+        return hashlib.sha256(blob.encode('utf8')).hexdigest()
+
+    def _archive_path(self, key):
+        return os.path.join(self.path, key[:2], key + '.tgz')
+
+    def restore(self, pkg, key):
+        """Unpack a cached build into the install path; return if we did."""
+
+        path = self._archive_path(key)
+        if not os.path.exists(path):
+            log.debug('%s is not in build cache as %s' % (pkg.name, key))
+            return False
+
+        log.info(style_note('Restoring from build cache', key[:12]))
+
+        if os.path.exists(pkg.install_path):
+            log.warning('Removing existing install', pkg.install_path)
+            shutil.rmtree(pkg.install_path)
+        makedirs(pkg.install_path)
+
+        try:
+            call(['tar', 'xzf', path], cwd=pkg.install_path)
+        except Exception as e:
+            log.warning('Could not restore from build cache: %s' % e)
+            shutil.rmtree(pkg.install_path)
+            return False
+
+        # Our least-recently-used is by mtime, since atime is often disabled.
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+
+        return True
+
+    def store(self, pkg, key):
+        """Archive the install path into the cache, and evict old builds."""
+
+        path = self._archive_path(key)
+        if os.path.exists(path):
+            return
+
+        log.info(style_note('Storing in build cache', key[:12]))
+
+        # Write to a temporary name so that nobody (on this host or another)
+        # ever sees a partial archive.
+        tmp_path = '%s.%s.%d.tmp' % (path, os.uname()[1], os.getpid())
+        try:
+            makedirs(os.path.dirname(path))
+            with open(tmp_path, 'wb') as fh:
+                archive = tarfile.open(fileobj=fh, mode='w|gz')
+                archive_tree(archive, pkg.install_path, manifest=FileManifest.load(pkg.install_path))
+                archive.close()
+            os.rename(tmp_path, path)
+        except (OSError, tarfile.TarError) as e:
+            log.warning('Could not store in build cache: %s' % e)
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            return
+
+        self.evict()
+
+    def evict(self, max_size=None):
+        """Remove the least recently used builds until we fit in the cap."""
+
+        max_size = self.max_size if max_size is None else max_size
+
+        entries = []
+        total = 0
+        for dir_path, dir_names, file_names in os.walk(self.path):
+            for file_name in file_names:
+                if not file_name.endswith('.tgz'):
+                    continue
+                path = os.path.join(dir_path, file_name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue # Someone else evicted it.
+                entries.append((st.st_mtime, st.st_size, path))
+                total += st.st_size
+
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= max_size:
+                break
+            log.debug('Evicting %s from build cache' % os.path.basename(path))
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+            total -= size
@@ -1,3 +1,4 @@
+import concurrent.futures
 import os
 import re
 import shutil
@@ -8,15 +9,53 @@ from vee.cli import style_note, style_warning
 from vee import log
 
 
-def delete_environment(con, id_):
-    con.execute('DELETE FROM links WHERE environment_id = ?', [id_])
-    con.execute('DELETE FROM environments WHERE id = ?', [id_])
+# Links, shared libraries, and dependencies go with them (via ON DELETE CASCADE).
 
-def delete_package(con, id_):
-    con.execute('DELETE FROM package_dependencies WHERE depender_id = ? or dependee_id = ?', [id_, id_])
-    con.execute('DELETE FROM links WHERE package_id = ?', [id_])
-    con.execute('DELETE FROM shared_libraries WHERE package_id = ?', [id_])
-    con.execute('DELETE FROM packages WHERE id = ?', [id_])
+def delete_environments(con, ids):
+    con.executemany('DELETE FROM environments WHERE id = ?', [(id_, ) for id_ in ids])
+
+def delete_packages(con, ids):
+    con.executemany('DELETE FROM packages WHERE id = ?', [(id_, ) for id_ in ids])
+
+def delete_shebangs(con, install_paths):
+    # Everything within each; "0" sorts right after "/".
+    con.executemany('DELETE FROM shebangs WHERE path >= ? AND path < ?', [
+        (path.rstrip('/') + '/', path.rstrip('/') + '0') for path in install_paths
+    ])
+
+
+def _check_paths(pool, paths):
+    """Which of the given paths exist, checked concurrently (since it is slow on NFS)."""
+    paths = sorted(set(x for x in paths if x))
+    return set(path for path, exists in zip(paths, pool.map(os.path.exists, paths)) if exists)
+
+
+def _remove_tree(path):
+    # Environments may be links to another's tree; see EnvironmentRepo.upgrade.
+    if os.path.islink(path):
+        os.unlink(path)
+    else:
+        shutil.rmtree(path)
+
+
+def _remove_trees(pool, paths_by_id):
+    """Remove directories concurrently, returning the IDs which were fully removed."""
+
+    futures = {}
+    for id_, paths in paths_by_id.items():
+        for path in paths:
+            futures[pool.submit(_remove_tree, path)] = (id_, path)
+
+    failed = set()
+    for future in concurrent.futures.as_completed(futures):
+        id_, path = futures[future]
+        try:
+            future.result()
+        except OSError as e:
+            log.warning('could not remove %s: %s' % (path, e))
+            failed.add(id_)
+
+    return [id_ for id_ in paths_by_id if id_ not in failed]
 
 
 @command(
@@ -26,6 +65,7 @@ def delete_package(con, id_):
     argument('-e', '--prune-environments', action='store_true'),
     argument('-p', '--prune-packages', action='store_true'),
 
+    argument('-j', '--jobs', type=int, default=8, help='number of paths to check or remove at once'),
     argument('-n', '--dry-run', action='store_true'),
 
     group='plumbing',
@@ -37,93 +77,139 @@ def gc(args):
     home = args.assert_home()
     con = home.db.connect()
 
-    with con:
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, args.jobs)) as pool:
+        _gc_environments(args, home, con, pool)
+        _gc_packages(args, home, con, pool)
 
-        repo_ids = {}
-        for row in con.execute('SELECT id, name from repositories'):
-            repo_ids[row['name']] = row['id']
 
-        envs_by_id = {}
+def _gc_environments(args, home, con, pool):
 
-        log.info(style_note('Cleaning environments'))
-        for row in con.execute('SELECT id, name, path, repository_id from environments ORDER BY created_at ASC'):
-            
-            id_, name, path, repo_id = row
-            
-            if not os.path.exists(path):
-                log.info('environment does not exist at %s; deleting' % (path))
-                if not args.dry_run:
-                    delete_environment(con, id_)
-                continue
+    repo_ids = dict((row['name'], row['id']) for row in con.execute('SELECT id, name from repositories'))
+    rows = con.execute('SELECT id, name, path, repository_id from environments ORDER BY created_at ASC, id ASC').fetchall()
 
-            # Track for later.
-            envs_by_id.setdefault(repo_id, []).append((id_, name, path))
+    log.info(style_note('Cleaning environments'))
+    existing = _check_paths(pool, (row['path'] for row in rows))
 
-            # The rest is making sure the repo_id and commit are correct.
-            if repo_id:
-                continue
+    missing = []
+    fixes = []
+    envs_by_id = {}
 
-            m = re.match(r'(\w+)/commits/([0-9a-f]{7,8}(?:-dirty)?)$', name)
-            if not m:
-                log.warning('%s (%d) does not appear to be managed by git; skipping' % (name, id_))
-                continue
+    for id_, name, path, repo_id in rows:
 
-            repo_name, commit_name = m.groups()
-            repo_id = repo_ids.get(repo_name)
-            if not repo_id:
-                log.warning('repo %s does not exist for %s (%d); skipping' % (repo_name, name, id_))
-                continue
+        if path not in existing:
+            log.info('environment does not exist at %s; deleting' % (path))
+            missing.append(id_)
+            continue
 
-            log.info('Fixing repo relationship for %s (%d)' % (name, id_))
-            if not args.dry_run:
-                con.execute('UPDATE environments SET repository_id = ?, repository_commit = ? WHERE id = ?', [
-                    repo_id, commit_name, id_
-                ])
-
-        if args.prune_environments:
-            log.info(style_note('Pruning old environments'))
-            for repo_id, envs in sorted(envs_by_id.items()):
-                for id_, name, path in envs[:-args.keep_latest]:
-                    log.info('Deleting %s (%d)' % (name, id_))
-                    if not args.dry_run:
-                        shutil.rmtree(path)
-                        delete_environment(con, id_)
-
-        log.info(style_note('Cleaning installed packages'))
-        package_ids = []
-        install_paths_to_id = {}
-        for row in con.execute('SELECT id, name, install_path, build_path from packages ORDER by created_at DESC'):
-
-            id_, name, install_path, build_path = row
-            log.debug('%s %s %s' % (id_, name, install_path))
-
-            if not os.path.exists(install_path):
-                log.info('%s no longer exists at %s; deleting' % (name, install_path))
-                if not args.dry_run:
-                    delete_package(con, id_)
-                    continue
-
-            real_id = install_paths_to_id.get(install_path)
-            if real_id:
-                log.info('%s %d is a duplicate of %s; deleting' % (name, id_, real_id))
-                # TODO: update any links or package_dependencies which to point to this.
-                if not args.dry_run:
-                    delete_package(con, id_)
-                continue
-            install_paths_to_id[install_path] = id_
+        # Track for later.
+        envs_by_id.setdefault(repo_id, []).append((id_, name, path))
+
+        # The rest is making sure the repo_id and commit are correct.
+        if repo_id:
+            continue
+
+        m = re.match(r'(\w+)/commits/([0-9a-f]{7,8}(?:-dirty)?)$', name)
+        if not m:
+            log.warning('%s (%d) does not appear to be managed by git; skipping' % (name, id_))
+            continue
 
-            if args.prune_packages:
-                row = con.execute('SELECT count(1) FROM links WHERE package_id = ?', [id_]).fetchone()
-                if not row[0]:
-                    log.info('%s (%d) is not linked; deleting' % (name, id_))
-                    if not args.dry_run:
-                        if build_path and os.path.exists(build_path):
-                            shutil.rmtree(build_path)
-                        shutil.rmtree(install_path)
-                        delete_package(con, id_)
+        repo_name, commit_name = m.groups()
+        repo_id = repo_ids.get(repo_name)
+        if not repo_id:
+            log.warning('repo %s does not exist for %s (%d); skipping' % (repo_name, name, id_))
+            continue
 
+        log.info('Fixing repo relationship for %s (%d)' % (name, id_))
+        fixes.append((repo_id, commit_name, id_))
 
+    if not args.dry_run:
+        with home.db.write_lock, con:
+            delete_environments(con, missing)
+            con.executemany('UPDATE environments SET repository_id = ?, repository_commit = ? WHERE id = ?', fixes)
 
+    if args.prune_environments:
+        log.info(style_note('Pruning old environments'))
 
+        candidates = []
+        kept = []
+        for repo_id, envs in sorted(envs_by_id.items(), key=lambda x: x[0] or 0):
+            candidates.extend(envs[:-args.keep_latest])
+            kept.extend(path for _, _, path in envs[-args.keep_latest:])
 
+        # Identical environments share one tree (by linking to it), which
+        # must stay as long as anything kept is linked to it.
+        shared = set(pool.map(os.path.realpath, kept))
+
+        old = {}
+        for id_, name, path in candidates:
+            if not os.path.islink(path) and os.path.realpath(path) in shared:
+                log.info('Keeping %s (%d); it is shared by a newer environment' % (name, id_))
+                continue
+            log.info('Deleting %s (%d)' % (name, id_))
+            old[id_] = [path]
+        if not args.dry_run:
+            removed = _remove_trees(pool, old)
+            with home.db.write_lock, con:
+                delete_environments(con, removed)
+
+
+def _gc_packages(args, home, con, pool):
+
+    log.info(style_note('Cleaning installed packages'))
+
+    rows = con.execute('''
+        SELECT id, name, install_path, build_path FROM packages
+        WHERE install_path IS NOT NULL
+        ORDER BY created_at DESC, id DESC
+    ''').fetchall()
+    existing = _check_paths(pool, (row['install_path'] for row in rows))
+
+    # Everything linked into a (remaining) environment, and everything
+    # those depend upon.
+    in_use = set(package_id for _, package_id in home.db.get_environment_packages())
+
+    missing = []
+    missing_paths = []
+    duplicates = []
+    unused = {}
+    install_paths_to_id = {}
+
+    for id_, name, install_path, build_path in rows:
+
+        log.debug('%s %s %s' % (id_, name, install_path))
+
+        if install_path not in existing:
+            log.info('%s no longer exists at %s; deleting' % (name, install_path))
+            missing.append(id_)
+            missing_paths.append(install_path)
+            continue
+
+        real_id = install_paths_to_id.get(install_path)
+        if real_id:
+            log.info('%s %d is a duplicate of %s; deleting' % (name, id_, real_id))
+            # TODO: update any links or package_dependencies which to point to this.
+            duplicates.append(id_)
+            continue
+        install_paths_to_id[install_path] = id_
+
+        if args.prune_packages and id_ not in in_use:
+            log.info('%s (%d) is not in use; deleting' % (name, id_))
+            unused[id_] = [install_path] + ([build_path] if build_path else [])
+
+    if args.dry_run:
+        return
+
+    with home.db.write_lock, con:
+        delete_packages(con, missing + duplicates)
+        delete_shebangs(con, missing_paths)
+
+    if unused:
+        # Build paths may be long gone.
+        existing = _check_paths(pool, (path for paths in unused.values() for path in paths[1:]))
+        for paths in unused.values():
+            paths[1:] = [path for path in paths[1:] if path in existing]
+        removed = _remove_trees(pool, unused)
+        with home.db.write_lock, con:
+            delete_packages(con, removed)
+            delete_shebangs(con, [unused[id_][0] for id_ in removed])
 
@@ -5,7 +5,7 @@ from vee import log
 from vee.cli import style, style_note
 from vee.commands.main import command, argument
 from vee.environment import Environment
-from vee.exceptions import AlreadyInstalled, AlreadyLinked, print_cli_exc
+from vee.linkplan import CONFLICT_POLICIES, LinkPlan
 from vee.manifest import Manifest
 from vee.package import Package
 from vee.packageset import PackageSet
@@ -15,8 +15,10 @@ from vee.packageset import PackageSet
     argument('--reinstall', action='store_true'),
     argument('--no-install', action='store_true'),
     argument('--force', action='store_true'),
+    argument('-j', '--jobs', type=int, default=1, help='number of packages to install at once'),
 
     argument('--raw', action='store_true', help='arguments are raw directories'),
+    argument('--conflicts', choices=CONFLICT_POLICIES, default='first', help='when packages link the same path: keep the first, replace with the last, or error'),
 
     argument('-r', '--repo'),
     argument('-e', '--environment'),
@@ -64,9 +66,11 @@ def link(args):
 
 
     if args.raw:
+        plan = LinkPlan(env, args.conflicts)
         for dir_ in args.requirements:
             log.info(style_note('Linking', dir_))
-            env.link_directory(dir_)
+            plan.add(dir_)
+        plan.apply()
         return
 
     manifest = Manifest(args.requirements, home=home)
@@ -76,29 +80,21 @@ def link(args):
     # of weakly resolved from installed packages.
     pkg_set.resolve_set(manifest)
 
+    names = []
     for req in manifest.iter_packages():
 
         # Skip if it wasn't requested.
         if args.subset and req.name not in args.subset:
             continue
 
-        log.info(style('==> %s' % req.name, 'blue'))
-
         pkg = pkg_set.resolve(req, check_existing=not args.reinstall)
 
         if args.no_install and not pkg.installed:
             raise CliError('not installed: %s' % req)
 
-        try:
-            with log.indent():
-                pkg_set.install(pkg.name, link_env=env, reinstall=args.reinstall, relink=args.force)
-        except AlreadyInstalled:
-            pass
-        except AlreadyLinked as e:
-            log.info(style('Already linked ', 'blue') + str(req), verbosity=1)
-        except Exception as e:
-            print_cli_exc(e, verbose=True)
-            log.exception('Failed to link %s' % req)
-            continue
-        
+        names.append(pkg.name)
+
+    # Errors are reported (and the rest carried on with) per package.
+    if names:
+        pkg_set.install(names, link_env=env, reinstall=args.reinstall, relink=args.force, jobs=args.jobs, conflicts=args.conflicts)
 
@@ -6,10 +6,10 @@ from vee.commands.main import command, argument, group
 from vee.environment import Environment
 from vee.cli import style, style_note
 from vee import log
-from vee.package import Package
+from vee.packagerecord import PackageRecord
 
 
-def describe(pkg, cache, depth=0):
+def describe(pkg, cache, depth=0, children=None):
 
     print(('    ' * depth) + style(pkg.name, 'blue'), pkg.id, style(
         '***' if pkg.id in cache else str(pkg), faint=True))
@@ -18,13 +18,14 @@ def describe(pkg, cache, depth=0):
         return
     cache[pkg.id] = pkg
 
-    for dep in pkg.dependencies:
-        dep.resolve_existing()
-        describe(dep, cache, depth + 1)
+    for dep in (children(pkg) if children else pkg.dependencies):
+        describe(dep, cache, depth + 1, children)
 
 
 @command(
     argument('-e', '--environments', action='store_true'),
+    argument('-r', '--dependents', action='store_true', help='list what depends on the packages, instead of what they depend on'),
+    argument('packages', nargs='*', help='names or URLs; defaults to everything'),
     name='list',
 )
 def list_(args):
@@ -34,7 +35,7 @@ def list_(args):
         list_environments(args)
         return
     else:
-        list_packages(args)
+        return list_packages(args)
 
 
 
@@ -54,18 +55,38 @@ def list_environments(args):
 def list_packages(args):
 
     home = args.assert_home()
-    con = home.db.connect()
 
     cache = {}
 
-    for row in con.execute('SELECT * from packages ORDER by created_at DESC'):
-
-        if row['id'] in cache:
-            continue
+    if not args.packages:
+        for pkg in PackageRecord.load_all(home):
+            if pkg.id not in cache:
+                describe(pkg, cache)
+        return
 
-        pkg = Package(url='junk', home=home)
-        pkg.restore_from_row(row)
-        pkg._load_dependencies()
+    roots = []
+    for desc in args.packages:
+        pkg = PackageRecord.find(home, name=desc) or PackageRecord.find(home, url=desc)
+        if pkg:
+            roots.append(pkg)
+        else:
+            log.error('cannot find package %s' % desc)
+    if not roots:
+        return 1
+
+    if args.dependents:
+        edges = home.db.get_dependents([pkg.id for pkg in roots])
+        ids = set(id_ for edge in edges for id_ in edge)
+        by_id = dict((pkg.id, pkg) for pkg in PackageRecord.load(home, ids))
+        by_id.update((pkg.id, pkg) for pkg in roots)
+        dependents = {}
+        for depender_id, dependee_id in edges:
+            dependents.setdefault(dependee_id, []).append(by_id[depender_id])
+        for pkg in roots:
+            describe(pkg, cache, children=lambda pkg: dependents.get(pkg.id, ()))
 
-        describe(pkg, cache)
+    else:
+        by_id = dict((pkg.id, pkg) for pkg in PackageRecord.load_closure(home, [pkg.id for pkg in roots]))
+        for pkg in roots:
+            describe(by_id[pkg.id], cache)
 
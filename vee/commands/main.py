@@ -10,11 +10,11 @@ import errno
 import functools
 import logging
 import os
-import pkg_resources
 import sys
 import traceback
 
 from vee import log
+from vee import registry
 from vee.cli import style
 from vee.exceptions import cli_exc_str, cli_errno, print_cli_exc
 from vee.home import Home
@@ -107,7 +107,7 @@ def get_parser():
         help="path of managed environments; defaults to $VEE or the directory above VEE's source"
     )
 
-    funcs = [ep.load() for ep in pkg_resources.iter_entry_points('vee_commands')]
+    funcs = [ep.load() for ep in registry.get_entry_points('vee_commands')]
     populate_subparser(parser, funcs)
 
     return parser
@@ -6,14 +6,14 @@ import os
 import sys
 import tarfile
 import tempfile
-import stat
 
 from vee.commands.main import command, argument, group
 from vee.environment import Environment
 from vee.cli import style, style_note
+from vee.filemanifest import FileManifest
 from vee import log
-from vee.package import Package
-from vee.utils import makedirs, guess_name, HashingWriter
+from vee.packagerecord import PackageRecord
+from vee.utils import makedirs, guess_name, HashingWriter, archive_tree
 
 
 PLATFORM_DEPENDENT_EXTS = set(('.so', '.exe', '.dylib', '.a'))
@@ -36,25 +36,29 @@ def repackage(args):
 
     makedirs(args.dir)
 
-    todo = args.packages
+    todo = []
+    for desc in args.packages:
+        pkg = (
+            PackageRecord.find(home, name=desc) or
+            PackageRecord.find(home, name=guess_name(desc), url=desc)
+        )
+        if not pkg:
+            log.error('cannot find package %s' % desc)
+            continue
+        todo.append(pkg)
+
+    # Load all of their dependencies at once.
+    if todo and not args.no_deps:
+        by_id = dict((pkg.id, pkg) for pkg in PackageRecord.load_closure(home, [pkg.id for pkg in todo]))
+        todo = [by_id[pkg.id] for pkg in todo]
+
     seen = set()
     in_order = []
     checksums = {}
 
     while todo:
 
-        desc = todo.pop(0)
-
-        if isinstance(desc, Package):
-            pkg = desc
-            pkg.id or pkg.resolve_existing()
-        else:
-            pkg = Package(name=desc, url='weak', home=home)
-            if not pkg.resolve_existing(weak=True):
-                pkg = Package(url=desc, home=home)
-                if not pkg.resolve_existing():
-                    log.error('cannot find package %s' % desc)
-                    continue
+        pkg = todo.pop(0)
 
         if pkg.name in seen:
             continue
@@ -65,8 +69,10 @@ def repackage(args):
         if not args.no_deps:
             todo.extend(pkg.dependencies)
 
+        manifest = FileManifest.load(pkg.install_path)
+
         platform_dependent = False
-        for dir_path, dir_names, file_names in os.walk(pkg.install_path):
+        for dir_path, dir_names, file_names in (manifest.walk() if manifest else os.walk(pkg.install_path)):
             for file_name in file_names:
                 _, ext = os.path.splitext(file_name)
                 if ext in PLATFORM_DEPENDENT_EXTS:
@@ -94,29 +100,11 @@ def repackage(args):
         writer = HashingWriter(open(path, 'wb'), hashlib.md5())
         archive = tarfile.open(fileobj=writer, mode='w|gz')
 
-        for dir_path, dir_names, file_names in os.walk(pkg.install_path):
-        
-            for dir_name in dir_names:
-                path = os.path.join(dir_path, dir_name)
-                rel_path = os.path.relpath(path, pkg.install_path)
-                if args.verbose:
-                    print('    ' + rel_path + '/')
-                archive.add(path, rel_path, recursive=False)
-            
-            for file_name in file_names:
-                path = os.path.join(dir_path, file_name)
-                mode = os.lstat(path).st_mode
-                if not (stat.S_ISREG(mode) or stat.S_ISDIR(mode) or stat.S_ISLNK(mode)):
-                    continue
-                rel_path = os.path.relpath(path, pkg.install_path)
-                if args.verbose:
-                    print('    ' + rel_path)
-                archive.add(path, rel_path)
+        archive_tree(archive, pkg.install_path, verbose=args.verbose, manifest=manifest)
 
         if pkg.dependencies:
             requirements = []
             for dep in pkg.dependencies:
-                dep.resolve_existing()
                 requirements.append(str(dep))
             buf = StringIO('\n'.join(requirements))
             info = tarfile.TarInfo('vee-manifest.txt')
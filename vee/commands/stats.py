@@ -0,0 +1,121 @@
+from __future__ import print_function
+
+from vee.cli import style, style_note
+from vee.commands.main import command, argument
+
+
+def format_duration(seconds):
+    if seconds >= 3600:
+        return '%dh%02dm' % divmod(int(seconds) // 60, 60)
+    if seconds >= 60:
+        return '%dm%02ds' % divmod(int(seconds), 60)
+    return '%.1fs' % seconds
+
+
+def format_bytes(count):
+    for unit in ('B', 'kB', 'MB', 'GB'):
+        if count < 1024:
+            break
+        count /= 1024.0
+    return ('%d%s' if unit == 'B' else '%.1f%s') % (count, unit)
+
+
+@command(
+    argument('-n', '--limit', type=int, default=10, help='how many of each to show'),
+    argument('--since', help='only consider timings since this date (e.g. 2020-01-31)'),
+    argument('-s', '--step', action='append', dest='steps', help='only consider these pipeline steps'),
+    argument('packages', nargs='*', help='only consider these packages'),
+    help='report where installs spend their time',
+    group='plumbing',
+)
+def stats(args):
+    """Report the slowest packages, and pipeline steps, of previous installs.
+
+    Every pipeline step records its wall time, the CPU time of the processes
+    it ran, and the bytes they wrote. A package's time in one run is the sum
+    of its steps; "last" is its most recent run, so that a package which has
+    recently become slower stands out against its mean.
+
+    """
+
+    home = args.assert_home()
+    con = home.db.connect()
+
+    clauses = []
+    params = []
+    if args.since:
+        clauses.append('created_at >= ?')
+        params.append(args.since)
+    if args.steps:
+        clauses.append('step IN (%s)' % ','.join('?' for _ in args.steps))
+        params.extend(args.steps)
+    if args.packages:
+        clauses.append('name IN (%s)' % ','.join('?' for _ in args.packages))
+        params.extend(args.packages)
+    where = ('WHERE ' + ' AND '.join(clauses)) if clauses else ''
+
+    # Packages; their runs are in chronological order.
+    packages = {}
+    for row in con.execute('''
+        SELECT name, sum(wall_time), sum(cpu_time), sum(bytes_written), sum(failed)
+        FROM pipeline_timings %s
+        GROUP BY name, run
+        ORDER BY max(created_at) ASC
+    ''' % where, params):
+        packages.setdefault(row[0], []).append(tuple(row)[1:])
+
+    if not packages:
+        print('No timings recorded.')
+        return
+
+    summaries = []
+    for name, runs in packages.items():
+        mean = sum(r[0] for r in runs) / len(runs)
+        summaries.append((mean, name, runs))
+    summaries.sort(reverse=True)
+
+    print(style_note('Slowest packages'))
+    print('  %-32s %5s %9s %9s %9s %9s' % ('name', 'runs', 'mean', 'last', 'cpu', 'written'))
+    for mean, name, runs in summaries[:args.limit]:
+        wall, cpu, written, failed = runs[-1]
+        print('  %-32s %5d %9s %9s %9s %9s%s' % (
+            name,
+            len(runs),
+            format_duration(mean),
+            format_duration(wall),
+            format_duration(cpu),
+            format_bytes(written),
+            style(' (failed)', 'red') if failed else '',
+        ))
+
+    print()
+    print(style_note('Slowest steps'))
+    print('  %-32s %-12s %-10s %5s %9s %9s %9s' % ('name', 'step', 'type', 'runs', 'mean', 'max', 'cpu'))
+    for row in con.execute('''
+        SELECT name, step, step_type, count(1), avg(wall_time), max(wall_time), avg(cpu_time)
+        FROM pipeline_timings %s
+        GROUP BY name, step
+        ORDER BY avg(wall_time) DESC
+        LIMIT ?
+    ''' % where, params + [args.limit]):
+        name, step, step_type, count, mean, max_, cpu = row
+        print('  %-32s %-12s %-10s %5d %9s %9s %9s' % (
+            name,
+            step,
+            step_type or '',
+            count,
+            format_duration(mean),
+            format_duration(max_),
+            format_duration(cpu),
+        ))
+
+    print()
+    print(style_note('Time by step'))
+    for row in con.execute('''
+        SELECT step, sum(wall_time), sum(cpu_time), sum(bytes_written)
+        FROM pipeline_timings %s
+        GROUP BY step
+        ORDER BY sum(wall_time) DESC
+    ''' % where, params):
+        step, wall, cpu, written = row
+        print('  %-12s %9s %9s %9s' % (step, format_duration(wall), format_duration(cpu), format_bytes(written)))
@@ -1,4 +1,5 @@
 from vee.commands.main import command, argument, group
+from vee.linkplan import CONFLICT_POLICIES
 
 
 @command(
@@ -7,8 +8,13 @@ from vee.commands.main import command, argument, group
     argument('--dirty', action='store_true', help='build even when work tree is dirty'),
     argument('--relink', action='store_true', help='relink packages'),
     argument('--reinstall', action='store_true', help='reinstall packages'),
+    argument('--check', action='store_true', help='check every package, even if nothing has changed since the last upgrade'),
+    argument('--full', action='store_true', help='build the environment from scratch instead of deriving it from the previous one'),
     argument('--no-deps', action='store_true', help='dont touch dependencies'),
     argument('-f', '--force-branch-link', action='store_true'),
+    argument('--conflicts', choices=CONFLICT_POLICIES, default='first', help='when packages link the same path: keep the first, replace with the last, or error'),
+    argument('-j', '--jobs', type=int, default=1, help='number of packages to install at once'),
+    argument('--fetch-jobs', type=int, default=8, help='number of packages to fetch at once before installing; 0 fetches each as it is installed'),
     argument('-r', '--repo', action='append', dest='repos'),
     argument('subset', nargs='*'),
     help='upgrade packages specified by repositories, and link into environments',
@@ -40,10 +46,15 @@ def upgrade(args):
         success = repo.upgrade(
             dirty=args.dirty,
             force_branch_link=args.force_branch_link,
+            jobs=args.jobs,
+            fetch_jobs=args.fetch_jobs,
+            incremental=not args.full,
+            check=args.check,
             no_deps=args.no_deps,
             reinstall=args.reinstall,
             relink=args.relink,
             subset=args.subset,
+            conflicts=args.conflicts,
         ) and success
 
     return int(not success)
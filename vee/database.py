@@ -1,8 +1,9 @@
+import collections
 import datetime
 import os
 import sqlite3
-import shutil
 import re
+import threading
 
 import six
 
@@ -10,6 +11,17 @@ from vee.utils import makedirs
 from vee import log
 
 
+def chunks(values, size=500):
+    """Split values for ``IN (...)`` lists into chunks SQLite will accept.
+
+    SQLite limits the number of parameters to a query (to 999 by default).
+
+    """
+    values = list(values)
+    for i in range(0, len(values), size):
+        yield values[i:i + size]
+
+
 _migrations = []
 
 
@@ -190,6 +202,157 @@ def _drop_dev_packages(con):
     if 'development_packages' in con.tables():
         con.execute('''DROP TABLE development_packages''')
 
+@_migrations.append
+def _create_pipeline_timings(con):
+    con.execute('''CREATE TABLE pipeline_timings (
+
+        id INTEGER PRIMARY KEY,
+        created_at TIMESTAMP NOT NULL DEFAULT (datetime('now')),
+
+        -- Which invocation of VEE this was a part of.
+        run TEXT NOT NULL,
+
+        name TEXT NOT NULL,
+        url TEXT,
+        step TEXT NOT NULL,
+        step_type TEXT,
+
+        wall_time REAL NOT NULL,
+        cpu_time REAL NOT NULL, -- Of child processes.
+        bytes_written INTEGER NOT NULL,
+        failed INTEGER NOT NULL DEFAULT 0
+
+    )''')
+
+
+@_migrations.append
+def _create_pipeline_checkpoints(con):
+    con.execute('''CREATE TABLE pipeline_checkpoints (
+
+        id INTEGER PRIMARY KEY,
+        created_at TIMESTAMP NOT NULL DEFAULT (datetime('now')),
+        updated_at TIMESTAMP NOT NULL DEFAULT (datetime('now')),
+
+        -- Hash of the requirement (as it was before extraction).
+        key TEXT UNIQUE NOT NULL,
+
+        name TEXT NOT NULL,
+        url TEXT,
+
+        steps TEXT NOT NULL, -- Comma separated.
+        state TEXT NOT NULL -- JSON of package attributes.
+
+    )''')
+
+
+@_migrations.append
+def _add_environment_manifest(con):
+    # JSON of the requirements which were linked into the environment, so
+    # that the next may be derived from it.
+    con.execute('''ALTER TABLE environments ADD COLUMN manifest TEXT''')
+
+
+@_migrations.append
+def _add_environment_fingerprint(con):
+    # Identifies the manifest (and platform) the environment was built from,
+    # so that upgrades which would change nothing can skip the work.
+    con.execute('''ALTER TABLE environments ADD COLUMN fingerprint TEXT''')
+
+
+@_migrations.append
+def _create_lookup_indexes(con):
+
+    # Package.resolve_existing always has a name, and usually an install_name
+    # and url (the url is dropped for weak lookups).
+    con.execute('''CREATE INDEX packages_by_name ON packages (name, install_name, url)''')
+
+    # Links and dependencies are looked up from both ends.
+    con.execute('''CREATE INDEX links_by_package ON links (package_id, environment_id)''')
+    con.execute('''CREATE INDEX links_by_environment ON links (environment_id, package_id)''')
+    con.execute('''CREATE INDEX package_dependencies_by_depender ON package_dependencies (depender_id, dependee_id)''')
+    con.execute('''CREATE INDEX package_dependencies_by_dependee ON package_dependencies (dependee_id)''')
+
+    # Relocation finds libraries by name (newest first), and rescans by package.
+    con.execute('''CREATE INDEX shared_libraries_by_name ON shared_libraries (name, created_at, path)''')
+    con.execute('''CREATE INDEX shared_libraries_by_package ON shared_libraries (package_id)''')
+
+    con.execute('''CREATE INDEX environments_by_path ON environments (path)''')
+    con.execute('''CREATE INDEX environments_by_repository ON environments (repository_id)''')
+
+
+@_migrations.append
+def _cascade_deletes(con):
+
+    # Everything hanging off of packages and environments goes with them, so
+    # that `vee gc` can delete in sets. SQLite can only add this to a table
+    # by rebuilding it, which would fail on any rows that are already orphaned.
+    con.execute('DELETE FROM links WHERE environment_id NOT IN (SELECT id FROM environments) OR package_id NOT IN (SELECT id FROM packages)')
+    con.execute('DELETE FROM shared_libraries WHERE package_id NOT IN (SELECT id FROM packages)')
+    con.execute('DELETE FROM package_dependencies WHERE depender_id NOT IN (SELECT id FROM packages) OR dependee_id NOT IN (SELECT id FROM packages)')
+
+    for table_name in ('links', 'shared_libraries', 'package_dependencies'):
+        schema = re.sub(r'(REFERENCES (?:packages|environments)\(id\))', r'\1 ON DELETE CASCADE', con.schema(table_name))
+        con.rebuild_table(table_name, schema)
+
+
+
+@_migrations.append
+def _create_package_provisions(con):
+
+    # Provisions as rows, so that existing packages may be matched against
+    # them in SQL (rather than parsing every candidate in Python).
+    con.execute('''CREATE TABLE package_provisions (
+
+        id INTEGER PRIMARY KEY,
+
+        package_id INTEGER REFERENCES packages(id) ON DELETE CASCADE NOT NULL,
+        name TEXT NOT NULL,
+        value TEXT -- Normalized via Version; NULL when only presence is provided.
+
+    )''')
+    con.execute('''CREATE INDEX package_provisions_by_package ON package_provisions (package_id, name, value)''')
+
+    from vee.provision import Provision
+
+    rows = []
+    for id_, raw in con.execute("SELECT id, provides FROM packages WHERE provides IS NOT NULL AND provides != ''").fetchall():
+        try:
+            provides = Provision(raw)
+        except ValueError as e:
+            log.warning('Could not parse provisions of package %d: %s' % (id_, e))
+            continue
+        rows.extend((id_, name, None if value is None else str(value)) for name, value in provides.items())
+    con.executemany('INSERT INTO package_provisions (package_id, name, value) VALUES (?, ?, ?)', rows)
+
+
+@_migrations.append
+def _add_environment_content_hash(con):
+    # Identifies the packages linked into the environment (and platform), so
+    # that identical environments may share one tree.
+    con.execute('''ALTER TABLE environments ADD COLUMN content_hash TEXT''')
+    con.execute('''CREATE INDEX environments_by_content_hash ON environments (content_hash)''')
+
+
+@_migrations.append
+def _create_shebangs(con):
+
+    # What the shebangs of installed executables are; see vee.shebang.
+    con.execute('''CREATE TABLE shebangs (
+
+        path TEXT PRIMARY KEY,
+
+        -- The stat of the file when it was read.
+        dev INTEGER NOT NULL,
+        ino INTEGER NOT NULL,
+        mtime INTEGER NOT NULL,
+        size INTEGER NOT NULL,
+
+        -- All NULL if it has no shebang.
+        interpreter BLOB,
+        rest BLOB,
+        offset INTEGER
+
+    )''')
 
 
 class _Row(sqlite3.Row):
@@ -284,12 +447,34 @@ class _Connection(sqlite3.Connection):
         if new_schema == old_schema:
             raise ValueError('no change in schema: %s' % new_schema)
 
+        self.rebuild_table(table_name, new_schema, new_columns)
+
+    def rebuild_table(self, table_name, new_schema, columns=None):
+        """Recreate a table with a new schema (for what ALTER TABLE can't do).
+
+        Indexes and triggers are recreated, other than those which refer to
+        columns which are no longer there.
+
+        """
+
+        columns = columns or self.columns(table_name)
+
+        # Indexes and triggers go with the old table, so we need to recreate them.
+        extras = [row['sql'] for row in self.execute(
+            "SELECT sql FROM sqlite_master WHERE type IN ('index', 'trigger') AND tbl_name = ? AND sql IS NOT NULL",
+            [table_name],
+        )]
+        dropped = set(self.columns(table_name)).difference(columns)
+        extras = [x for x in extras if not any(re.search(r'\b%s\b' % c, x.split('(', 1)[1]) for c in dropped)]
+
         self.execute('ALTER TABLE %s RENAME TO old_%s' % (table_name, table_name))
         self.execute(new_schema)
         self.execute('INSERT INTO %s (%s) SELECT %s FROM old_%s' % (
-            table_name, ','.join(new_columns), ','.join(new_columns), table_name
+            table_name, ','.join(columns), ','.join(columns), table_name
         ))
         self.execute('DROP TABLE old_%s' % table_name)
+        for sql in extras:
+            self.execute(sql)
 
 
 
@@ -335,12 +520,29 @@ class Database(object):
 
     def __init__(self, path):
         self.path = path
+
+        # SQLite fails immediately (rather than waiting) when a transaction
+        # which has read tries to write while another connection is writing,
+        # so threads which write more than trivially should hold this.
+        self.write_lock = threading.RLock()
+
+        # One connection per thread (and process).
+        self._local = threading.local()
+
         if self.exists:
             self._migrate()
 
     def _migrate(self, con=None):
-        did_backup = False
+
         con = con or self.connect()
+
+        # The number of migrations applied is kept in the header of the
+        # database, so that the usual case is one read (without a transaction).
+        version = con.execute('PRAGMA user_version').fetchone()[0]
+        if version >= len(_migrations):
+            return
+
+        did_backup = False
         with con:
 
             # We try to select without creating the table, so that we don't
@@ -372,11 +574,19 @@ class Database(object):
                     f(con)
                     con.execute('INSERT INTO migrations (name) VALUES (?)', [name])
 
+        with con:
+            con.execute('PRAGMA user_version = %d' % len(_migrations))
+
     def _backup(self):
         backup_dir = os.path.join(os.path.dirname(self.path), 'backups')
         backup_path = os.path.join(backup_dir, os.path.basename(self.path) + '.' + datetime.datetime.utcnow().isoformat('T'))
         makedirs(backup_dir)
-        shutil.copyfile(self.path, backup_path)
+        # Not a file copy, since (in WAL mode) the database is more than the one file.
+        dst = sqlite3.connect(backup_path)
+        try:
+            self.connect().backup(dst)
+        finally:
+            dst.close()
 
     @property
     def exists(self):
@@ -389,10 +599,46 @@ class Database(object):
         self._migrate(con)
 
     def connect(self, create=False):
+        """Get this thread's connection to the database.
+
+        Connections are reused, so transactions (via ``with con:``) nest
+        within a thread rather than contending with each other.
+
+        """
+
+        pid = os.getpid()
+        con = getattr(self._local, 'con', None)
+        if con is not None and self._local.pid == pid:
+            return con
+
         if not create and not self.exists:
             raise ValueError('database does not exist; run `vee init`')
-        con = sqlite3.connect(self.path, factory=_Connection)
+
+        timeout = float(os.environ.get('VEE_DB_TIMEOUT') or 60)
+        con = sqlite3.connect(self.path, factory=_Connection, timeout=timeout)
         con.execute('PRAGMA foreign_keys = ON')
+
+        # WAL lets others read while one writes, but it needs shared memory
+        # between the processes, and so may corrupt homes on NFS; it is only
+        # used when asked for. Otherwise the database keeps whatever mode it
+        # has (which is stored in the file).
+        journal_mode = (os.environ.get('VEE_DB_JOURNAL_MODE') or '').upper()
+        try:
+            if journal_mode:
+                journal_mode = con.execute('PRAGMA journal_mode = %s' % journal_mode).fetchone()[0].upper()
+            else:
+                journal_mode = con.execute('PRAGMA journal_mode').fetchone()[0].upper()
+        except sqlite3.OperationalError as e:
+            # Someone else has it locked; we'll get it next time.
+            log.debug('Could not set journal_mode: %s' % e)
+        if journal_mode == 'WAL':
+            # Durable at checkpoints, rather than every commit.
+            con.execute('PRAGMA synchronous = NORMAL')
+            con.execute('PRAGMA mmap_size = %d' % (64 * 1024 * 1024))
+        con.execute('PRAGMA cache_size = -%d' % (16 * 1024)) # In KiB.
+
+        self._local.con = con
+        self._local.pid = pid
         return con
 
     def cursor(self):
@@ -407,7 +653,182 @@ class Database(object):
     def update(self, *args, **kwargs):
         return self.cursor().update(*args, **kwargs)
 
+    # The dependency graph; each is a single (recursive) query.
+
+    def get_dependencies(self, package_ids=None, transitive=True):
+        """Get ``(depender_id, dependee_id)`` dependency edges.
+
+        :param package_ids: Where to start; ``None`` for every package.
+        :param bool transitive: Follow dependencies of dependencies.
+
+        """
+        return self._walk_graph('depender_id', 'dependee_id', package_ids, transitive)
+
+    def get_dependents(self, package_ids, transitive=True):
+        """Get ``(depender_id, dependee_id)`` edges of those who depend on the given packages."""
+        return self._walk_graph('dependee_id', 'depender_id', package_ids, transitive)
+
+    def _walk_graph(self, from_col, to_col, package_ids, transitive):
+
+        # Edges are always in the order they were recorded.
+        if package_ids is None:
+            return [tuple(row) for row in self.execute('SELECT depender_id, dependee_id FROM package_dependencies ORDER BY id')]
+
+        # Walked from each chunk of the given packages in turn, which may find
+        # the same edges more than once.
+        edges = {}
+        for chunk in chunks(package_ids):
+            seed = 'SELECT id, depender_id, dependee_id FROM package_dependencies WHERE %s IN (%s)' % (
+                from_col, ','.join('?' * len(chunk)))
+            if transitive:
+                # UNION (rather than UNION ALL) stops at cycles.
+                query = '''
+                    WITH RECURSIVE edges(id, depender_id, dependee_id) AS (
+                        %s
+                        UNION
+                        SELECT d.id, d.depender_id, d.dependee_id
+                        FROM package_dependencies AS d JOIN edges ON d.%s = edges.%s
+                    )
+                    SELECT id, depender_id, dependee_id FROM edges
+                ''' % (seed, from_col, to_col)
+            else:
+                query = seed
+            for row in self.execute(query, chunk):
+                edges[row[0]] = (row[1], row[2])
+
+        return [edges[id_] for id_ in sorted(edges)]
 
+    def get_environment_packages(self, environment_ids=None):
+        """Get ``(environment_id, package_id)`` for every package in environments.
+
+        That is everything linked into them, and (transitively) everything
+        those depend upon.
+
+        :param environment_ids: Which environments; ``None`` for all of them.
+
+        """
+
+        query = '''
+            WITH RECURSIVE members(environment_id, package_id) AS (
+                SELECT environment_id, package_id FROM links %s
+                UNION
+                SELECT members.environment_id, d.dependee_id
+                FROM package_dependencies AS d JOIN members ON d.depender_id = members.package_id
+            )
+            SELECT environment_id, package_id FROM members
+        '''
+
+        if environment_ids is None:
+            return [tuple(row) for row in self.execute(query % '')]
+
+        # Each environment is entirely within one chunk, so nothing repeats.
+        res = []
+        for chunk in chunks(environment_ids):
+            where = 'WHERE environment_id IN (%s)' % ','.join('?' * len(chunk))
+            res.extend(tuple(row) for row in self.execute(query % where, chunk))
+        return res
+
+
+
+
+class Session(object):
+
+    """A unit of work; writes which are collected, then flushed at once.
+
+    On :meth:`flush`, all in one transaction: objects queued with :meth:`add`
+    are persisted (in order, since they need IDs), then statements queued with
+    :meth:`execute` are run (in order), and finally rows queued with
+    :meth:`insert` are inserted with one ``executemany`` per table. Any
+    :class:`DBObject` in the parameters of the latter two is replaced by its
+    ID. If that fails, everything is queued again (ahead of anything queued
+    since), so that nothing is lost if it is flushed again.
+
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self._lock = threading.RLock()
+        self._clear()
+
+    def _clear(self):
+        self._objects = []
+        self._statements = []
+        self._inserts = collections.OrderedDict()
+
+    @property
+    def pending(self):
+        return bool(self._objects or self._statements or self._inserts)
+
+    def discard(self):
+        """Forget everything queued (e.g. after a flush of it failed)."""
+        with self._lock:
+            self._clear()
+
+    def has_object(self, obj):
+        return any(x is obj for x in self._objects)
+
+    def add(self, obj):
+        with self._lock:
+            if not self.has_object(obj):
+                self._objects.append(obj)
+
+    def execute(self, query, params=()):
+        with self._lock:
+            self._statements.append((query, list(params)))
+
+    def insert(self, table, data):
+        pairs = sorted(data.items())
+        key = (table, tuple(k for k, v in pairs))
+        with self._lock:
+            self._inserts.setdefault(key, []).append([v for k, v in pairs])
+
+    def flush(self, con=None):
+
+        with self._lock:
+            if not self.pending:
+                return
+            objects = self._objects
+            statements = self._statements
+            inserts = self._inserts
+            self._clear()
+
+        def resolve(params):
+            return [x.id if isinstance(x, DBObject) else x for x in params]
+
+        new_objects = [obj for obj in objects if obj.id is None]
+        dirty_objects = [obj for obj in objects if obj.is_dirty]
+
+        con = con or self.db.connect()
+        try:
+            with self.db.write_lock, con:
+                for obj in objects:
+                    if obj.is_dirty:
+                        obj._persist_row(con)
+                for query, params in statements:
+                    con.execute(query, resolve(params))
+                for (table, columns), rows in inserts.items():
+                    con.executemany('INSERT INTO %s (%s) VALUES (%s)' % (
+                        escape_identifier(table),
+                        ','.join(escape_identifier(c) for c in columns),
+                        ','.join('?' for _ in columns),
+                    ), [resolve(row) for row in rows])
+        except:
+            # Those IDs (and updates) were rolled back.
+            for obj in new_objects:
+                obj.id = None
+            for obj in dirty_objects:
+                obj.is_dirty = True
+            with self._lock:
+                self._objects = objects + [x for x in self._objects if not any(x is y for y in objects)]
+                self._statements = statements + self._statements
+                for key, rows in self._inserts.items():
+                    inserts.setdefault(key, []).extend(rows)
+                self._inserts = inserts
+            raise
+
+        log.debug('Flushed %d objects, %d statements, and %d rows' % (
+            len(objects), len(statements), sum(len(rows) for rows in inserts.values())
+        ))
 
 
 class Column(object):
@@ -503,9 +924,11 @@ class DBObject(object):
         return self.id or self.persist_in_db(*args, **kwargs)
 
     def persist_in_db(self, con=None, force=False):
-
         if not self.is_dirty and not force:
             return self.id
+        return self._persist_row(con or self._connect())
+
+    def _persist_row(self, con):
 
         data = {}
         for col in self.__columns__:
@@ -519,7 +942,6 @@ class DBObject(object):
             except KeyError:
                 pass
 
-        con = con or self._connect()
         if self.id:
             con.update(self.__tablename__, data, {'id': self.id})
         else:
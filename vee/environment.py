@@ -1,18 +1,18 @@
 import errno
 import os
-import re
 import shutil
 import sys
 
-import six
 import virtualenv
 
 from vee import log
 from vee.cli import style, style_note
 from vee.compat import fsencode
 from vee.database import DBObject, Column
+from vee.filemanifest import FileManifest
 from vee.python import get_default_python
-from vee.utils import makedirs
+from vee.shebang import ShebangCache
+from vee.utils import copy_range, makedirs
 
 IGNORE_DIRS = frozenset(('.git', '.svn'))
 IGNORE_FILES = frozenset(('.DS_Store', ))
@@ -33,7 +33,6 @@ TOP_LEVEL_DIRS = frozenset((
 
 ))
 
-
 class Environment(DBObject):
 
     __tablename__ = 'environments'
@@ -43,6 +42,15 @@ class Environment(DBObject):
     repository_id = Column()
     repository_commit = Column()
 
+    # JSON of the requirements (by name) which were linked into this.
+    manifest = Column()
+
+    # Of the manifest files and platform; see EnvironmentRepo.get_fingerprint.
+    fingerprint = Column()
+
+    # Of the linked packages and platform; see EnvironmentRepo.get_content_hash.
+    content_hash = Column()
+
     def __init__(self, name=None, home=None, repo=None):
         super(Environment, self).__init__()
 
@@ -123,51 +131,61 @@ class Environment(DBObject):
                 if e.errno != errno.EEXIST:
                     raise
 
-    def rewrite_shebang(self, old_path, new_path):
+    def rewrite_shebang(self, old_path, new_path, shebangs=None):
+        """Copy an executable, pointing its shebang to this environment.
+
+        Only those whose interpreter is in our ``bin`` are copied. What their
+        shebangs are comes from a :class:`.ShebangCache` (which the caller
+        may share between many calls, and must flush).
+
+        """
 
         # Only care if it is at all executable.
         stat = os.stat(old_path)
         if not (stat.st_mode & 0o111):
             return
 
-        # If it starts with a Python shebang, rewrite it.
-        with open(old_path, 'rb') as old_fh:
-            old_shebang = old_fh.readline()
-            m = re.match(six.b(r'#!(|\S+/)([^\s/]+)'), old_shebang)
-            if not m:
-                return
-
-            new_bin = os.path.join(fsencode(self.path), b'bin', m.group(2))
-            if not os.path.exists(new_bin):
-                return
-
-            new_shebang = b'#!%s%s' % (new_bin, old_shebang[m.end(2):])
-            log.info('Rewriting shebang of %s' % old_path, verbosity=1)
-            log.debug('New shebang: %s' % new_shebang.strip(), verbosity=1)
-
-            self._assert_real_dir(os.path.dirname(new_path))
+        own_cache = shebangs is None
+        if own_cache:
+            shebangs = ShebangCache(self.home.db)
+        shebang = shebangs.get(old_path, stat)
+        if own_cache:
+            shebangs.flush()
 
-            # Due to the way the _assert_real_dir works, we may have already
-            # created a symlink in the location of the new_path which points to
-            # the old_path. If we don't delete it first, then we will be
-            # reading and writing to the same time, and will only get the
-            # shebang + 1024 bytes (the buffer size on my machine).
-            if os.path.lexists(new_path):
-                os.unlink(new_path)
-
-            with open(new_path, 'wb') as new_fh:
-                new_fh.write(new_shebang)
-                new_fh.writelines(old_fh)
-            try:
-                shutil.copystat(old_path, new_path)
-            except OSError as e:
-                # These often come up when you are not the owner
-                # of the file.
-                log.exception('Could not copystat to %s' % new_path)
-                if e.errno != errno.EPERM:
-                    raise
+        # If it starts with a Python shebang, rewrite it.
+        if not shebang:
+            return
+        new_bin = os.path.join(fsencode(self.path), b'bin', shebang.interpreter)
+        if not os.path.exists(new_bin):
+            return
 
-            return True
+        new_shebang = b'#!%s%s' % (new_bin, shebang.rest)
+        log.info('Rewriting shebang of %s' % old_path, verbosity=1)
+        log.debug('New shebang: %s' % new_shebang.strip(), verbosity=1)
+
+        self._assert_real_dir(os.path.dirname(new_path))
+
+        # Due to the way the _assert_real_dir works, we may have already
+        # created a symlink in the location of the new_path which points to
+        # the old_path. If we don't delete it first, then we will be
+        # reading and writing to the same time, and will only get the
+        # shebang + 1024 bytes (the buffer size on my machine).
+        if os.path.lexists(new_path):
+            os.unlink(new_path)
+
+        with open(old_path, 'rb') as old_fh, open(new_path, 'wb') as new_fh:
+            new_fh.write(new_shebang)
+            copy_range(old_fh, new_fh, shebang.offset, stat.st_size - shebang.offset)
+        try:
+            shutil.copystat(old_path, new_path)
+        except OSError as e:
+            # These often come up when you are not the owner
+            # of the file.
+            log.exception('Could not copystat to %s' % new_path)
+            if e.errno != errno.EPERM:
+                raise
+
+        return True
 
     def _assert_real_dir(self, path):
 
@@ -198,74 +216,173 @@ class Environment(DBObject):
                     os.symlink(os.path.join(link_dst, name), os.path.join(path, name))
 
 
-    def link_directory(self, dir_to_link):
-        
-        src_root = os.path.abspath(dir_to_link)
+    def clone_from(self, other):
+        """Create this environment as a copy of the link tree of another.
+
+        Symlinks are copied as they are (other than those into the other
+        environment itself), and never followed, so a package linked as a
+        whole directory costs one call. The few real files (from virtualenv,
+        and rewritten shebangs) have the other environment's path replaced
+        by ours as they are copied.
+
+        """
+
+        if os.path.lexists(self.path):
+            raise ValueError('environment already exists at %s' % self.path)
+
+        log.info(style_note('Cloning environment', 'from %s' % other.name))
+
+        # It may be shared with (i.e. a link to) another environment.
+        tmp_path = self._clone_aside(os.path.realpath(other.path))
+        os.rename(tmp_path, self.path)
+
+    def unshare(self):
+        """Give this environment a tree of its own, if it shares another's.
+
+        A shared environment is a link to the tree of another (see
+        :meth:`.EnvironmentRepo.upgrade`), so anything linked into it would
+        change that one as well. Returns if it did anything.
+
+        """
+
+        if not os.path.islink(self.path):
+            return False
+
+        other_path = os.path.realpath(self.path)
+        if not os.path.exists(other_path):
+            # What it shared with has since been collected.
+            os.unlink(self.path)
+            return True
+
+        log.info(style_note('Unsharing %s' % self.name, 'from %s' % other_path))
+
+        tmp_path = self._clone_aside(other_path)
+        # A directory can't be renamed over a link.
+        os.unlink(self.path)
+        os.rename(tmp_path, self.path)
+        return True
+
+    def _clone_aside(self, other_path):
+
+        # Build it off to the side, so we never leave a partial environment.
+        tmp_path = '%s.%d.tmp' % (self.path, os.getpid())
+        makedirs(os.path.dirname(self.path))
+        if os.path.lexists(tmp_path):
+            shutil.rmtree(tmp_path)
+
+        counts = {'links': 0, 'files': 0, 'dirs': 0}
+        self._clone_tree(other_path, tmp_path, other_path.rstrip('/'), counts)
+
+        log.debug('Cloned %(dirs)d directories, %(links)d links, and %(files)d files' % counts)
+        return tmp_path
+
+    def _clone_tree(self, src_dir, dst_dir, old_prefix, counts):
+
+        os.mkdir(dst_dir)
+        counts['dirs'] += 1
+
+        subdirs = []
+        for entry in os.scandir(src_dir):
+
+            dst_path = os.path.join(dst_dir, entry.name)
+
+            if entry.is_symlink():
+                target = os.readlink(entry.path)
+                if target == old_prefix or target.startswith(old_prefix + '/'):
+                    target = self.path + target[len(old_prefix):]
+                os.symlink(target, dst_path)
+                counts['links'] += 1
+
+            elif entry.is_dir(follow_symlinks=False):
+                subdirs.append((entry.path, dst_path))
+
+            else:
+                with open(entry.path, 'rb') as fh:
+                    content = fh.read()
+                # Binaries can't have their paths changed in length.
+                if b'\0' not in content:
+                    content = content.replace(fsencode(old_prefix), fsencode(self.path))
+                with open(dst_path, 'wb') as fh:
+                    fh.write(content)
+                shutil.copymode(entry.path, dst_path)
+                counts['files'] += 1
+
+        for src_path, dst_path in subdirs:
+            self._clone_tree(src_path, dst_path, old_prefix, counts)
+        shutil.copymode(src_dir, dst_dir)
+
+    def unlink_directory(self, dir_to_unlink):
+        """Remove everything that :meth:`link_directory` would have linked."""
+
+        src_root = os.path.abspath(dir_to_unlink)
         dst_root = self.path
 
-        self.create_if_not_exists()
+        manifest = FileManifest.load(src_root)
+        for src_dir, dir_names, file_names in (manifest.walk() if manifest else os.walk(src_root)):
 
-        for src_dir, dir_names, file_names in os.walk(src_root):
-            
-            _rel_dir = os.path.relpath(src_dir, src_root)
-            dst_dir = os.path.abspath(os.path.join(dst_root, _rel_dir))
+            rel_dir = os.path.relpath(src_dir, src_root)
+            dst_dir = os.path.abspath(os.path.join(dst_root, rel_dir))
 
-            # The top level should only have the standard directories,
-            # and no files.
             if src_dir == src_root:
                 dir_names[:] = [x for x in dir_names if x in TOP_LEVEL_DIRS]
                 file_names = []
 
-            # Determine if the currect dst directory is real, or there is a link
-            # at some point.
-            dst_dir_is_real = True
-            dst_dir_is_mine = True
-            dst_to_test = dst_dir
-            while len(dst_to_test) > len(dst_root):
-                is_link = os.path.lexists and os.path.islink(dst_to_test)
-                if is_link:
-                    dst_dir_is_real = False
-                    link_path = os.readlink(dst_to_test)
-                    src_to_test = os.path.join(src_root, os.path.relpath(dst_to_test, dst_root))
-                    if link_path != src_to_test:
-                        dst_dir_is_mine = False
-                        break
-                dst_to_test = os.path.dirname(dst_to_test)
-
-            if not dst_dir_is_mine:
-                self._assert_real_dir(dst_dir)
-                dst_dir_is_real = dst_dir_is_mine = True
-
-            # Ignore and skip these directories, and remember to link the
-            # others for later
-            dir_names[:] = [x for x in dir_names if x not in IGNORE_DIRS]
-            to_link = dir_names[:]
-
-            # Check the files first, since they will determine if we need to
-            # force this thing to be real.
-            for name in file_names:
-                if name in IGNORE_FILES:
-                    continue
+            # Whole directories may have been linked, in which case we don't
+            # need to go any further.
+            for name in list(dir_names):
+                dst_path = os.path.join(dst_dir, name)
+                if os.path.islink(dst_path):
+                    if os.readlink(dst_path) == os.path.join(src_dir, name):
+                        os.unlink(dst_path)
+                    dir_names.remove(name)
+                elif name in IGNORE_DIRS or not os.path.isdir(dst_path):
+                    dir_names.remove(name)
 
+            for name in file_names:
                 src_path = os.path.join(src_dir, name)
                 dst_path = os.path.join(dst_dir, name)
+                if os.path.islink(dst_path):
+                    if os.readlink(dst_path) == src_path:
+                        os.unlink(dst_path)
+                elif os.path.isfile(dst_path) and self._is_rewritten_shebang(src_path, dst_path):
+                    os.unlink(dst_path)
+
+    def unlink_missing_directory(self, missing_dir):
+        """Remove every link into a directory which no longer exists.
+
+        Without the directory there is no telling what :meth:`link_directory`
+        linked, so the whole environment is walked instead. Rewritten
+        shebangs are copies, and so are left as they are.
+
+        """
+
+        prefix = os.path.abspath(missing_dir).rstrip('/')
+        for dir_path, dir_names, file_names in os.walk(self.path):
+            for name in dir_names + file_names:
+                path = os.path.join(dir_path, name)
+                if not os.path.islink(path):
+                    continue
+                target = os.readlink(path)
+                if target == prefix or target.startswith(prefix + '/'):
+                    os.unlink(path)
+
+    def _is_rewritten_shebang(self, src_path, dst_path):
+        # It is a copy which differs only in its first line.
+        try:
+            with open(src_path, 'rb') as src_fh, open(dst_path, 'rb') as dst_fh:
+                src_shebang = src_fh.readline()
+                dst_shebang = dst_fh.readline()
+                if not (src_shebang.startswith(b'#!') and dst_shebang.startswith(b'#!')):
+                    return False
+                src_size = os.fstat(src_fh.fileno()).st_size - len(src_shebang)
+                dst_size = os.fstat(dst_fh.fileno()).st_size - len(dst_shebang)
+                return src_size == dst_size
+        except (IOError, OSError):
+            return False
 
-                # Need to check again, since it may be a broken symlink.
-                if os.path.exists(src_path) and self.rewrite_shebang(src_path, dst_path):
-                    dst_dir_is_real = True
-                else:
-                    to_link.append(name)
-
-            # I guess we better link them...
-            if dst_dir_is_real:
-                for name in to_link:
-                    src_path = os.path.join(src_dir, name)
-                    dst_path = os.path.join(dst_dir, name)
-                    try:
-                        os.symlink(src_path, dst_path)
-                    except OSError as e:
-                        if e.errno != errno.EEXIST:
-                            raise
-
-
-
+    def link_directory(self, dir_to_link):
+        # Imported here since it builds upon this module.
+        from vee.linkplan import LinkPlan
+        plan = LinkPlan(self)
+        plan.add(dir_to_link)
+        plan.apply()
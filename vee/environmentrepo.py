@@ -1,6 +1,11 @@
 from subprocess import CalledProcessError
+import hashlib
+import json
 import os
+import platform
 import re
+import socket
+import sys
 
 from vee import log
 from vee.cli import style_note, style_warning, style_error, style
@@ -12,6 +17,14 @@ from vee.packageset import PackageSet
 from vee.utils import cached_property, makedirs
 
 
+# What the fingerprint can't see: Git requirements are resolved by fetching
+# unless pinned to a revision, and control expressions may look at anything
+# via ``os`` (e.g. the environ, or the filesystem).
+_GIT_REQUIREMENT = re.compile(br'^\s*git[:+]\S*(.*)$', re.MULTILINE)
+_PINNED_VERSION = re.compile(br'(?:^|\s)(?:--version[=\s]\s*|-V\s*)[0-9a-f]{8,}(?:\s|$)')
+_VOLATILE_CONTROL = re.compile(br'^\s*%\s*(?:if|elif|set|eval|expr)\b.*\bos\b', re.MULTILINE)
+
+
 class EnvironmentRepo(GitRepo):
 
     def __init__(self, dbrow, home):
@@ -38,6 +51,245 @@ class EnvironmentRepo(GitRepo):
     def get_environment(self):
         return Environment(repo=self, home=self.home)
     
+    def _link_by_branch(self, env):
+        path_by_branch = self.home._abs_path('environments', self.name, self.branch_name)
+        if os.path.lexists(path_by_branch):
+            if os.path.islink(path_by_branch) and os.readlink(path_by_branch) == env.path:
+                return
+            os.unlink(path_by_branch)
+        makedirs(os.path.dirname(path_by_branch))
+        os.symlink(env.path, path_by_branch)
+
+    def get_fingerprint(self):
+        """Identify everything that evaluating the manifest depends upon.
+
+        This is the content of the manifest and everything it includes, the
+        package metadata beside it, and the platform that the control
+        expressions may look at; all without parsing any packages.
+
+        Returns ``None`` if the manifest depends on anything else: a Git
+        requirement which is not pinned to a revision (and so is resolved by
+        fetching), or a control expression which looks at ``os``.
+
+        """
+
+        hasher = hashlib.sha1()
+        for value in (sys.platform, platform.machine(), socket.gethostname(), sys.version):
+            hasher.update(('%s\n' % value).encode('utf8'))
+
+        paths = [self._req_path]
+        seen = set()
+        while paths:
+            path = paths.pop(0)
+            if path in seen:
+                continue
+            seen.add(path)
+            try:
+                with open(path, 'rb') as fh:
+                    content = fh.read()
+            except IOError:
+                content = b''
+            hasher.update(('%s %d\n' % (os.path.relpath(path, self.work_tree), len(content))).encode('utf8'))
+            hasher.update(content)
+            if _VOLATILE_CONTROL.search(content):
+                return
+            for m in _GIT_REQUIREMENT.finditer(content):
+                if not _PINNED_VERSION.search(m.group(1)):
+                    return
+            for m in re.finditer(br'^\s*%\s*include\s+(\S+?)\s*(?:#.*)?$', content, re.MULTILINE):
+                paths.append(os.path.join(os.path.dirname(path), m.group(1).decode('utf8')))
+
+        meta_dir = os.path.join(self.work_tree, 'packages')
+        if os.path.isdir(meta_dir):
+            for name in sorted(os.listdir(meta_dir)):
+                if not name.endswith(('.py', '.sh')):
+                    continue
+                with open(os.path.join(meta_dir, name), 'rb') as fh:
+                    content = fh.read()
+                hasher.update(('packages/%s %d\n' % (name, len(content))).encode('utf8'))
+                hasher.update(content)
+
+        return hasher.hexdigest()
+
+    def get_content_hash(self, packages, names):
+        """Identify what an environment of the given packages would contain.
+
+        This is the IDs of the installed packages (which pin down their
+        dependencies) and the platform, so different manifests (or repos)
+        which resolve to the same packages get the same hash. Returns
+        ``None`` if any of them are not installed yet.
+
+        """
+
+        ids = []
+        for name in names:
+            pkg = packages.get(name)
+            if pkg is None or pkg.virtual:
+                continue
+            if pkg.id is None:
+                return
+            ids.append(pkg.id)
+
+        hasher = hashlib.sha1()
+        for value in (sys.platform, platform.machine(), sys.version):
+            hasher.update(('%s\n' % value).encode('utf8'))
+        hasher.update(','.join(str(x) for x in sorted(set(ids))).encode('utf8'))
+        return hasher.hexdigest()
+
+    def _get_shared_environment(self, env, content_hash):
+        """Find a complete environment with the same contents, to share."""
+
+        con = self.home.db.connect()
+        rows = con.execute('''
+            SELECT id, name, path FROM environments
+            WHERE content_hash = ? AND manifest IS NOT NULL AND path != ?
+            ORDER BY modified_at DESC, id DESC
+        ''', [content_hash, env.path]).fetchall()
+
+        for row in rows:
+            if not os.path.exists(os.path.join(row['path'], 'bin', 'python')):
+                continue
+            shared = Environment(row['path'], home=self.home)
+            shared.id = row['id']
+            shared.name = row['name']
+            return shared
+
+    def _share_environment(self, env, shared):
+        """Create ``env`` as a link to the tree of ``shared``."""
+
+        # Always to the real tree, so that there are no chains to break.
+        path = os.path.realpath(shared.path)
+        log.info(style_note('Sharing %s' % env.name, 'with %s' % shared.name))
+
+        makedirs(os.path.dirname(env.path))
+        os.symlink(path, env.path)
+
+        db = self.home.db
+        con = db.connect()
+        with db.write_lock:
+            env_id = env.id_or_persist()
+        with db.write_lock, con:
+            con.execute('''
+                INSERT INTO links (environment_id, package_id)
+                SELECT ?, package_id FROM links WHERE environment_id = ?
+            ''', [env_id, shared.id])
+
+    def _is_up_to_date(self, env, fingerprint):
+        """Is the environment built from this fingerprint, and still intact?"""
+
+        if fingerprint is None or not os.path.exists(os.path.join(env.path, 'bin', 'python')):
+            return False
+
+        con = self.home.db.connect()
+        row = con.execute('SELECT id, fingerprint FROM environments WHERE path = ?', [env.path]).fetchone()
+        if not row or row['fingerprint'] != fingerprint:
+            return False
+
+        for row in con.execute('''
+            SELECT packages.install_path FROM links
+            JOIN packages ON packages.id = links.package_id
+            WHERE links.environment_id = ?
+        ''', [row['id']]):
+            if not (row['install_path'] and os.path.exists(row['install_path'])):
+                return False
+
+        return True
+
+    def _get_previous_environment(self, env):
+        """Find the last complete environment of this repo to derive from."""
+
+        con = self.home.db.connect()
+        rows = con.execute('''
+            SELECT id, name, path, manifest FROM environments
+            WHERE repository_id = ? AND manifest IS NOT NULL AND path != ?
+            ORDER BY modified_at DESC, id DESC
+        ''', [self.id, env.path]).fetchall()
+
+        for row in rows:
+            if not os.path.exists(os.path.join(row['path'], 'bin', 'python')):
+                continue
+            previous = Environment(row['path'], home=self.home)
+            previous.id = row['id']
+            previous.name = row['name']
+            previous.manifest = row['manifest']
+            return previous
+
+    def _derive_environment(self, env, previous, requirements):
+        """Create ``env`` from ``previous``, and return what must be installed.
+
+        The previous environment is cloned, the packages which have changed
+        (or been removed) since it are unlinked, and the links of the rest are
+        recorded as belonging to the new environment. Only the packages which
+        have changed (or been added), or whose installs have gone missing,
+        need to go through the install.
+
+        Dependencies (i.e. linked packages which aren't in the manifest) are
+        only kept while an unchanged package still depends on them; those of
+        changed packages are linked again as those are installed.
+
+        """
+
+        old_requirements = json.loads(previous.manifest)
+
+        changed = [name for name, args in sorted(requirements.items()) if old_requirements.get(name) != args]
+        removed = [name for name in sorted(old_requirements) if name not in requirements]
+
+        log.info(style_note('Deriving %s from %s' % (env.name, previous.name),
+            '%d changed, %d removed' % (len(changed), len(removed))))
+
+        env.clone_from(previous)
+
+        stale = set(changed)
+        stale.update(removed)
+
+        db = self.home.db
+        con = db.connect()
+        rows = con.execute('''
+            SELECT packages.id, packages.name, packages.install_path FROM links
+            JOIN packages ON packages.id = links.package_id
+            WHERE links.environment_id = ?
+        ''', [previous.id]).fetchall()
+
+        missing = set()
+        for row in rows:
+            if not (row['install_path'] and os.path.exists(row['install_path'])):
+                missing.add(row['id'])
+
+        # Whatever depends on a missing install must be installed again.
+        broken = set(missing)
+        broken.update(x[0] for x in db.get_dependents(missing))
+        for row in rows:
+            if row['id'] in broken and row['name'] in requirements and row['name'] not in stale:
+                log.warning('%s (or a dependency) is no longer installed' % row['name'])
+                stale.add(row['name'])
+                changed.append(row['name'])
+
+        # What the unchanged packages still need.
+        roots = [row['id'] for row in rows if row['name'] in requirements and row['name'] not in stale]
+        needed = set(roots)
+        needed.update(x[1] for x in db.get_dependencies(roots))
+
+        keep = []
+        for row in rows:
+            if row['name'] in stale or row['id'] not in needed:
+                if row['id'] in missing:
+                    if row['install_path']:
+                        env.unlink_missing_directory(row['install_path'])
+                else:
+                    env.unlink_directory(row['install_path'])
+            else:
+                keep.append(row['id'])
+
+        with db.write_lock:
+            env_id = env.id_or_persist()
+        with db.write_lock, con:
+            con.executemany(
+                'INSERT INTO links (environment_id, package_id) VALUES (?, ?)',
+                [(env_id, package_id) for package_id in keep],
+            )
+
+        return sorted(changed)
+
     def load_manifest(self, revision=None):
         manifest = Manifest(repo=self, home=self.home)
         if revision:
@@ -111,7 +363,8 @@ class EnvironmentRepo(GitRepo):
         return True
 
     def upgrade(self, dirty=False, subset=None, reinstall=False, relink=False,
-        no_deps=False, force_branch_link=True
+        no_deps=False, force_branch_link=True, jobs=1, fetch_jobs=8,
+        incremental=True, check=False, conflicts='first',
     ):
 
         self.clone_if_not_exists()
@@ -139,6 +392,12 @@ class EnvironmentRepo(GitRepo):
 
         env = self.get_environment()
 
+        fingerprint = self.get_fingerprint()
+        if not (check or subset or reinstall or relink) and self._is_up_to_date(env, fingerprint):
+            log.info(style_note('Up to date', env.name))
+            self._link_by_branch(env)
+            return True
+
         manifest = self.load_manifest()
         packages = PackageSet(env=env, home=self.home)
         
@@ -147,19 +406,51 @@ class EnvironmentRepo(GitRepo):
         # TODO: This blanket reinstalls things, even if no_deps is set.
         packages.resolve_set(manifest, check_existing=not reinstall)
 
-        # Install and/or link.
-        packages.install(subset or None, link_env=env, reinstall=reinstall, relink=relink, no_deps=no_deps)
+        # What this environment will be made of, so that the next one may be
+        # derived from it.
+        requirements = dict(
+            (pkg.name, ' '.join(pkg.to_args()))
+            for pkg in manifest.iter_packages()
+        )
+
+        # What it shared with has since been collected.
+        if os.path.islink(env.path) and not os.path.exists(env.path):
+            os.unlink(env.path)
+
+        names = subset or None
+        if incremental and not (subset or reinstall or relink) and not os.path.exists(env.path):
+            content_hash = self.get_content_hash(packages, requirements)
+            shared = self._get_shared_environment(env, content_hash) if content_hash else None
+            if shared is not None:
+                self._share_environment(env, shared)
+                names = []
+            else:
+                previous = self._get_previous_environment(env)
+                if previous is not None:
+                    names = self._derive_environment(env, previous, requirements)
+
+        if names is None or names:
+
+            # Get all of the downloads and clones out of the way at once, so
+            # that builds don't stall on them.
+            if fetch_jobs:
+                packages.prefetch(names, reinstall=reinstall, jobs=fetch_jobs)
+
+            # Install and/or link.
+            packages.install(names, link_env=env, reinstall=reinstall, relink=relink, no_deps=no_deps, jobs=jobs, conflicts=conflicts)
+
+        if not (subset or packages._errored):
+            env.manifest = json.dumps(requirements, sort_keys=True)
+            env.fingerprint = fingerprint
+            env.content_hash = self.get_content_hash(packages, requirements)
+            with self.home.db.write_lock:
+                env.persist_in_db()
 
         if packages._errored and not force_branch_link:
             log.warning("Not creating branch or version links; force with --force-branch-link")
             return False
 
-        # Create a symlink by branch.
-        path_by_branch = self.home._abs_path('environments', self.name, self.branch_name)
-        if os.path.lexists(path_by_branch):
-            os.unlink(path_by_branch)
-        makedirs(os.path.dirname(path_by_branch))
-        os.symlink(env.path, path_by_branch)
+        self._link_by_branch(env)
 
         # Create a symlink by version.
         version = manifest.headers.get('Version')
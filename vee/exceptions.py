@@ -72,6 +72,9 @@ class AlreadyInstalled(RuntimeError):
 class AlreadyLinked(RuntimeError):
     __cli_format__ = '{self} is already linked into the environment'
 
+class LinkConflict(RuntimeError):
+    __cli_title__ = 'Link conflict'
+
 class PipelineError(RuntimeError):
     pass
 
@@ -0,0 +1,205 @@
+"""Manifests of the files in an install, recorded at ``post_install``.
+
+Linking, relocation, and repackaging all need to know what is in an install,
+and walking the tree for each of them (especially on NFS) dominates their
+time. So we walk it once, after installing, and record every entry in
+``.vee-files.json`` at the top of the install (where it is never linked,
+since only directories are linked from there). Each entry is
+``(path, type, mode, size, target, binary)``, where:
+
+- ``path`` is relative to the install;
+- ``type`` is ``"d"`` for directories, ``"f"`` for regular files, ``"l"``
+  for symlinks, ``"ld"`` for symlinks to directories, or ``"o"`` for
+  anything else;
+- ``mode`` is the permission bits;
+- ``size`` is in bytes (for regular files);
+- ``target`` is what a symlink points to;
+- ``binary`` is ``"elf"`` or ``"macho"`` for such executables and libraries.
+
+Relocation only changes the contents of files, and so sizes may be stale,
+but nothing else may change an install without rescanning it.
+
+"""
+
+import base64
+import collections
+import json
+import os
+import stat
+
+from vee import log
+from vee.utils import chmod_mode, parse_chmod
+
+
+MANIFEST_NAME = '.vee-files.json'
+
+# Bump when entries change shape; older manifests are ignored.
+VERSION = 1
+
+MACHO_TAGS = set((
+
+    b'feedface',
+    b'cefaefde',
+    b'feedfacf',
+    b'cffaedfe',
+
+    b'cafebabe', # For FAT files?
+    b'bebafeca',
+
+))
+
+ELF_MAGIC = b'\x7fELF'
+
+
+Entry = collections.namedtuple('Entry', 'path type mode size target binary')
+
+
+def _binary_type(path):
+    try:
+        with open(path, 'rb') as fh:
+            magic = fh.read(4)
+    except (IOError, OSError):
+        return
+    if magic == ELF_MAGIC:
+        return 'elf'
+    if base64.b16encode(magic).lower() in MACHO_TAGS:
+        return 'macho'
+
+
+class FileManifest(object):
+
+    def __init__(self, root, entries):
+        self.root = root
+        self.entries = collections.OrderedDict((e.path, e) for e in entries)
+        self._children = None
+
+    @classmethod
+    def scan(cls, root):
+        """Walk the tree at ``root`` (once) to build a manifest."""
+
+        entries = []
+        todo = ['']
+        while todo:
+
+            rel_dir = todo.pop()
+            try:
+                dir_entries = list(os.scandir(os.path.join(root, rel_dir) if rel_dir else root))
+            except OSError as e:
+                # Just as os.walk ignores them.
+                log.debug('Could not scan %s: %s' % (rel_dir or root, e))
+                continue
+
+            for dir_entry in dir_entries:
+
+                rel_path = os.path.join(rel_dir, dir_entry.name) if rel_dir else dir_entry.name
+                if rel_path == MANIFEST_NAME:
+                    continue
+
+                st = dir_entry.stat(follow_symlinks=False)
+                mode = stat.S_IMODE(st.st_mode)
+                size = 0
+                target = binary = None
+
+                if stat.S_ISLNK(st.st_mode):
+                    type_ = 'ld' if dir_entry.is_dir() else 'l'
+                    target = os.readlink(dir_entry.path)
+                elif stat.S_ISDIR(st.st_mode):
+                    type_ = 'd'
+                    todo.append(rel_path)
+                elif stat.S_ISREG(st.st_mode):
+                    type_ = 'f'
+                    size = st.st_size
+                    # Only read those which could be binaries (see
+                    # libs.find_shared_libraries), rather than everything.
+                    ext = os.path.splitext(dir_entry.name)[1]
+                    if not ext or ext in ('.so', '.dylib') or mode & 0o111:
+                        binary = _binary_type(dir_entry.path)
+                else:
+                    type_ = 'o'
+
+                entries.append(Entry(rel_path, type_, mode, size, target, binary))
+
+        entries.sort()
+        return cls(root, entries)
+
+    @property
+    def path(self):
+        return os.path.join(self.root, MANIFEST_NAME)
+
+    @classmethod
+    def load(cls, root):
+        """Get the manifest recorded for ``root``, or ``None``."""
+        path = os.path.join(root, MANIFEST_NAME)
+        try:
+            with open(path) as fh:
+                raw = json.load(fh)
+        except (IOError, OSError):
+            return
+        except ValueError as e:
+            log.warning('Could not read %s: %s' % (path, e))
+            return
+        if raw.get('version') != VERSION:
+            return
+        return cls(root, [Entry(*x) for x in raw['entries']])
+
+    def save(self):
+        path = self.path
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp_path, 'w') as fh:
+            json.dump({
+                'version': VERSION,
+                'entries': [list(e) for e in self.entries.values()],
+            }, fh, separators=(',', ':'))
+        os.rename(tmp_path, path)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        return iter(self.entries.values())
+
+    def get(self, path, default=None):
+        """Get the entry at a path relative to the root."""
+        return self.entries.get(path, default)
+
+    def listdir(self, path=''):
+        """The entries directly within a directory (relative to the root)."""
+        if self._children is None:
+            self._children = {'': []}
+            for e in self.entries.values():
+                if e.type == 'd':
+                    self._children.setdefault(e.path, [])
+                self._children.setdefault(os.path.dirname(e.path), []).append(e)
+        return self._children.get(path, [])
+
+    def walk(self):
+        """Like ``os.walk(root)`` (top-down, without following links).
+
+        As with os.walk, ``dir_names`` may be modified in place to prune the
+        walk. Symlinks to directories are in ``dir_names``, but never walked.
+
+        """
+
+        todo = ['']
+        while todo:
+            rel_dir = todo.pop(0)
+            dir_names = []
+            file_names = []
+            for e in self.listdir(rel_dir):
+                (dir_names if e.type in ('d', 'ld') else file_names).append(os.path.basename(e.path))
+            yield (os.path.join(self.root, rel_dir) if rel_dir else self.root), dir_names, file_names
+            todo[0:0] = [
+                path for path in (os.path.join(rel_dir, name) if rel_dir else name for name in dir_names)
+                if self.entries[path].type == 'd'
+            ]
+
+    def chmod(self, specs):
+        """Apply ``chmod`` specs to every file and directory (but not links)."""
+        ops = parse_chmod(specs)
+        for path, e in list(self.entries.items()):
+            if e.type not in ('d', 'f'):
+                continue
+            mode = chmod_mode(e.mode, ops)
+            if mode != e.mode:
+                os.chmod(os.path.join(self.root, path), mode)
+                self.entries[path] = e._replace(mode=mode)
@@ -2,8 +2,7 @@ import json
 import os
 import re
 
-import pkg_resources
-
+from vee.buildcache import BuildCache
 from vee.config import Config
 from vee.database import Database
 from vee.devpackage import DevPackage
@@ -68,6 +67,10 @@ class Home(object):
         path = [os.path.expanduser(x) for x in path]
         return path
 
+    @cached_property
+    def build_cache(self):
+        return BuildCache.from_environ(self)
+
     def _abs_path(self, *args):
         return os.path.abspath(os.path.join(self.root, *args))
 
@@ -0,0 +1,86 @@
+"""A GNU make jobserver shared by everything we build.
+
+Every process we run with ``call(..., jobserver=True)`` holds one job slot
+for as long as it runs (which is the implicit slot that make assumes it
+has), and is told about the jobserver via ``$MAKEFLAGS`` so that ``make`` (and
+anything else which speaks the protocol) takes further slots from the same
+pool. Total build parallelism is therefore bounded by the size of the pool no
+matter how many packages are building at once.
+
+The pool is sized by ``$VEE_MAKE_JOBS``, defaulting to the number of CPUs
+available to us.
+
+"""
+
+import os
+import select
+import threading
+
+
+def default_jobs(environ=None):
+    environ = os.environ if environ is None else environ
+    value = environ.get('VEE_MAKE_JOBS')
+    if value:
+        return max(1, int(value))
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+class Jobserver(object):
+
+    def __init__(self, jobs):
+
+        self.jobs = jobs
+
+        # Tokens are single bytes in a pipe; taking one is a read, and
+        # returning it is a write.
+        self.read_fd, self.write_fd = os.pipe()
+        os.set_inheritable(self.read_fd, True)
+        os.set_inheritable(self.write_fd, True)
+        os.write(self.write_fd, b'+' * jobs)
+
+    @property
+    def fds(self):
+        return (self.read_fd, self.write_fd)
+
+    @property
+    def makeflags(self):
+        # The -j is required for make to look for a jobserver at all; make
+        # 4.2 renamed --jobserver-fds to --jobserver-auth.
+        return '-j%d --jobserver-fds=%d,%d --jobserver-auth=%d,%d' % (
+            self.jobs, self.read_fd, self.write_fd, self.read_fd, self.write_fd,
+        )
+
+    def acquire(self):
+        while True:
+            try:
+                return os.read(self.read_fd, 1)
+            except InterruptedError:
+                pass
+            except BlockingIOError:
+                # make sets the (shared) pipe to be non-blocking.
+                select.select([self.read_fd], [], [])
+
+    def release(self, token):
+        os.write(self.write_fd, token)
+
+    def prepare(self, kwargs):
+        """Setup :func:`subprocess.Popen` kwargs to pass on the jobserver."""
+        env = dict(kwargs.get('env') or os.environ)
+        env['MAKEFLAGS'] = self.makeflags
+        env.pop('MFLAGS', None)
+        kwargs['env'] = env
+        kwargs['pass_fds'] = tuple(kwargs.get('pass_fds', ())) + self.fds
+
+
+_jobserver = None
+_lock = threading.Lock()
+
+def get_jobserver():
+    global _jobserver
+    with _lock:
+        if _jobserver is None:
+            _jobserver = Jobserver(default_jobs())
+        return _jobserver
@@ -5,6 +5,7 @@ import re
 import stat
 import sys
 
+from vee.filemanifest import FileManifest, MACHO_TAGS
 from vee.subproc import call
 from vee import log
 
@@ -103,21 +104,27 @@ def get_symbols(path):
     return _symbol_cache[path]
 
 
-MACHO_TAGS = set((
-
-    b'feedface',
-    b'cefaefde',
-    b'feedfacf',
-    b'cffaedfe',
-
-    b'cafebabe', # For FAT files?
-    b'bebafeca',
-
-))
+def _allow_blank_ext(dir_path):
+    return bool(re.search(r'(^|/)([^/]+\.framework|MacOS|bin|scripts)($/|)', dir_path))
 
 
 def find_shared_libraries(path):
 
+    # Installs (usually) have a manifest of their files, so we don't need to
+    # walk them.
+    manifest = FileManifest.load(path)
+    if manifest is not None:
+        for entry in manifest:
+            if entry.type != 'f':
+                continue
+            lib_path = os.path.join(path, entry.path)
+            ext = os.path.splitext(lib_path)[1]
+            if ext in ('.so', '.dylib'):
+                yield lib_path
+            elif not ext and entry.binary == 'macho' and _allow_blank_ext(os.path.dirname(lib_path)):
+                yield lib_path
+        return
+
     for dir_path, dir_names, file_names in os.walk(path):
 
         allow_blank_ext = None
@@ -136,12 +143,12 @@ def find_shared_libraries(path):
             if not ext:
                 
                 if allow_blank_ext is None:
-                    allow_blank_ext = bool(re.search(r'(^|/)([^/]+\.framework|MacOS|bin|scripts)($/|)', dir_path))
+                    allow_blank_ext = _allow_blank_ext(dir_path)
                 if not allow_blank_ext:
                     continue
 
                 try:
-                    tag = base64.b16encode(open(path, 'rb').read(4))
+                    tag = base64.b16encode(open(path, 'rb').read(4)).lower()
                 except IOError:
                     continue
                 if tag in MACHO_TAGS:
@@ -174,15 +181,33 @@ def get_installed_shared_libraries(con, package_id, install_path, rescan=False):
         for lib_path in find_shared_libraries(install_path):
             log.debug('Found shared library %s' % lib_path)
             res.append(lib_path)
-            con.execute('''INSERT INTO shared_libraries (package_id, name, path) VALUES (?, ?, ?)''', [
-                package_id, os.path.basename(lib_path), lib_path,
-            ])
+        con.executemany('''INSERT INTO shared_libraries (package_id, name, path) VALUES (?, ?, ?)''', [
+            (package_id, os.path.basename(lib_path), lib_path) for lib_path in res
+        ])
         
         con.execute('UPDATE packages SET scanned_for_libraries = 1 WHERE id = ?', [package_id])
 
         return res
 
 
+def queue_shared_libraries(session, package, install_path):
+    """Scan for shared libraries, and queue recording them on the session."""
+
+    res = []
+    for lib_path in find_shared_libraries(install_path):
+        log.debug('Found shared library %s' % lib_path)
+        res.append(lib_path)
+        session.insert('shared_libraries', {
+            'package_id': package,
+            'name': os.path.basename(lib_path),
+            'path': lib_path,
+        })
+
+    session.execute('UPDATE packages SET scanned_for_libraries = 1 WHERE id = ?', [package])
+
+    return res
+
+
 def _parse_spec(spec, root):
 
     flags = set()
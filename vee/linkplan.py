@@ -0,0 +1,488 @@
+"""Planned linking of installs into an environment.
+
+Linking one install at a time means walking it, climbing the ancestors of
+every directory to see what is a symlink, and then often undoing what the
+last install did (by "exploding" a symlinked directory into a real one full of
+symlinks) when the next install shares a directory (e.g.
+``lib/python*/site-packages``).
+
+Instead, a :class:`LinkPlan` works out the final symlink farm for every install
+in memory (reading installs from their :class:`.FileManifest`, and each
+directory of the environment at most once via :func:`os.scandir`), and then
+applies it in one pass with calls relative to open directories.
+
+The result is the same as that of linking each install in turn: whole
+directories are linked where nothing else is, and real directories are made
+where installs overlap or shebangs must be rewritten.
+
+Since the whole farm is in memory, two installs (or an install and what is
+already in the environment) claiming the same path are found there, and
+reported before anything is touched on disk. What happens then is up to the
+``conflicts`` policy: ``"first"`` keeps what was there first (as linking has
+always done), ``"last"`` replaces it, and ``"error"`` refuses to link the
+install at all (by raising :class:`.LinkConflict` from :meth:`LinkPlan.add`).
+
+"""
+
+import collections
+import errno
+import os
+import stat
+
+from vee import log
+from vee.cli import style_note
+from vee.compat import fsencode
+from vee.environment import IGNORE_DIRS, IGNORE_FILES, TOP_LEVEL_DIRS
+from vee.exceptions import LinkConflict
+from vee.filemanifest import FileManifest
+from vee.shebang import ShebangCache
+from vee.utils import copy_range
+
+
+# Everything we need; macOS and Linux have them all.
+_DIR_FD = all(f in os.supports_dir_fd for f in (os.open, os.mkdir, os.symlink, os.unlink))
+
+CONFLICT_POLICIES = ('first', 'last', 'error')
+
+# ``existing`` is what it is linked to, or None if we don't know.
+Conflict = collections.namedtuple('Conflict', 'path existing new')
+
+_missing = object()
+
+
+class _Dir(object):
+
+    """A real directory; ``children`` are read from disk when first needed."""
+
+    __slots__ = ('children', 'on_disk', 'loaded', 'replaces')
+
+    def __init__(self, on_disk=False, replaces=False):
+        self.children = {}
+        self.on_disk = on_disk
+        self.loaded = not on_disk
+        self.replaces = replaces
+
+
+class _Link(object):
+
+    """A symlink; for those already on disk, the target is read when needed."""
+
+    __slots__ = ('target', 'is_dir', 'on_disk', 'replaces')
+
+    def __init__(self, target, is_dir=None, on_disk=False):
+        self.target = target
+        self.is_dir = is_dir
+        self.on_disk = on_disk
+        self.replaces = False
+
+
+class _File(object):
+
+    """Anything else already on disk, or a script to rewrite the shebang of."""
+
+    __slots__ = ('src_path', 'on_disk', 'replaces')
+
+    def __init__(self, src_path=None, on_disk=False):
+        self.src_path = src_path
+        self.on_disk = on_disk
+        self.replaces = False
+
+
+class LinkPlan(object):
+
+    def __init__(self, env, conflicts='first'):
+
+        if conflicts not in CONFLICT_POLICIES:
+            raise ValueError('conflicts must be one of %s; got %r' % (', '.join(CONFLICT_POLICIES), conflicts))
+
+        self.env = env
+        self.policy = conflicts
+        self.root = _Dir(on_disk=True)
+        self.count = 0
+
+        # Every Conflict found so far (including those refused).
+        self.conflicts = []
+
+        # Calls to the filesystem we have made (or will make when applied),
+        # and an estimate of how many linking one at a time would have made.
+        self.calls = 0
+        self.naive_calls = 0
+
+        self._rewrites_cache = {}
+        self._shebangs = ShebangCache(env.home.db)
+        self._needs_real_cache = {}
+        self._prepared = False
+        self._undo = None
+
+    def add(self, src_root):
+        """Plan linking everything in the given directory (usually an install)."""
+
+        if not self._prepared:
+            # Never write through into the tree of another environment.
+            self.env.unshare()
+            # So that we know what shebangs may be rewritten to.
+            self.env.create_if_not_exists()
+            self._prepared = True
+
+        src_root = os.path.abspath(src_root)
+        self._shebangs.preload(src_root)
+        manifest = FileManifest.load(src_root)
+        if manifest is None:
+            manifest = FileManifest.scan(src_root)
+            self.calls += len(manifest)
+        self.calls += 1
+
+        # The top level should only have the standard directories, and no files.
+        entries = [e for e in manifest.listdir() if e.type in ('d', 'ld') and e.path in TOP_LEVEL_DIRS]
+
+        start = len(self.conflicts)
+        self._undo = [] if self.policy == 'error' else None
+        try:
+            self._merge(self.root, self.env.path, src_root, manifest, entries)
+            conflicts = self.conflicts[start:]
+            if conflicts and self._undo is not None:
+                # Leave the plan as if we were never asked.
+                for children, name, node in reversed(self._undo):
+                    if node is _missing:
+                        del children[name]
+                    else:
+                        children[name] = node
+                raise LinkConflict('%s has %d conflicting paths; first is %s' % (src_root, len(conflicts), conflicts[0].path))
+        finally:
+            self._undo = None
+
+        for c in conflicts:
+            log.warning('%s from %s conflicts with %s; %s' % (
+                c.path, src_root, c.existing or 'what is already there',
+                'replacing it' if self.policy == 'last' else 'skipping',
+            ))
+
+        self.count += 1
+        self.naive_calls += self._estimate_naive_calls(manifest)
+
+    def _estimate_naive_calls(self, manifest):
+        # Environment.link_directory used to walk every directory, check each
+        # of its ancestors for symlinks, stat every file (twice), open every
+        # executable, and attempt a symlink of most entries.
+        calls = 1
+        for e in manifest:
+            top = e.path.split(os.path.sep, 1)[0]
+            if top not in TOP_LEVEL_DIRS:
+                continue
+            if e.type == 'd':
+                calls += 2 + e.path.count(os.path.sep) + 1
+            else:
+                calls += 3 + bool(e.mode & 0o111)
+        return calls
+
+    def _children(self, node, path):
+        if not node.loaded:
+            node.loaded = True
+            self.calls += 1
+            for entry in os.scandir(path):
+                if entry.is_symlink():
+                    child = _Link(None, on_disk=True)
+                elif entry.is_dir(follow_symlinks=False):
+                    child = _Dir(on_disk=True)
+                else:
+                    child = _File(on_disk=True)
+                node.children.setdefault(entry.name, child)
+        return node.children
+
+    def _link_target(self, link, path):
+        if link.target is None:
+            self.calls += 1
+            target = os.readlink(path)
+            link.target = os.path.normpath(os.path.join(os.path.dirname(path), target))
+        return link.target
+
+    def _link_is_dir(self, link, path):
+        if link.is_dir is None:
+            self.calls += 1
+            link.is_dir = os.path.isdir(self._link_target(link, path))
+        return link.is_dir
+
+    def _set(self, children, name, node):
+        if self._undo is not None:
+            self._undo.append((children, name, children.get(name, _missing)))
+        children[name] = node
+        return node
+
+    def _merge(self, node, dst_dir, src_root, manifest, entries):
+
+        children = self._children(node, dst_dir)
+
+        for e in entries:
+
+            name = os.path.basename(e.path)
+            if name in (IGNORE_DIRS if e.type in ('d', 'ld') else IGNORE_FILES):
+                continue
+
+            src_path = os.path.join(src_root, e.path)
+            dst_path = os.path.join(dst_dir, name)
+            child = children.get(name)
+
+            if child is None:
+                self._set(children, name, self._new_node(src_root, manifest, e, dst_path))
+                continue
+
+            if e.type == 'd':
+
+                # Real directories (not links to them) are merged into whatever
+                # directory is there.
+                if isinstance(child, _Link) and self._link_is_dir(child, dst_path):
+                    if self._link_target(child, dst_path) == src_path and not self._needs_real(src_root, manifest, e):
+                        continue # Already linked.
+                    child = self._set(children, name, self._explode(child, dst_path))
+
+                if isinstance(child, _Dir):
+                    self._merge(child, dst_path, src_root, manifest, manifest.listdir(e.path))
+                    continue
+
+            elif self._is_same(child, dst_path, src_path, e):
+                if isinstance(child, _File) and child.on_disk:
+                    # Rewrite it again, since the original may have changed.
+                    self._set(children, name, _File(src_path))
+                continue
+
+            self._conflict(children, name, child, src_root, manifest, e, dst_path)
+
+    def _is_same(self, child, dst_path, src_path, e):
+        """Is the existing node already what we would link for ``e``?"""
+        if isinstance(child, _Link):
+            return self._link_target(child, dst_path) == src_path
+        if isinstance(child, _File):
+            if not child.on_disk:
+                return child.src_path == src_path
+            if e.type in ('f', 'l') and self._rewrites(src_path, e):
+                self.calls += 1
+                return self.env._is_rewritten_shebang(src_path, dst_path)
+        return False
+
+    def _conflict(self, children, name, child, src_root, manifest, e, dst_path):
+
+        if isinstance(child, _Link):
+            existing = child.target
+        elif isinstance(child, _File):
+            existing = child.src_path
+        else:
+            existing = None
+        self.conflicts.append(Conflict(os.path.relpath(dst_path, self.env.path), existing, os.path.join(src_root, e.path)))
+
+        # Directories may have come from many places, so they always stay.
+        if self.policy == 'last' and not isinstance(child, _Dir):
+            node = self._new_node(src_root, manifest, e, dst_path)
+            node.replaces = child.on_disk or child.replaces
+            self._set(children, name, node)
+
+    def _new_node(self, src_root, manifest, e, dst_path):
+
+        src_path = os.path.join(src_root, e.path)
+
+        if e.type == 'd':
+            if self._needs_real(src_root, manifest, e):
+                node = _Dir()
+                self._merge(node, dst_path, src_root, manifest, manifest.listdir(e.path))
+                return node
+            return _Link(src_path, is_dir=True)
+
+        if e.type in ('f', 'l') and self._rewrites(src_path, e):
+            return _File(src_path)
+
+        return _Link(src_path, is_dir=e.type == 'ld')
+
+    def _explode(self, link, path):
+        """Turn a link to a directory into a real one, full of links."""
+        target = self._link_target(link, path)
+        # If we haven't made the link yet, there is nothing to replace.
+        node = _Dir(replaces=link.on_disk or link.replaces)
+        self.calls += 1
+        for entry in os.scandir(target):
+            node.children[entry.name] = _Link(os.path.join(target, entry.name), is_dir=entry.is_dir())
+        return node
+
+    def _needs_real(self, src_root, manifest, e):
+        """Must this directory be real (since it has shebangs to rewrite)?"""
+        key = (src_root, e.path)
+        try:
+            return self._needs_real_cache[key]
+        except KeyError:
+            pass
+        res = False
+        for child in manifest.listdir(e.path):
+            name = os.path.basename(child.path)
+            if child.type == 'd':
+                if name not in IGNORE_DIRS and self._needs_real(src_root, manifest, child):
+                    res = True
+                    break
+            elif child.type in ('f', 'l') and name not in IGNORE_FILES:
+                if self._rewrites(os.path.join(src_root, child.path), child):
+                    res = True
+                    break
+        self._needs_real_cache[key] = res
+        return res
+
+    def _rewrites(self, src_path, e):
+        """Would :meth:`.Environment.rewrite_shebang` rewrite this?"""
+
+        try:
+            return self._rewrites_cache[src_path]
+        except KeyError:
+            pass
+
+        res = False
+        if e.type == 'l' or e.mode & 0o111:
+            self.calls += 1
+            try:
+                st = os.stat(src_path)
+            except OSError:
+                st = None
+            if st is not None and st.st_mode & 0o111:
+                reads = self._shebangs.reads
+                shebang = self._shebangs.get(src_path, st)
+                self.calls += self._shebangs.reads - reads
+                if shebang:
+                    res = self._will_exist('bin', os.fsdecode(shebang.interpreter))
+
+        self._rewrites_cache[src_path] = res
+        return res
+
+    def _will_exist(self, *parts):
+        """Will the given path exist in the environment (once we are applied)?"""
+        node = self.root
+        path = self.env.path
+        for i, name in enumerate(parts):
+            if isinstance(node, _Link):
+                self.calls += 1
+                return os.path.exists(os.path.join(self._link_target(node, path), *parts[i:]))
+            if not isinstance(node, _Dir):
+                return False
+            node = self._children(node, path).get(name)
+            path = os.path.join(path, name)
+            if node is None:
+                return False
+        return True
+
+    def apply(self):
+        """Make the planned links (and directories, and rewritten scripts)."""
+
+        # Nothing was added, so the environment may not even exist.
+        if not self._prepared:
+            return
+
+        before = self.calls
+
+        fd = os.open(self.env.path, os.O_RDONLY) if _DIR_FD else None
+        self.calls += 1
+        try:
+            self._apply_dir(self.root, self.env.path, fd)
+        finally:
+            if fd is not None:
+                os.close(fd)
+
+        self._shebangs.flush()
+
+        log.debug('Link plan for %s made %d filesystem calls' % (self.env.name, self.calls - before))
+        if self.count > 1:
+            log.info(style_note('Linked %d packages' % self.count, 'with %d filesystem calls; about %d fewer than one at a time' % (
+                self.calls, max(0, self.naive_calls - self.calls))))
+
+    def _apply_dir(self, node, path, fd):
+
+        for name, child in sorted(node.children.items()):
+
+            if child.on_disk:
+                # Only what we have looked into may have changed within.
+                if isinstance(child, _Dir) and child.loaded:
+                    self._apply_subdir(child, path, fd, name)
+                continue
+
+            if isinstance(child, _Link):
+                if child.replaces:
+                    self._call(os.unlink, None, path, fd, name)
+                self._call(os.symlink, child.target, path, fd, name)
+
+            elif isinstance(child, _File):
+                if not self._rewrite(child, path, fd, name):
+                    if child.replaces:
+                        self._call(os.unlink, None, path, fd, name)
+                    self._call(os.symlink, child.src_path, path, fd, name)
+
+            else:
+                if child.replaces:
+                    self._call(os.unlink, None, path, fd, name)
+                self._call(os.mkdir, None, path, fd, name)
+                self._apply_subdir(child, path, fd, name)
+
+    def _rewrite(self, child, path, fd, name):
+        """Copy a script with its shebang pointed to the environment.
+
+        The same as :meth:`.Environment.rewrite_shebang`, but relative to the
+        open directory, and trusting the plan that the interpreter will be
+        there (it may not be linked yet).
+
+        """
+
+        self.calls += 1
+        try:
+            st = os.stat(child.src_path)
+        except OSError:
+            return
+        reads = self._shebangs.reads
+        shebang = self._shebangs.get(child.src_path, st)
+        self.calls += self._shebangs.reads - reads
+        # It may have changed since it was planned.
+        if not (shebang and st.st_mode & 0o111):
+            return
+
+        new_bin = os.path.join(fsencode(self.env.path), b'bin', shebang.interpreter)
+        new_shebang = b'#!%s%s' % (new_bin, shebang.rest)
+        log.info('Rewriting shebang of %s' % child.src_path, verbosity=1)
+        log.debug('New shebang: %s' % new_shebang.strip(), verbosity=1)
+
+        if child.replaces:
+            self._call(os.unlink, None, path, fd, name)
+
+        flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC
+        self.calls += 2
+        with open(child.src_path, 'rb') as src_fh:
+            if fd is not None:
+                dst_fd = os.open(name, flags, 0o600, dir_fd=fd)
+            else:
+                dst_fd = os.open(os.path.join(path, name), flags, 0o600)
+            with os.fdopen(dst_fd, 'wb') as dst_fh:
+                # One write, and (usually) one copy in the kernel.
+                self.calls += 2
+                dst_fh.write(new_shebang)
+                copy_range(src_fh, dst_fh, shebang.offset, st.st_size - shebang.offset)
+                self.calls += 2
+                os.fchmod(dst_fd, stat.S_IMODE(st.st_mode))
+                os.utime(dst_fd, ns=(st.st_atime_ns, st.st_mtime_ns))
+
+        return True
+
+    def _apply_subdir(self, node, path, fd, name):
+        sub_path = os.path.join(path, name)
+        sub_fd = None
+        if fd is not None:
+            self.calls += 1
+            sub_fd = os.open(name, os.O_RDONLY, dir_fd=fd)
+        try:
+            self._apply_dir(node, sub_path, sub_fd)
+        finally:
+            if sub_fd is not None:
+                os.close(sub_fd)
+
+    def _call(self, func, target, path, fd, name):
+        self.calls += 1
+        args = () if target is None else (target, )
+        try:
+            if fd is not None:
+                func(*args, name, dir_fd=fd)
+            else:
+                func(*args, os.path.join(path, name))
+        except OSError as e:
+            # Conflicts were dealt with in the plan, but someone else may
+            # have linked something since.
+            if e.errno != errno.EEXIST:
+                raise
@@ -1,8 +1,11 @@
 import contextlib
+import copy
+import io
 import logging
 import sys
+import threading
 
-from vee.globals import Stack
+from vee.globals import Proxy, Stack
 from vee.cli import style
 
 
@@ -13,8 +16,26 @@ root.setLevel(logging.DEBUG)
 root.propagate = False
 
 
-_config_stack = Stack()
-config = _config_stack.proxy()
+class _Context(object):
+
+    """Where a thread's output goes, and the config stack used to format it."""
+
+    def __init__(self, stack, stream=None):
+        self.stack = stack
+        self.stream = stream
+        self.last_nl = True
+
+
+_main_context = _Context(Stack())
+_local = threading.local()
+_output_lock = threading.Lock()
+
+
+def get_context():
+    return getattr(_local, 'context', None) or _main_context
+
+
+config = Proxy(lambda: get_context().stack[-1])
 
 config.indent = ''
 config.style = {}
@@ -23,12 +44,44 @@ config.verbosity = 0
 
 @contextlib.contextmanager
 def indent(prefix='  ', postfix=''):
-    config = _config_stack.push()
+    stack = get_context().stack
+    config = stack.push()
     config.indent = prefix + config.indent + postfix
     try:
         yield
     finally:
-        _config_stack.pop()
+        stack.pop()
+
+
+@contextlib.contextmanager
+def adopt(context):
+    """Send this thread's output to the given context (from :func:`get_context`)."""
+    old = getattr(_local, 'context', None)
+    _local.context = context
+    try:
+        yield
+    finally:
+        _local.context = old
+
+
+@contextlib.contextmanager
+def group():
+    """Buffer this thread's output, and write it all at once when done.
+
+    This keeps the output of concurrent work from interleaving; the config
+    (indent, verbosity, etc.) starts as a copy of the current one.
+
+    """
+    parent = get_context()
+    context = _Context(Stack(copy.deepcopy(parent.stack[-1])), io.StringIO())
+    try:
+        with adopt(context):
+            yield
+    finally:
+        with _output_lock:
+            stream = parent.stream or sys.stdout
+            stream.write(context.stream.getvalue())
+            stream.flush()
 
 
 @contextlib.contextmanager
@@ -61,10 +114,6 @@ _default_verbosity = {
 
 class StdoutHandler(logging.Handler):
     
-    def __init__(self, *args, **kwargs):
-        super(StdoutHandler, self).__init__(*args, **kwargs)
-        self._last_nl = True
-
     def filter(self, record):
         # Make sure it isn't too verbose. DEBUG messages default to level 2,
         # and everything else gets through. If we introduct TRACE or BLATHER
@@ -88,6 +137,8 @@ class StdoutHandler(logging.Handler):
 
     def emit(self, record):
         
+        context = get_context()
+        stream = context.stream or sys.stdout
         indent = config.indent
 
         # Subprocesses should not have a trailing newline added.
@@ -95,16 +146,16 @@ class StdoutHandler(logging.Handler):
         if from_subproc:
             msg = record.msg % record.args if record.args else record.msg
             for line in msg.splitlines(True):
-                sys.stdout.write((indent if self._last_nl else '') + line)
-                self._last_nl = line.endswith('\n')
-            sys.stdout.flush()
+                stream.write((indent if context.last_nl else '') + line)
+                context.last_nl = line.endswith('\n')
+            stream.flush()
             return
 
         msg = self.format(record)
         for line in msg.rstrip().splitlines():
-            print(indent + line)
+            stream.write(indent + line + '\n')
 
-        self._last_nl = True
+        context.last_nl = True
 
 
 root.addHandler(StdoutHandler())
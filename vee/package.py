@@ -13,12 +13,10 @@ import sys
 
 import six
 
-import pkg_resources
-
 from vee import libs
 from vee import log
 from vee.cli import style, style_note
-from vee.database import DBObject, Column
+from vee.database import DBObject, Column, Session
 from vee.exceptions import AlreadyInstalled, AlreadyLinked, CliMixin
 from vee.pipeline.base import Pipeline
 from vee.provision import Provision
@@ -644,57 +642,86 @@ class Package(DBObject):
         log.info(style_note('Uninstalling ', self.install_path))
         shutil.rmtree(self.install_path)
 
-    def shared_libraries(self, rescan=False):
+    def shared_libraries(self, rescan=False, session=None):
         if self.virtual:
             raise RuntimeError('cannot find libraries of virtual package')
         self._assert_paths(install=True)
         if not self.installed:
             raise RuntimeError('cannot find libraries if not installed')
+        if session is not None and self.id is None and session.has_object(self):
+            # It isn't in the database yet, so it certainly hasn't been scanned.
+            return libs.queue_shared_libraries(session, self, self.install_path)
         if not self.id:
             # I'm not sure if this is a big deal, but I want to see when
             # it is happening.
             log.warning('Finding shared libraries before package is in database.')
         return libs.get_installed_shared_libraries(self.home.db.connect(), self.id_or_persist(), self.install_path, rescan)
 
-    def link(self, env, force=False):
+    def link(self, env, force=False, session=None, plan=None):
+        """Link this package into an environment.
+
+        With a :class:`.LinkPlan` the links are only planned, and the caller
+        must record them (with :meth:`_record_link`) once the plan is applied.
+
+        """
         self._assert_paths(install=True)
         if not force:
             self._assert_unlinked(env)
         log.info(style_note('Linking into %s' % env.name))
+        if plan is not None:
+            plan.add(self.install_path)
+            return
         env.link_directory(self.install_path)
-        self._record_link(env)
+        self._record_link(env, session)
 
     def _assert_unlinked(self, env, frozen=None):
-        if not self.link_id:
+        row = None
+        # It can't have been linked if it isn't in the database yet.
+        if not self.link_id and self.id is not None:
             row = self.home.db.execute(
                 'SELECT id FROM links WHERE package_id = ? AND environment_id = ?',
-                [self.id_or_persist(), env.id_or_persist()]
+                [self.id, env.id_or_persist()]
             ).fetchone()
         if self.link_id or row:
             raise AlreadyLinked(str(self), self.link_id or row[0])
 
-    def persist_in_db(self, con=None):
+    def persist_in_db(self, con=None, session=None):
+        """Record this package (and its dependencies) in the database.
+
+        With a :class:`.Session` the writes are queued on it, and so the ID
+        is not known until it is flushed.
+
+        """
+
         if self.virtual:
             raise RuntimeError('cannot persist virtual package')
         self._set_names(package=True, build=True, install=True)
         if not self.installed:
             log.warning('%s does not appear to be installed to %s' % (self.name, self.install_path))
             raise ValueError('cannot record requirement that is not installed')
-        con = con or self.home.db.connect()
-        with con:
-            exists = self.id is not None
-            res = super(Package, self).persist_in_db(con=con)
-            if exists:
-                con.execute('DELETE FROM package_dependencies WHERE depender_id = ?', [self.id])
-            for dep in self.dependencies:
-                dep_id = dep.id_or_persist(con=con)
-                log.debug('Recorded %s -> %s dependency as %d' % (
-                    self.name, dep.name, dep_id
-                ))
-                con.execute('INSERT INTO package_dependencies (depender_id, dependee_id) VALUES (?, ?)', [
-                    self.id, dep_id
-                ])
-            return res
+
+        if session is None:
+            session = Session(self.home.db)
+            self.persist_in_db(session=session)
+            session.flush(con)
+            return self.id
+
+        if self.id is not None:
+            session.execute('DELETE FROM package_dependencies WHERE depender_id = ?', [self])
+            session.execute('DELETE FROM package_provisions WHERE package_id = ?', [self])
+        session.add(self)
+        for name, value in self.provides.items():
+            session.insert('package_provisions', {
+                'package_id': self,
+                'name': name,
+                'value': None if value is None else str(value),
+            })
+        for dep in self.dependencies:
+            if dep.id is None and not session.has_object(dep):
+                dep.persist_in_db(session=session)
+            log.debug('Recording %s -> %s dependency' % (self.name, dep.name))
+            session.insert('package_dependencies', {'depender_id': self, 'dependee_id': dep})
+        return self.id
 
     def resolve_existing(self, env=None, weak=False):
         """Check against the database to see if this was already installed."""
@@ -712,15 +739,20 @@ class Package(DBObject):
         
         else:
 
+            filters = self._existing_filters(weak)
             clauses = ['install_path IS NOT NULL']
-            values = []
-            if not weak and self.url:
-                clauses.append('url = ?')
-                values.append(self.url)
-            for name in ('name', 'etag', 'install_name'):
-                if getattr(self, name):
-                    clauses.append('%s = ?' % name)
-                    values.append(getattr(self, name))
+            clauses.extend('%s = ?' % name for name, _ in filters)
+            values = [value for _, value in filters]
+            for name, value, prefix in self._existing_provisions():
+                clauses.append('''EXISTS (
+                    SELECT 1 FROM package_provisions AS pp
+                    WHERE pp.package_id = packages.id AND pp.name = ? AND %s
+                )''' % (
+                    '(substr(pp.value, 1, length(?)) = ? OR substr(?, 1, length(pp.value)) = pp.value)'
+                    if prefix else 'pp.value = ?'
+                ))
+                values.append(name)
+                values.extend([value] * (3 if prefix else 1))
             clause = ' AND '.join(clauses)
 
             # log.debug('SELECT FROM packages WHERE %s' % ' AND '.join('%s = %r' % (c.replace(' = ?', ''), v) for c, v in zip(clauses[1:], values)), verbosity=2)
@@ -740,7 +772,57 @@ class Package(DBObject):
                     ORDER BY packages.created_at DESC
                 ''' % clause, values)
         
-        for row in cur:
+        row = self._match_existing(cur)
+        if row is None:
+            if deferred:
+                raise ValueError('deferred package %d no longer exists; consider `vee gc`' % deferred_id)
+            return
+
+        self._restore_existing(row, env=env, weak=weak, cursor=cur)
+        return True
+
+    def _existing_filters(self, weak=False):
+        """The ``(column, value)`` pairs that an existing package must match."""
+        filters = []
+        if not weak and self.url:
+            filters.append(('url', self.url))
+        for name in ('name', 'etag', 'install_name'):
+            if getattr(self, name):
+                filters.append((name, getattr(self, name)))
+        return filters
+
+    def _existing_provisions(self):
+        """The ``(name, value, prefix)`` provisions an existing package must have.
+
+        Values are normalized as in the ``package_provisions`` table. Git
+        revisions may be abbreviated, so they match (when ``prefix``) if
+        either is a prefix of the other. These only narrow down the candidates
+        for :meth:`_match_existing`, which has the final say.
+
+        """
+        return [
+            (name, str(value), bool(value.git_rev))
+            for name, value in self.provides.items()
+            if value is not None
+        ]
+
+    def _has_provisions(self, provisions, wanted=None):
+        """Might the given ``{name: value}`` normalized provisions satisfy us?"""
+        for name, value, prefix in (self._existing_provisions() if wanted is None else wanted):
+            have = provisions.get(name)
+            if have is None:
+                return False
+            if prefix:
+                if not (have.startswith(value) or value.startswith(have)):
+                    return False
+            elif have != value:
+                return False
+        return True
+
+    def _match_existing(self, rows, exists=os.path.exists):
+        """Pick the first of the candidate rows that satisfies us."""
+
+        for row in rows:
             
             # Make sure it has enough provisions.
             provides = Provision(row['provides'])
@@ -754,7 +836,7 @@ class Package(DBObject):
                 continue
 
             # Make sure it has enough requirements.
-            requires = RequirementSet(row['requires'])
+            requires = RequirementSet(row['requires']) if self.requires else None
             reqs_ok = True
             for name in self.requires:
                 try:
@@ -773,15 +855,12 @@ class Package(DBObject):
                     self.requires,
                 ), verbosity=2)
 
-            if not os.path.exists(row['install_path']):
+            if not exists(row['install_path']):
                 log.warning('Found %s (%d) does not exist at %s' % (self.name or row['name'], row['id'], row['install_path']))
                 continue
-            break
-        else:
+            return row
 
-            if deferred:
-                raise ValueError('deferred package %d no longer exists; consider `vee gc`' % deferred_id)
-            return
+    def _restore_existing(self, row, env=None, weak=False, cursor=None, dependee_ids=None):
 
         log.debug('Found %s (%d%s%s) at %s' % (
             self.name or row['name'],
@@ -791,33 +870,40 @@ class Package(DBObject):
             row['install_path'],
         ))
 
+        deferred = self.url.startswith('deferred:')
+
         self.restore_from_row(row)
         self.link_id = row.get('link_id')
 
         if deferred:
             self._init_pipeline()
 
-        self._load_dependencies(cur)
-
-        return True
+        self._load_dependencies(cursor, dependee_ids)
 
-    def _load_dependencies(self, cursor=None):
+    def _load_dependencies(self, cursor=None, dependee_ids=None):
 
         if self.dependencies:
             raise ValueError('dependencies already loaded')
 
-        cur = cursor or self.home.db.cursor()
+        if dependee_ids is None:
+            cur = cursor or self.home.db.cursor()
+            cur.execute('SELECT dependee_id from package_dependencies WHERE depender_id = ?', [self.id])
+            dependee_ids = [row['dependee_id'] for row in cur]
 
         # Set up weak references to dependencies. 
-        cur.execute('SELECT dependee_id from package_dependencies WHERE depender_id = ?', [self.id])
-        for row in cur:
+        for dependee_id in dependee_ids:
             self.dependencies.append(Package(
-                url='deferred:%d' % row['dependee_id'],
+                url='deferred:%d' % dependee_id,
                 source=self,
                 home=self.home,
             ))
 
-    def _record_link(self, env):
+    def _record_link(self, env, session=None):
+        if session is not None:
+            if self.id is None and not session.has_object(self):
+                self.persist_in_db(session=session)
+            session.insert('links', {'package_id': self, 'environment_id': env.id_or_persist()})
+            return
         cur = self.home.db.cursor()
         cur.execute('''INSERT INTO links (package_id, environment_id) VALUES (?, ?)''', [
             self.id_or_persist(),
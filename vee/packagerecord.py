@@ -0,0 +1,218 @@
+import os
+import re
+
+from vee.database import chunks
+from vee.provision import Provision
+from vee.requirement import RequirementSet
+
+
+class PackageRecord(object):
+
+    """A read-only view of a row in the ``packages`` table.
+
+    This is for when we only need to look at what is installed (e.g. ``vee
+    list``), for which a :class:`.Package` is very expensive: it populates
+    every argument, loads metadata, and initializes its pipeline. Use
+    :meth:`to_package` when a pipeline is actually needed.
+
+    """
+
+    __slots__ = (
+        'home', 'id', 'created_at', 'url', 'name', 'etag',
+        'package_name', 'build_name', 'install_name',
+        'package_path', 'build_path', 'install_path',
+        '_raw_provides', '_raw_requires', '_provides', '_requires',
+        '_dependency_ids', '_dependencies',
+    )
+
+    # The columns we read, and the slots they go in.
+    _columns = (
+        'id', 'created_at', 'url', 'name', 'etag',
+        'package_name', 'build_name', 'install_name',
+        'package_path', 'build_path', 'install_path',
+        'provides', 'requires',
+    )
+    _attrs = _columns[:-2] + ('_raw_provides', '_raw_requires')
+    _select = 'SELECT %s FROM packages' % ', '.join(_columns)
+
+    def __init__(self, home, values, dependency_ids=None):
+        set_ = object.__setattr__
+        set_(self, 'home', home)
+        for name, value in zip(self._attrs, values):
+            set_(self, name, value)
+        set_(self, '_provides', None)
+        set_(self, '_requires', None)
+        set_(self, '_dependency_ids', dependency_ids)
+        set_(self, '_dependencies', None)
+
+    @classmethod
+    def _execute(cls, home, where='', params=()):
+        # Plain tuples are much faster than our rows.
+        cur = home.db.connect().cursor()
+        cur.row_factory = None
+        return cur.execute('%s %s' % (cls._select, where), params)
+
+    @classmethod
+    def _execute_in(cls, home, ids):
+        # A chunk at a time, since SQLite limits the number of parameters.
+        for chunk in chunks(ids):
+            for values in cls._execute(home, 'WHERE id IN (%s)' % ','.join('?' * len(chunk)), chunk):
+                yield values
+
+    def __setattr__(self, name, value):
+        raise AttributeError('%s is read-only' % self.__class__.__name__)
+
+    @classmethod
+    def get(cls, home, id_):
+        values = cls._execute(home, 'WHERE id = ?', [id_]).fetchone()
+        if values is None:
+            raise KeyError(id_)
+        return cls(home, values)
+
+    @classmethod
+    def find(cls, home, name=None, url=None):
+        """Get the newest installed package by name and/or URL, or None."""
+
+        clauses = ['install_path IS NOT NULL']
+        values = []
+        for column, value in (('name', name), ('url', url)):
+            if value:
+                clauses.append('%s = ?' % column)
+                values.append(value)
+
+        for row in cls._execute(home, 'WHERE %s ORDER BY created_at DESC, id DESC' % ' AND '.join(clauses), values):
+            record = cls(home, row)
+            if os.path.exists(record.install_path):
+                return record
+
+    @classmethod
+    def load(cls, home, package_ids):
+        """Get the given packages (without their dependencies wired up)."""
+        return [cls(home, row) for row in cls._execute_in(home, package_ids)]
+
+    @classmethod
+    def load_all(cls, home):
+        """Get every package (newest first), with their dependencies wired up.
+
+        This is two queries no matter how many packages there are.
+
+        """
+        records = list(cls._execute(home, 'ORDER BY created_at DESC, id DESC'))
+        return cls._wire(home, records, home.db.get_dependencies())
+
+    @classmethod
+    def load_closure(cls, home, package_ids):
+        """Get the given packages and all of their dependencies, wired up.
+
+        The records of the given packages come first (in the given order).
+
+        """
+
+        package_ids = list(package_ids)
+        edges = home.db.get_dependencies(package_ids)
+
+        ids = list(package_ids)
+        seen = set(ids)
+        for _, dependee_id in edges:
+            if dependee_id not in seen:
+                seen.add(dependee_id)
+                ids.append(dependee_id)
+
+        by_id = dict((row[0], row) for row in cls._execute_in(home, ids))
+        return cls._wire(home, [by_id[id_] for id_ in ids if id_ in by_id], edges)
+
+    @classmethod
+    def _wire(cls, home, rows, edges):
+
+        dependency_ids = {}
+        for depender_id, dependee_id in edges:
+            dependency_ids.setdefault(depender_id, []).append(dependee_id)
+
+        records = [cls(home, row, dependency_ids.get(row[0], ())) for row in rows]
+
+        by_id = dict((record.id, record) for record in records)
+        for record in records:
+            object.__setattr__(record, '_dependencies', [
+                by_id[id_] for id_ in record._dependency_ids if id_ in by_id
+            ])
+
+        return records
+
+    @property
+    def provides(self):
+        if self._provides is None:
+            object.__setattr__(self, '_provides', Provision(self._raw_provides))
+        return self._provides
+
+    @property
+    def requires(self):
+        if self._requires is None:
+            object.__setattr__(self, '_requires', RequirementSet(self._raw_requires))
+        return self._requires
+
+    @property
+    def version(self):
+        x = self.provides.get('version')
+        return None if x is None else str(x)
+
+    @property
+    def dependencies(self):
+        if self._dependencies is None:
+            if self._dependency_ids is None:
+                object.__setattr__(self, '_dependency_ids', [row[0] for row in self.home.db.execute(
+                    'SELECT dependee_id FROM package_dependencies WHERE depender_id = ? ORDER BY id',
+                    [self.id],
+                )])
+            object.__setattr__(self, '_dependencies', [self.get(self.home, id_) for id_ in self._dependency_ids])
+        return self._dependencies
+
+    def to_args(self):
+        """The requirement arguments that would describe this package.
+
+        This is the subset of :meth:`.Package.to_args` which is recorded.
+
+        """
+
+        argsets = []
+
+        if self.name:
+            argsets.append(('--name', self.name))
+        if len(self.provides) == 1 and self.version:
+            argsets.append(('--version', self.version))
+        elif self.provides:
+            argsets.append(('--provides', str(self.provides)))
+        if self.requires:
+            argsets.append(('--requires', str(self.requires)))
+        if self.etag:
+            argsets.append(('--etag', self.etag))
+        if self.install_name:
+            argsets.append(('--install-name', self.install_name))
+
+        args = [self.url]
+        for option_str, value in sorted(argsets):
+            # Shell escape!
+            if re.search(r'\s', value):
+                value = "'%s'" % value.replace("'", "''")
+            args.append('%s=%s' % (option_str, value))
+        return args
+
+    def __str__(self):
+        return ' '.join(self.to_args())
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, str(self))
+
+    def to_package(self, context=None):
+        """Get a full :class:`.Package` for this record."""
+
+        # Imported here since Package is the heavy thing we are avoiding.
+        from vee.manifest import Manifest
+        from vee.package import Package
+
+        pkg = Package(
+            url='deferred:%d' % self.id,
+            home=self.home,
+            context=context or Manifest(home=self.home),
+        )
+        pkg.resolve_existing()
+        return pkg
@@ -1,14 +1,145 @@
 from __future__ import print_function
 
 import collections
+import concurrent.futures
+import os
+import threading
 
 from vee.package import Package
 from vee.exceptions import AlreadyInstalled, AlreadyLinked, PipelineError, print_cli_exc
 from vee import log
-from vee.cli import style
+from vee.cli import style, style_note
+from vee.database import Session, chunks
+from vee.linkplan import LinkPlan
 from vee.utils import guess_name
 
 
+class ExistingIndex(object):
+
+    """Installed packages which might satisfy a set of requirements.
+
+    This is the bulk equivalent of :meth:`.Package.resolve_existing`: every
+    candidate row (by name) is loaded up front, along with the environment's
+    links and the candidates' dependencies, and the existence of their
+    install paths is checked concurrently (since they are often on NFS).
+    Resolving a package is then done in memory.
+
+    """
+
+    def __init__(self, home, reqs, env=None, weak=False, jobs=16):
+
+        self.home = home
+        self.env = env
+
+        con = home.db.connect()
+        names = set(req.name or guess_name(req.url) for req in reqs)
+
+        # Newest first, just as resolve_existing orders them.
+        self.rows = {}
+        for chunk in chunks(sorted(names)):
+            for row in con.execute('''
+                SELECT * FROM packages
+                WHERE install_path IS NOT NULL AND name IN (%s)
+            ''' % ','.join('?' * len(chunk)), chunk):
+                self.rows.setdefault(row['name'], []).append(dict(zip(row.keys(), row)))
+        for rows in self.rows.values():
+            rows.sort(key=lambda row: (row['created_at'], row['id']), reverse=True)
+
+        # Normalized provisions, so that variants may be ruled out without
+        # parsing them.
+        self.provisions = {}
+        for chunk in chunks(sorted(names)):
+            for package_id, name, value in con.execute('''
+                SELECT package_id, package_provisions.name, value FROM package_provisions
+                JOIN packages ON packages.id = package_id
+                WHERE install_path IS NOT NULL AND packages.name IN (%s)
+            ''' % ','.join('?' * len(chunk)), chunk):
+                self.provisions.setdefault(package_id, {})[name] = value
+
+        # The most recent link of each package into the environment.
+        self.links = {}
+        if env is not None:
+            for row in con.execute('''
+                SELECT id, package_id, created_at FROM links
+                WHERE environment_id = ?
+                ORDER BY created_at, id
+            ''', [env.id_or_persist()]):
+                self.links[row['package_id']] = (row['created_at'], row['id'])
+
+        # Only the rows which could match will ever be looked at.
+        candidates = {}
+        for req in reqs:
+            filters = req._existing_filters(weak)
+            wanted = req._existing_provisions()
+            for row in self.rows.get(req.name or guess_name(req.url), ()):
+                if self._matches(req, row, filters, wanted):
+                    candidates[row['id']] = row
+
+        self.dependencies = dict((id_, []) for id_ in candidates)
+        for chunk in chunks(sorted(candidates)):
+            for row in con.execute('''
+                SELECT depender_id, dependee_id FROM package_dependencies
+                WHERE depender_id IN (%s)
+                ORDER BY id
+            ''' % ','.join('?' * len(chunk)), chunk):
+                self.dependencies[row['depender_id']].append(row['dependee_id'])
+
+        paths = sorted(set(row['install_path'] for row in candidates.values()))
+        if len(paths) > 1 and jobs > 1:
+            with concurrent.futures.ThreadPoolExecutor(min(jobs, len(paths))) as executor:
+                self.exists = dict(zip(paths, executor.map(os.path.exists, paths)))
+        else:
+            self.exists = dict((path, os.path.exists(path)) for path in paths)
+
+    def _exists(self, path):
+        try:
+            return self.exists[path]
+        except KeyError:
+            return os.path.exists(path)
+
+    def _matches(self, pkg, row, filters, wanted):
+        return (
+            all(row[key] == value for key, value in filters) and
+            pkg._has_provisions(self.provisions.get(row['id'], {}), wanted)
+        )
+
+    def resolve(self, pkg, weak=False):
+        """Restore the package from the best existing row.
+
+        This looks (in order) for one linked into the environment, then for
+        any at all, then (if ``weak``) for any with a different URL.
+
+        """
+
+        if pkg.id is not None:
+            raise ValueError('requirement already in database')
+
+        rows = self.rows.get(pkg.name, ())
+
+        passes = []
+        filters = pkg._existing_filters()
+        wanted = pkg._existing_provisions()
+        if self.env is not None:
+            linked = []
+            for row in rows:
+                link = self.links.get(row['id'])
+                if link and self._matches(pkg, row, filters, wanted):
+                    linked.append((link, dict(row, link_id=link[1])))
+            linked.sort(key=lambda x: x[0], reverse=True)
+            passes.append((self.env, False, [row for _, row in linked]))
+        passes.append((None, False, [row for row in rows if self._matches(pkg, row, filters, wanted)]))
+        if weak:
+            filters = pkg._existing_filters(weak=True)
+            passes.append((None, True, [row for row in rows if self._matches(pkg, row, filters, wanted)]))
+
+        for env, weak_pass, candidates in passes:
+            row = pkg._match_existing(candidates, exists=self._exists)
+            if row is not None:
+                dependee_ids = self.dependencies.get(row['id'])
+                pkg._restore_existing(row, env=env, weak=weak_pass, dependee_ids=dependee_ids)
+                return True
+
+
 class PackageSet(collections.OrderedDict):
 
     def __init__(self, env=None, home=None):
@@ -25,7 +156,20 @@ class PackageSet(collections.OrderedDict):
         self._linked = set()
         self._errored = set()
 
+        # Database writes and links while installing; see install.
+        self._session = None
+        self._link_plan = None
+        self._planned_links = []
+
+        # Guards resolution (and the mapping itself) while installing
+        # concurrently.
+        self._lock = threading.RLock()
+
     def resolve(self, req, check_existing=True, weak=False, env=None):
+        with self._lock:
+            return self._resolve(req, check_existing, weak, env)
+
+    def _resolve(self, req, check_existing, weak, env, existing=None):
 
         # We may need to guess a name.
         name = req.name or guess_name(req.url)
@@ -43,7 +187,9 @@ class PackageSet(collections.OrderedDict):
         # deferred packages will definitely be wrong).
         pkg.name = pkg.name or name
 
-        if check_existing:
+        if existing is not None and not pkg.url.startswith('deferred:'):
+            existing.resolve(pkg, weak)
+        elif check_existing:
             (
                 pkg.resolve_existing(env=env or self.env) or
                 pkg.resolve_existing() or
@@ -55,11 +201,83 @@ class PackageSet(collections.OrderedDict):
         self[pkg.name] = pkg
         return pkg
     
-    def resolve_set(self, req_set, **kwargs):
-        for req in req_set.iter_packages():
-            self.resolve(req, **kwargs)
+    def resolve_set(self, req_set, check_existing=True, weak=False, env=None):
+        """Resolve every package in the given manifest.
+
+        Existing packages are looked up for the whole set at once (see
+        :class:`ExistingIndex`), rather than with a few queries each.
+
+        """
+
+        reqs = list(req_set.iter_packages())
+        with self._lock:
+            existing = None
+            if check_existing and reqs:
+                existing = ExistingIndex(self.home or reqs[0].home, reqs, env=env or self.env, weak=weak)
+            for req in reqs:
+                self._resolve(req, check_existing, weak, env, existing)
+
+    def prefetch(self, names=None, reinstall=False, jobs=8):
+        """Fetch the named packages concurrently, ahead of installing them.
+
+        At most ``jobs`` packages are fetched at once, and at most
+        ``fetch_concurrency`` (from the fetch step) of any one transport.
+        Packages which are already installed are skipped (unless reinstalling),
+        as are dependencies, since we don't know about them until inspection.
+
+        """
+
+        if isinstance(names, str):
+            names = [names]
+        names = list(names if names else self.keys())
+
+        todo = []
+        semaphores = {}
+        for name in names:
+            pkg = self[name]
+            if name in self._extracted or name in self._errored or pkg.pipeline.has_run('fetch'):
+                continue
+            if pkg.installed and not reinstall:
+                continue
+            # Keyed by class, since some steps set their own name.
+            cls = pkg.pipeline.load('fetch').__class__
+            semaphore = semaphores.get(cls)
+            if semaphore is None:
+                semaphore = semaphores[cls] = threading.BoundedSemaphore(cls.fetch_concurrency)
+            todo.append((pkg, semaphore))
+
+        if not todo:
+            return
+
+        log.info(style_note('Fetching %d packages' % len(todo)))
+        with concurrent.futures.ThreadPoolExecutor(max(1, jobs)) as executor:
+            for future in [executor.submit(self._prefetch_one, *x) for x in todo]:
+                future.result()
+
+    def _prefetch_one(self, pkg, semaphore):
+        with semaphore, log.group():
+            log.info('==>', style(pkg.name, 'blue'), style('(fetch)', faint=True))
+            with log.indent():
+                try:
+                    pkg.pipeline.run_to('fetch')
+                except Exception as e:
+                    self._errored.add(pkg.name)
+                    print_cli_exc(e, verbose=True)
+                    log.exception('Exception while fetching %s' % pkg.name)
 
-    def install(self, names=None, link_env=None, reinstall=False, relink=False, no_deps=False):
+    def install(self, names=None, link_env=None, reinstall=False, relink=False, no_deps=False, jobs=1, conflicts='first'):
+        """Install (and optionally link) the named packages, and their dependencies.
+
+        Dependencies are discovered as packages are inspected, so the graph is
+        built as we go: whenever a package finds that it must wait on others,
+        it is parked until they are done. Packages that are not waiting on
+        anything are run on a pool of ``jobs`` workers; with more than one,
+        each package's output is buffered and written as a single block.
+
+        Links are all made at the end, with paths that more than one package
+        claims resolved by the ``conflicts`` policy (see :class:`.LinkPlan`).
+
+        """
 
         # I'd love to split this method into an "install" and "link" step, but
         # then we'd need to reimplement the dependency resolution. That would
@@ -78,11 +296,106 @@ class PackageSet(collections.OrderedDict):
         if not isinstance(relink, set):
             relink    = set(names if no_deps else self.keys()) if relink    else set()
 
-        while names:
-            name = names.pop(0)
+        jobs = max(1, jobs or 1)
+        args = (link_env, reinstall, relink, no_deps)
+
+        # Each package, its dependencies, and libraries are recorded in one
+        # batch (rather than in a few transactions each).
+        self._session = Session(self.home.db)
 
+        # Links are planned as packages are installed, and made all at once
+        # at the end (since later packages often share directories with
+        # earlier ones); they are recorded only once they are made.
+        self._link_plan = LinkPlan(link_env, conflicts) if link_env else None
+        self._planned_links = []
+
+        ready = collections.deque(names)
+        waiting = collections.OrderedDict() # name -> names it is waiting on
+        running = {} # future -> name
+
+        executor = concurrent.futures.ThreadPoolExecutor(jobs) if jobs > 1 else None
+        try:
+            while ready or running or waiting:
+
+                while ready and len(running) < jobs:
+                    name = ready.popleft()
+                    # Anything already in flight will be looked at again.
+                    if name in waiting or name in running.values():
+                        continue
+                    if executor:
+                        future = executor.submit(self._install_grouped, name, *args)
+                        running[future] = name
+                    else:
+                        requeued = self._install_next(name, *args)
+                        self._schedule(name, requeued, ready, waiting, running)
+
+                if running:
+                    done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        name = running.pop(future)
+                        self._schedule(name, future.result(), ready, waiting, running)
+
+                elif waiting and not ready:
+                    # Everything left is waiting on something else, so there
+                    # must be a dependency cycle. Let the oldest one through,
+                    # since we assume the requirements file has the right order.
+                    name, _ = waiting.popitem(last=False)
+                    log.debug('%s is in a dependency cycle; continuing anyways' % name)
+                    ready.appendleft(name)
+
+        finally:
+            if executor:
+                executor.shutdown()
+
+        # Only on the way out normally, so that an interrupted (or crashed)
+        # install never makes half of its links.
+        self._session.flush()
+        if self._link_plan is not None and self._link_plan.count:
+            # Only what actually made it to disk is recorded.
+            self._link_plan.apply()
+            for pkg in self._planned_links:
+                pkg._record_link(link_env, self._session)
+            self._session.flush()
+
+        if self._errored:
+            log.warning('There were errors in: %s' % ', '.join(sorted(self._errored)))
+
+    def _schedule(self, name, requeued, ready, waiting, running):
+
+        # The package may have asked to be looked at again after everything it
+        # put in front of itself.
+        if name in requeued:
+            needs = requeued[:requeued.index(name)]
+            blocking = set(needs)
+            if blocking:
+                waiting[name] = blocking
+            else:
+                ready.appendleft(name)
+
+        else:
+            needs = requeued
+            # Anything that was only waiting on this one may now continue.
+            released = []
+            for other, blocking in list(waiting.items()):
+                blocking.discard(name)
+                if not blocking:
+                    del waiting[other]
+                    released.append(other)
+            ready.extendleft(reversed(released))
+
+        in_flight = set(running.values())
+        ready.extendleft(reversed([x for x in needs if x not in waiting and x not in in_flight]))
+
+    def _install_grouped(self, name, *args):
+        with log.group():
+            return self._install_next(name, *args)
+
+    def _install_next(self, name, link_env, reinstall, relink, no_deps):
+
+        requeued = []
+
+        with self._lock:
             self._parent_names.setdefault(name, None)
-            
             parent_chain = []
             tip = name
             while tip and tip not in parent_chain:
@@ -90,30 +403,26 @@ class PackageSet(collections.OrderedDict):
                 tip = self._parent_names.get(tip)
             parent_chain = parent_chain[1:]
 
-            print('==>', style(name, 'blue'), style('(%s)' % ' < '.join(parent_chain), faint=True) if parent_chain else '')
+        log.info('==>', style(name, 'blue'), style('(%s)' % ' < '.join(parent_chain), faint=True) if parent_chain else '')
 
-            with log.indent():
+        with log.indent():
 
-                # Avoid infinite error loops.
-                if name in self._errored:
-                    log.warning('Skipping due to previous error.')
-                    continue
+            # Avoid infinite error loops.
+            if name in self._errored:
+                log.warning('Skipping due to previous error.')
+                return requeued
 
-                try:
-                    self._install_one(names, name, link_env, reinstall, relink, no_deps)
-                except PipelineError as e:
-                    self._errored.add(name)
-                    log.error(str(e))
-                    continue
-                except Exception as e:
-                    self._errored.add(name)
-                    print_cli_exc(e, verbose=True)
-                    log.exception('Exception while processing %s' % name)
-                    continue
-
-        if self._errored:
-            log.warning('There were errors in: %s' % ', '.join(sorted(self._errored)))
+            try:
+                self._install_one(requeued, name, link_env, reinstall, relink, no_deps)
+            except PipelineError as e:
+                self._errored.add(name)
+                log.error(str(e))
+            except Exception as e:
+                self._errored.add(name)
+                print_cli_exc(e, verbose=True)
+                log.exception('Exception while processing %s' % name)
 
+        return requeued
 
     def _install_one(self, names, name, link_env, reinstall, relink, no_deps):
 
@@ -126,12 +435,16 @@ class PackageSet(collections.OrderedDict):
         reinstall_this = name in reinstall
         relink_this    = name in relink
 
+        # Reinstalls start from scratch, rather than from a checkpoint.
+        pkg.pipeline.resume = not reinstall_this
+
         if name not in self._extracted:
             try:
                 # Between every step, take a look to see if we now have
                 # enough information to tell that it is already installed.
                 pkg.assert_uninstalled(uninstall=reinstall_this)
-                pkg.pipeline.run_to('fetch')
+                if not pkg.pipeline.has_run('fetch'): # May have been prefetched.
+                    pkg.pipeline.run_to('fetch')
                 pkg.assert_uninstalled(uninstall=reinstall_this)
                 pkg.pipeline.run_to('extract')
                 pkg.assert_uninstalled(uninstall=reinstall_this)
@@ -188,8 +501,24 @@ class PackageSet(collections.OrderedDict):
 
         if name not in self._installed:
             try:
-                pkg.pipeline.run_to('build')
-                pkg.pipeline.run_to('install')
+                cache = self.home.build_cache
+                key = cache and cache.get_key(pkg)
+                if key and cache.restore(pkg, key):
+                    pkg.pipeline.skip_to('relocate')
+                else:
+                    pkg.pipeline.run_to('build')
+                    pkg.pipeline.run_to('install')
+                    pkg.pipeline.run_to('post_install')
+                    if key:
+                        cache.store(pkg, key)
+                # Relocation may look for the libraries of anything before.
+                # The session is shared, so only flush it between packages.
+                with self._lock:
+                    try:
+                        self._session.flush()
+                    except:
+                        self._session.discard()
+                        raise
                 pkg.pipeline.run_to('relocate')
             except AlreadyInstalled:
                 pass
@@ -217,15 +546,23 @@ class PackageSet(collections.OrderedDict):
                 names.insert(insert_i, name)
                 return
 
-            pkg.persist_in_db()
-            pkg.shared_libraries() # TODO: Move this earlier?
+            # The environment is shared, so the rest is one package at a time,
+            # in its own transaction (so a failure only loses this package).
+            with self._lock:
+                pkg.persist_in_db(session=self._session)
+                pkg.shared_libraries(session=self._session) # TODO: Move this earlier?
+                try:
+                    self._session.flush()
+                except:
+                    self._session.discard()
+                    raise
             self._persisted.add(name)
 
         if link_env and name not in self._linked:
-            try:
-                pkg.link(link_env, force=relink_this)
-            except AlreadyLinked:
-                pass
+            with self._lock:
+                try:
+                    pkg.link(link_env, force=relink_this, session=self._session, plan=self._link_plan)
+                    self._planned_links.append(pkg)
+                except AlreadyLinked:
+                    pass
             self._linked.add(name)
-
-
@@ -10,6 +10,8 @@ from vee.utils import assert_file_checksum
 class ArchiveExtractor(PipelineStep):
 
     factory_priority = 2000
+    factory_steps = ('extract', )
+    resumable_steps = ('extract', )
 
     @classmethod
     def factory(cls, step, pkg):
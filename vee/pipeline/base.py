@@ -1,10 +1,41 @@
-import pkg_resources
+import datetime
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
 
 from vee import log
+from vee import registry
+from vee.cli import style_note
+from vee.exceptions import AlreadyInstalled
+from vee.subproc import child_usage
+
+
+_step_entries = []
+
+# Package attributes which resumable steps set, and so are restored with them.
+_checkpoint_attrs = ('build_name', 'build_path', 'build_subdir', 'install_prefix')
+
+# Identifies this invocation in the pipeline_timings table.
+_run = '%s/%d' % (datetime.datetime.utcnow().strftime('%Y%m%d%H%M%S'), os.getpid())
+
 
+def _thread_bytes_written():
+    # Only Linux can tell us about a single thread.
+    if resource is not None and hasattr(resource, 'RUSAGE_THREAD'):
+        return resource.getrusage(resource.RUSAGE_THREAD).ru_oublock * 512
+    return 0
 
-_step_classes = []
-_step_classes_by_name = {}
+
+def _usage():
+    cpu_time, bytes_written = child_usage()
+    return time.time(), cpu_time, bytes_written + _thread_bytes_written()
 
 
 class Pipeline(object):
@@ -15,6 +46,12 @@ class Pipeline(object):
         self._step_indices = dict((name, i) for i, name in enumerate(self._step_names))
         self._have_run = set()
         self._steps = {}
+        self._timings = []
+
+        # Set to False to discard any checkpoint instead of resuming from it.
+        self.resume = True
+        self._checkpoint_key = None
+        self._checkpoint_steps = []
 
     def copy(self, package):
         copy = self.__class__(package, self._step_names)
@@ -22,6 +59,16 @@ class Pipeline(object):
         copy._steps = self._steps.copy()
         return copy
 
+    def has_run(self, name):
+        return name in self._have_run
+
+    def skip_to(self, name):
+        """Consider every step before the given one as run, without running them."""
+        index = self._step_indices[name]
+        self._have_run.update(self._step_names[:index])
+        if index > self._step_indices.get('install', index):
+            self._clear_checkpoint()
+
     def run_to(self, name, *args, **kwargs):
 
         if name in self._have_run:
@@ -30,10 +77,158 @@ class Pipeline(object):
         # Run everything up to here.
         index = self._step_indices[name]
         for name in self._step_names[:index + 1]:
+
+            # Extraction is the first step which a checkpoint may skip, and
+            # also when the package is (re)created in a build directory.
+            if name == 'extract' and name not in self._have_run:
+                self._load_checkpoint()
+
+            if name not in self._have_run and self._resume_step(name):
+                self._have_run.add(name)
+                continue
+
             if name not in self._have_run:
-                step = self.load(name)
-                step.run(name, self._package, *args, **kwargs)
+                start = _usage()
+                step = None
+                try:
+                    step = self.load(name)
+                    step.run(name, self._package, *args, **kwargs)
+                except AlreadyInstalled:
+                    self._record_timing(name, step, start)
+                    raise
+                except Exception:
+                    self._record_timing(name, step, start, failed=True)
+                    raise
+                self._record_timing(name, step, start)
                 self._have_run.add(name)
+                self._update_checkpoint(name, step)
+
+    def _get_checkpoint_key(self):
+        pkg = self._package
+        blob = json.dumps([pkg.url, pkg.package_path, pkg.to_args()])
+        return hashlib.sha1(blob.encode('utf8')).hexdigest()
+
+    def _load_checkpoint(self):
+
+        pkg = self._package
+        db = pkg.home.db
+        self._checkpoint_key = key = self._get_checkpoint_key()
+        self._checkpoint_steps = []
+
+        try:
+            con = db.connect()
+            if not self.resume:
+                with db.write_lock, con:
+                    con.execute('DELETE FROM pipeline_checkpoints WHERE key = ?', [key])
+                return
+            row = con.execute('SELECT steps, state FROM pipeline_checkpoints WHERE key = ?', [key]).fetchone()
+        except (sqlite3.Error, ValueError) as e:
+            log.warning('Could not load pipeline checkpoint: %s' % e)
+            return
+
+        if not row:
+            return
+
+        # We can only pick up where we left off if it is still there.
+        state = json.loads(row['state'])
+        if not state.get('build_path') or not os.path.isdir(state['build_path']):
+            log.debug('Checkpointed build of %s is gone from %s' % (pkg.name, state.get('build_path')))
+            return
+
+        for attr in _checkpoint_attrs:
+            setattr(pkg, attr, state.get(attr))
+        self._checkpoint_steps = row['steps'].split(',')
+
+    def _resume_step(self, name):
+        if name not in self._checkpoint_steps:
+            return False
+        step = self.load(name) # Later steps may come from it.
+        if name not in step.resumable_steps:
+            return False
+        log.info(style_note('Resuming after %s' % name, 'in ' + self._package.build_path))
+        return True
+
+    def _update_checkpoint(self, name, step):
+
+        if self._checkpoint_key is None:
+            return
+
+        # Once installed there is nothing left to resume.
+        if name == 'install':
+            self._clear_checkpoint()
+            return
+
+        resumable = name in step.resumable_steps
+        if not resumable and name not in self._checkpoint_steps:
+            return
+
+        # Anything after a step that has been re-run is invalid.
+        index = self._step_indices[name]
+        steps = [x for x in self._checkpoint_steps if self._step_indices[x] < index]
+        if resumable:
+            steps.append(name)
+        self._checkpoint_steps = steps
+
+        pkg = self._package
+        db = pkg.home.db
+        state = dict((attr, getattr(pkg, attr)) for attr in _checkpoint_attrs)
+        try:
+            con = db.connect()
+            with db.write_lock, con:
+                con.execute('''INSERT OR REPLACE INTO pipeline_checkpoints
+                    (key, name, url, steps, state, updated_at) VALUES (?, ?, ?, ?, ?, datetime('now'))
+                ''', [self._checkpoint_key, pkg.name, pkg.url, ','.join(steps), json.dumps(state)])
+        except (sqlite3.Error, ValueError) as e:
+            log.warning('Could not record pipeline checkpoint: %s' % e)
+
+    def _clear_checkpoint(self):
+
+        key, self._checkpoint_key = self._checkpoint_key, None
+        self._checkpoint_steps = []
+        if key is None:
+            return
+
+        db = self._package.home.db
+        try:
+            con = db.connect()
+            with db.write_lock, con:
+                con.execute('DELETE FROM pipeline_checkpoints WHERE key = ?', [key])
+        except (sqlite3.Error, ValueError) as e:
+            log.warning('Could not clear pipeline checkpoint: %s' % e)
+
+    def _record_timing(self, name, step, start, failed=False):
+
+        end = _usage()
+        pkg = self._package
+        self._timings.append((
+            _run,
+            pkg.name,
+            pkg.url,
+            name,
+            getattr(step.__class__, 'name', None),
+            end[0] - start[0],
+            end[1] - start[1],
+            end[2] - start[2],
+            int(failed),
+        ))
+
+        # Every package runs init, even when just listing them, so we wait
+        # for something more interesting to happen before writing.
+        if name != 'init':
+            self._flush_timings()
+
+    def _flush_timings(self):
+        rows, self._timings = self._timings, []
+        db = self._package.home.db
+        try:
+            con = db.connect()
+            with db.write_lock, con:
+                con.executemany('''INSERT INTO pipeline_timings
+                    (run, name, url, step, step_type, wall_time, cpu_time, bytes_written, failed)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ''', rows)
+        except (sqlite3.Error, ValueError) as e:
+            log.warning('Could not record pipeline timings: %s' % e)
 
     def load(self, step_name):
 
@@ -55,17 +250,19 @@ class Pipeline(object):
                 self._steps[step_name] = step
                 return step
 
-        # Load the step classes.
-        if not _step_classes:
-            for ep in pkg_resources.iter_entry_points('vee_pipeline_steps'):
-                cls = ep.load()
-                cls.name = ep.name
-                _step_classes.append(cls)
-                _step_classes_by_name[ep.name] = cls
-            _step_classes.sort(key=lambda cls: getattr(cls, 'factory_priority', 1), reverse=True)
-        
+        # Find the step classes (without importing them).
+        if not _step_entries:
+            entries = registry.get_entry_points('vee_pipeline_steps')
+            entries.sort(key=lambda ep: ep.hints.get('factory_priority', 1), reverse=True)
+            _step_entries[:] = entries
+
         # Find something that self-identifies it provides this step.
-        for cls in _step_classes:
+        for ep in _step_entries:
+            factory_steps = ep.hints.get('factory_steps')
+            if factory_steps is not None and step_name not in factory_steps:
+                continue
+            cls = ep.load()
+            cls.name = ep.name
             step = cls.factory(step_name, self._package)
             if step:
                 log.debug('%s factory built %s for %s' % (step.name, step_name, self._package), verbosity=2)
@@ -77,6 +274,18 @@ class Pipeline(object):
 
 class PipelineStep(object):
 
+    # Which steps our factory may provide; None means it may provide any.
+    # This is cached in the registry so that we only import the step classes
+    # which may match.
+    factory_steps = None
+
+    # How many packages may run this step's fetch at once.
+    fetch_concurrency = 1
+
+    # Which of our steps may be skipped when resuming an interrupted install,
+    # because their work is all in the (checkpointed) build path.
+    resumable_steps = ()
+
     @classmethod
     def factory(cls, pkg):
         raise NotImplementedError()
@@ -6,6 +6,7 @@ from vee.builtin import load_builtin
 class BuiltinLoader(PipelineStep):
     
     factory_priority = 9999
+    factory_steps = ('init', )
 
     @classmethod
     def factory(cls, step, pkg):
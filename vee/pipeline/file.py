@@ -12,6 +12,8 @@ from vee import log
 class FileTransport(PipelineStep):
     
     factory_priority = 100
+    factory_steps = ('init', 'extract')
+    resumable_steps = ('extract', )
 
     @classmethod
     def factory(cls, step, pkg):
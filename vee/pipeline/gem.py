@@ -12,6 +12,7 @@ from vee.package import Package
 class GemManager(PipelineStep):
 
     factory_priority = 1000
+    factory_steps = ('init', )
 
     @cached_property
     def system_gems(self):
@@ -6,15 +6,17 @@ from vee import libs
 from vee import log
 from vee.cli import style_note
 from vee.envvars import join_env_path
+from vee.filemanifest import FileManifest
 from vee.pipeline.base import PipelineStep
 from vee.subproc import call, bash_source
-from vee.utils import find_in_tree, linktree, makedirs, chmod
+from vee.utils import find_in_tree, linktree, makedirs
 from vee.homebrew import Homebrew
 
 
 class GenericBuilder(PipelineStep):
     
     factory_priority = 0
+    resumable_steps = ('build', )
 
     @classmethod
     def factory(cls, step, pkg):
@@ -55,8 +57,11 @@ class GenericBuilder(PipelineStep):
             shutil.copytree(pkg.build_path_to_install, pkg.install_path_from_build, symlinks=True)
 
     def post_install(self, pkg):
+        # Everything after this reads the manifest instead of walking.
+        manifest = FileManifest.scan(pkg.install_path)
         # TODO: Pull this from repository config (when that exists).
-        chmod(pkg.install_path, 'o-w', recurse=True)
+        manifest.chmod('o-w')
+        manifest.save()
 
     def relocate(self, pkg):
         relocate_package(pkg)
@@ -12,6 +12,8 @@ from vee.utils import makedirs, cached_property
 class GitTransport(PipelineStep):
 
     factory_priority = 1000
+    factory_steps = ('init', )
+    fetch_concurrency = 4
 
     @classmethod
     def factory(cls, step, pkg):
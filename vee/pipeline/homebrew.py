@@ -17,6 +17,7 @@ from vee.pipeline.generic import relocate_package
 class HomebrewManager(PipelineStep):
 
     factory_priority = 1000
+    factory_steps = ('init', 'relocate')
 
     @classmethod
     def factory(cls, step, pkg):
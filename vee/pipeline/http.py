@@ -1,4 +1,5 @@
 import datetime
+import json
 import os
 import re
 import shutil
@@ -14,6 +15,8 @@ from vee import log
 class HttpTransport(PipelineStep):
     
     factory_priority = 1000
+    factory_steps = ('init', )
+    fetch_concurrency = 8
 
     @classmethod
     def factory(cls, step, pkg):
@@ -49,20 +52,89 @@ class HttpTransport(PipelineStep):
 
 
 
+def _parse_content_range(value):
+    # E.g. "bytes 100-199/200"; we only care where it starts.
+    m = re.match(r'^\s*bytes\s+(\d+)-\d+/(?:\d+|\*)\s*$', value or '')
+    return int(m.group(1)) if m else None
+
+
+def _load_validator(path, url):
+    try:
+        with open(path) as fh:
+            meta = json.load(fh)
+    except (IOError, OSError, ValueError):
+        return
+    if meta.get('url') != url:
+        return
+    # Weak ETags can't be used in an If-Range.
+    etag = meta.get('etag')
+    if etag and not etag.startswith('W/'):
+        return etag
+    return meta.get('last_modified')
+
+
 def download(url, dst):
+    """Download a URL to the given path.
+
+    The transfer goes to ``<dst>.downloading`` (with the response's ETag or
+    Last-Modified beside it in ``<dst>.downloading.json``), so that if it is
+    interrupted the next attempt resumes from where it stopped with a
+    ``Range`` request. The ``If-Range`` validator makes sure that we only
+    resume the same file; otherwise, or if the server doesn't do ranges, we
+    get the whole thing again.
+
+    """
 
     makedirs(os.path.dirname(dst))
 
     tmp = dst + '.downloading'
+    meta_path = tmp + '.json'
+
+    offset = 0
+    headers = {}
+    if os.path.exists(tmp):
+        validator = _load_validator(meta_path, url)
+        offset = os.path.getsize(tmp) if validator else 0
+        if offset:
+            headers['Range'] = 'bytes=%d-' % offset
+            headers['If-Range'] = validator
 
     src_fh = None
     dst_fh = None
     try:
-        src_fh = http_request('GET', url, preload_content=False)
-        dst_fh = open(tmp, 'wb')
+
+        src_fh = http_request('GET', url, headers=headers, preload_content=False)
+
+        resume = bool(offset) and src_fh.status == 206 and _parse_content_range(src_fh.headers.get('Content-Range')) == offset
+        if not resume and src_fh.status in (206, 416):
+            # What we have can't be continued (e.g. it is already too long),
+            # or we didn't get the range we asked for.
+            log.debug('Could not resume; restarting download of %s' % url)
+            src_fh.close()
+            src_fh = http_request('GET', url, preload_content=False)
+
+        if src_fh.status >= 400:
+            raise ValueError('HTTP %d from %s' % (src_fh.status, url))
+
+        if resume:
+            log.info(style_note('Resuming download', 'from %d bytes' % offset))
+            dst_fh = open(tmp, 'ab')
+        else:
+            # Either we asked for everything, or the server gave it to us
+            # anyways (since it doesn't do ranges, or the file has changed);
+            # remember how to resume it.
+            with open(meta_path, 'w') as fh:
+                json.dump({
+                    'url': url,
+                    'etag': src_fh.headers.get('ETag'),
+                    'last_modified': src_fh.headers.get('Last-Modified'),
+                }, fh)
+            dst_fh = open(tmp, 'wb')
+
         # TODO: Indicate progress.
         for chunk in iter(lambda: src_fh.read(16384), b''):
             dst_fh.write(chunk)
+
     finally:
         if src_fh:
             src_fh.close()
@@ -70,3 +142,5 @@ def download(url, dst):
             dst_fh.close()
 
     shutil.move(tmp, dst)
+    if os.path.exists(meta_path):
+        os.unlink(meta_path)
@@ -10,6 +10,7 @@ from vee import log
 class MakeBuilder(GenericBuilder):
 
     factory_priority = 1000
+    factory_steps = ('build', 'install')
 
     @classmethod
     def factory(cls, step, pkg):
@@ -103,7 +104,7 @@ class MakeBuilder(GenericBuilder):
             log.info(style_note('make'))
 
             env = env or pkg.fresh_environ()
-            call(['make', '-j4'], cwd=os.path.dirname(self.makefile_path), env=env)
+            call(['make'], cwd=os.path.dirname(self.makefile_path), env=env, jobserver=True)
 
             pkg.build_subdir = os.path.dirname(self.makefile_path)
     
@@ -112,9 +113,10 @@ class MakeBuilder(GenericBuilder):
         pkg._assert_paths(install=True)
         log.info(style_note('make install'))
         if call(
-            ['make', 'install', '-j4'],
+            ['make', 'install'],
             cwd=os.path.dirname(self.makefile_path),
             env=pkg.fresh_environ(),
+            jobserver=True,
         ):
             raise RuntimeError('Could not `make install` package')
 
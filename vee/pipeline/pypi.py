@@ -42,6 +42,8 @@ print(json.dumps([(t.interpreter, t.abi, t.platform) for t in packaging.tags.sys
 class PyPiTransport(PipelineStep):
     
     factory_priority = 1000
+    factory_steps = ('init', )
+    fetch_concurrency = 8
 
     @classmethod
     def factory(cls, step, pkg):
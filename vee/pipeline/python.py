@@ -40,6 +40,7 @@ class DummyPipRequirement(object):
 class PythonBuilder(GenericBuilder):
 
     factory_priority = 5000
+    factory_steps = ('inspect', )
 
     @classmethod
     def factory(cls, step, pkg):
@@ -137,7 +138,7 @@ class PythonBuilder(GenericBuilder):
             cmd = ['build']
             cmd.extend(pkg.config)
 
-            res = call_setup_py(self.setup_path, cmd, env=pkg.fresh_environ(), indent=True, verbosity=1)
+            res = call_setup_py(self.setup_path, cmd, env=pkg.fresh_environ(), indent=True, verbosity=1, jobserver=True)
             if res:
                 raise RuntimeError('Could not build Python package')
 
@@ -185,7 +186,7 @@ class PythonBuilder(GenericBuilder):
         if not pkg.defer_setup_build:
             cmd.append('--skip-build')
         
-        res = call_setup_py(self.setup_path, cmd, env=env, indent=True, verbosity=1)
+        res = call_setup_py(self.setup_path, cmd, env=env, indent=True, verbosity=1, jobserver=pkg.defer_setup_build)
         if res:
             raise RuntimeError('Could not install Python package')
 
@@ -14,6 +14,7 @@ _installed_packages = set()
 class RPMChecker(PipelineStep):
 
     factory_priority = 1000
+    factory_steps = ('init', )
 
     @cached_property
     def installed_packages(self):
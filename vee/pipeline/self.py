@@ -13,6 +13,7 @@ from vee.utils import find_in_tree
 class SelfBuilder(GenericBuilder):
 
     factory_priority = 9000
+    factory_steps = ('inspect', 'build', 'install', 'develop')
 
     @classmethod
     def factory(cls, step, pkg):
@@ -93,7 +94,7 @@ class SelfBuilder(GenericBuilder):
         cwd = os.path.dirname(self.build_sh)
         envfile = os.path.join(cwd, 'vee-env-' + base64.b16encode(os.urandom(8)).decode())
 
-        call(['bash', '-c', '. %s; env | grep VEE > %s' % (os.path.basename(self.build_sh), envfile)], env=env, cwd=cwd)
+        call(['bash', '-c', '. %s; env | grep VEE > %s' % (os.path.basename(self.build_sh), envfile)], env=env, cwd=cwd, jobserver=True)
 
         env = list(open(envfile))
         env = dict(line.strip().split('=', 1) for line in env)
@@ -119,7 +120,7 @@ class SelfBuilder(GenericBuilder):
         cwd = os.path.dirname(self.install_sh)
 
         with log.indent():
-            call(['bash', '-c', 'source "%s" "%s"' % (self.install_sh, pkg.install_path)], env=env, cwd=cwd)
+            call(['bash', '-c', 'source "%s" "%s"' % (self.install_sh, pkg.install_path)], env=env, cwd=cwd, jobserver=True)
 
     def develop(self, pkg):
         
@@ -0,0 +1,208 @@
+"""Cached registry of our entry points (commands, and pipeline steps).
+
+Finding entry points means reading the metadata of every installed
+distribution (and ``pkg_resources`` is slow to even import), so we do it once
+and cache the result in ``$VEE_REGISTRY_CACHE`` (default
+``~/.cache/vee/registry-*.json``) until the installed distributions change.
+
+Pipeline steps also have some of their class attributes recorded, so that we
+know which steps they might provide without importing them.
+
+"""
+
+import hashlib
+import importlib
+import json
+import os
+import sys
+
+from vee import log
+
+
+# Bump this when the format of the cache changes.
+CACHE_VERSION = 1
+
+GROUPS = ('vee_commands', 'vee_pipeline_steps')
+
+# Attributes of the loaded objects to record in the cache.
+HINTS = {
+    'vee_pipeline_steps': ('factory_priority', 'factory_steps'),
+}
+
+
+class EntryPoint(object):
+
+    def __init__(self, name, value, hints=None):
+        self.name = name
+        self.value = value
+        self.hints = hints or {}
+        self._loaded = None
+
+    def __repr__(self):
+        return '<EntryPoint %s = %s>' % (self.name, self.value)
+
+    def load(self):
+        if self._loaded is None:
+            module_name, _, attr = self.value.partition(':')
+            obj = importlib.import_module(module_name.strip())
+            for part in attr.strip().split('.') if attr else ():
+                obj = getattr(obj, part)
+            self._loaded = obj
+        return self._loaded
+
+
+_registry = None
+
+def get_entry_points(group):
+    """Get a list of :class:`EntryPoint` in the given group.
+
+    They are in the order they were declared in.
+
+    """
+
+    global _registry
+    if _registry is None:
+        _registry = _load()
+    return [EntryPoint(*x) for x in _registry['groups'].get(group, ())]
+
+
+def get_cache_path():
+    path = os.environ.get('VEE_REGISTRY_CACHE')
+    if path:
+        return os.path.expanduser(path)
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join('~', '.cache')
+    # Different Pythons will have different distributions.
+    tag = hashlib.sha1(sys.executable.encode('utf8')).hexdigest()[:8]
+    return os.path.join(os.path.expanduser(base), 'vee', 'registry-%s.json' % tag)
+
+
+def get_fingerprint():
+    """Identify the set of installed distributions (and their entry points).
+
+    This is a directory listing of everything on ``sys.path``, and a stat of
+    each ``entry_points.txt``, which is far cheaper than reading them.
+
+    """
+
+    hasher = hashlib.sha1()
+    hasher.update(('%s\n%s\n' % (CACHE_VERSION, sys.executable)).encode('utf8'))
+    for entry in sys.path:
+        try:
+            names = sorted(os.listdir(entry or '.'))
+        except OSError:
+            continue
+        hasher.update(('%s\n' % entry).encode('utf8'))
+        for name in names:
+            if not name.endswith(('.dist-info', '.egg-info', '.egg-link', '.pth')):
+                continue
+            try:
+                st = os.stat(os.path.join(entry or '.', name, 'entry_points.txt'))
+            except OSError:
+                stamp = ''
+            else:
+                stamp = '%s %s' % (st.st_mtime, st.st_size)
+            hasher.update(('%s %s\n' % (name, stamp)).encode('utf8'))
+    return hasher.hexdigest()
+
+
+def _load():
+
+    path = get_cache_path()
+    fingerprint = get_fingerprint()
+
+    try:
+        with open(path) as fh:
+            registry = json.load(fh)
+    except (OSError, ValueError):
+        pass
+    else:
+        if registry.get('fingerprint') == fingerprint and _sources_unchanged(registry['sources']):
+            return registry
+
+    log.debug('Scanning for entry points')
+    groups, sources = _scan()
+    registry = {'fingerprint': fingerprint, 'groups': groups, 'sources': sources}
+
+    # Write atomically, since many of us may be starting at once.
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    try:
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(tmp_path, 'w') as fh:
+            json.dump(registry, fh, indent=1, sort_keys=True)
+        os.rename(tmp_path, path)
+    except OSError as e:
+        log.debug('Could not cache entry points to %s: %s' % (path, e))
+
+    return registry
+
+
+def _stat_source(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_mtime, st.st_size]
+
+
+def _sources_unchanged(sources):
+    # The hints came from the source of those modules, which may be edited in
+    # place (e.g. when installed in develop mode).
+    for path, stamp in sources.items():
+        if _stat_source(path) != stamp:
+            return False
+    return True
+
+
+def _iter_entry_points(group):
+
+    try:
+        from importlib import metadata
+    except ImportError:
+        import pkg_resources
+        for ep in pkg_resources.iter_entry_points(group):
+            yield ep.name, '%s:%s' % (ep.module_name, '.'.join(ep.attrs))
+        return
+
+    eps = metadata.entry_points()
+    if hasattr(eps, 'select'):
+        eps = eps.select(group=group)
+    else:
+        eps = eps.get(group, ())
+    for ep in eps:
+        yield ep.name, ep.value
+
+
+def _scan():
+
+    groups = {}
+    sources = {}
+
+    for group in GROUPS:
+
+        entries = groups[group] = []
+        seen = set()
+        hint_names = HINTS.get(group, ())
+
+        for name, value in _iter_entry_points(group):
+
+            # The same distribution may be visible more than once (e.g. when
+            # installed in develop mode); the first on the path wins.
+            if name in seen:
+                continue
+            seen.add(name)
+
+            hints = {}
+            if hint_names:
+                obj = EntryPoint(name, value).load()
+                source = getattr(sys.modules.get(obj.__module__), '__file__', None)
+                if source:
+                    sources[source] = _stat_source(source)
+                for hint_name in hint_names:
+                    hint = getattr(obj, hint_name, None)
+                    if hint is not None:
+                        hints[hint_name] = list(hint) if isinstance(hint, (tuple, set, frozenset)) else hint
+
+            entries.append((name, value, hints))
+
+    return groups, sources
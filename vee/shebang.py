@@ -0,0 +1,111 @@
+"""What the shebangs of installed executables are, cached in the database.
+
+Linking rewrites the shebang of every executable that names an interpreter
+the environment has (see :meth:`.Environment.rewrite_shebang`), so every link
+used to open and read every executable of every install. Instead, the result
+of reading one is recorded against its path, keyed by ``(dev, ino, mtime,
+size)`` so that a changed file is read again, and relinking only needs a
+``stat``.
+
+"""
+
+import collections
+import os
+import re
+
+
+# Rewritten to point to the environment's bin, if it has that interpreter.
+SHEBANG_PATTERN = re.compile(br'#!(|\S+/)([^\s/]+)')
+
+
+# ``interpreter`` is the name to look for in the environment's bin, ``rest``
+# is the rest of the first line (after that name), and ``offset`` is where
+# the rest of the file starts.
+Shebang = collections.namedtuple('Shebang', 'interpreter rest offset')
+
+
+def read_shebang(path):
+    """Get the :class:`Shebang` of a file, or ``None`` if it has none."""
+    with open(path, 'rb') as fh:
+        line = fh.readline()
+    m = SHEBANG_PATTERN.match(line)
+    if m:
+        return Shebang(m.group(2), line[m.end(2):], len(line))
+
+
+def _stat_key(st):
+    return (st.st_dev, st.st_ino, st.st_mtime_ns, st.st_size)
+
+
+class ShebangCache(object):
+
+    def __init__(self, db):
+        self.db = db
+        self._rows = {}
+        self._loaded = set()
+        self._dirty = {}
+
+        # How many files we had to read.
+        self.reads = 0
+
+    def preload(self, root):
+        """Load everything recorded within the given directory in one query."""
+
+        root = os.path.abspath(root).rstrip('/')
+        if root in self._loaded:
+            return
+        self._loaded.add(root)
+
+        # Everything starting with "root/"; "0" sorts right after "/".
+        cur = self.db.connect().cursor()
+        cur.row_factory = None
+        for row in cur.execute('''
+            SELECT path, dev, ino, mtime, size, interpreter, rest, offset FROM shebangs
+            WHERE path >= ? AND path < ?
+        ''', [root + '/', root + '0']):
+            self._rows.setdefault(row[0], row)
+
+    def get(self, path, st=None):
+        """Get the :class:`Shebang` of the file at ``path``, or ``None``.
+
+        :param st: The result of :func:`os.stat` on the path, if we have it.
+
+        """
+
+        path = os.path.abspath(path)
+        st = os.stat(path) if st is None else st
+        key = _stat_key(st)
+
+        row = self._rows.get(path)
+        if row is None and not any(path.startswith(root + '/') for root in self._loaded):
+            row = self.db.execute('''
+                SELECT path, dev, ino, mtime, size, interpreter, rest, offset FROM shebangs
+                WHERE path = ?
+            ''', [path]).fetchone()
+            row = tuple(row) if row else None
+
+        if row is not None and tuple(row[1:5]) == key:
+            return Shebang(bytes(row[5]), bytes(row[6]), row[7]) if row[5] is not None else None
+
+        self.reads += 1
+        try:
+            shebang = read_shebang(path)
+        except (IOError, OSError):
+            return
+
+        row = (path, ) + key + (tuple(shebang) if shebang else (None, None, None))
+        self._rows[path] = self._dirty[path] = row
+        return shebang
+
+    def flush(self):
+        """Record everything we had to read since the last flush."""
+        if not self._dirty:
+            return
+        rows = list(self._dirty.values())
+        self._dirty.clear()
+        con = self.db.connect()
+        with self.db.write_lock, con:
+            con.executemany('''
+                INSERT OR REPLACE INTO shebangs (path, dev, ino, mtime, size, interpreter, rest, offset)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ''', rows)
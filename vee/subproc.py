@@ -10,6 +10,7 @@ import errno
 from vee import log
 from vee.cli import style
 from vee.envvars import join_env_path
+from vee.jobserver import get_jobserver
 
 
 class _CallOutput(object):
@@ -23,6 +24,9 @@ class _CallOutput(object):
         self.name = name
         self.logger = None
 
+        # Our reader thread logs on behalf of the thread that called us.
+        self.log_context = log.get_context()
+
         if not isinstance(specs, (list, tuple)):
             specs = [specs]
 
@@ -86,6 +90,10 @@ class _CallOutput(object):
         self.thread.start()
 
     def _target(self):
+        with log.adopt(self.log_context):
+            self._read()
+
+    def _read(self):
         fd = self.master_fd
         size = 2**10
         callbacks = self.callbacks
@@ -109,6 +117,34 @@ class _CallOutput(object):
         self.close()
 
 
+_usage = threading.local()
+
+
+def child_usage():
+    """Get the CPU seconds used, and bytes written, by all subprocesses which
+    :func:`call` has run on this thread.
+
+    Take the difference of two of these to measure some block of work.
+
+    """
+    return getattr(_usage, 'cpu_time', 0.0), getattr(_usage, 'bytes_written', 0)
+
+
+def _wait(proc):
+
+    if not hasattr(os, 'wait4'):
+        proc.wait()
+        return
+
+    # Reap it ourselves so that we get the resource usage of just this process,
+    # since RUSAGE_CHILDREN mixes in everything other threads have run too.
+    _, status, rusage = os.wait4(proc.pid, 0)
+    proc.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+
+    _usage.cpu_time = getattr(_usage, 'cpu_time', 0.0) + rusage.ru_utime + rusage.ru_stime
+    _usage.bytes_written = getattr(_usage, 'bytes_written', 0) + rusage.ru_oublock * 512
+
+
 def call(cmd, **kwargs):
 
     # Log the call.
@@ -146,11 +182,21 @@ def call(cmd, **kwargs):
         env['PATH'] = join_env_path(os.path.join(vee_src, 'bin'), env.get('PATH'))
         kwargs['env'] = env
 
-    proc = subprocess.Popen(cmd, stdout=stdout.slave_fd, stderr=stderr.slave_fd, bufsize=0, **kwargs)
-    stdout.start(proc)
-    stderr.start(proc)
+    # Hold a job slot for as long as it runs; see vee.jobserver.
+    jobserver = get_jobserver() if kwargs.pop('jobserver', False) else None
+    if jobserver:
+        jobserver.prepare(kwargs)
+        token = jobserver.acquire()
+
+    try:
+        proc = subprocess.Popen(cmd, stdout=stdout.slave_fd, stderr=stderr.slave_fd, bufsize=0, **kwargs)
+        stdout.start(proc)
+        stderr.start(proc)
+        _wait(proc)
+    finally:
+        if jobserver:
+            jobserver.release(token)
 
-    proc.wait()
     stdout.join()
     stderr.join()
 
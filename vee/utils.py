@@ -46,6 +46,20 @@ def makedirs(*args):
 
 def chmod(path, specs, recurse=False):
 
+    ops = parse_chmod(specs)
+
+    if not recurse:
+        _chmod(path, ops)
+        return
+
+    for root, dir_names, file_names in os.walk(path):
+        for name in itertools.chain(dir_names, file_names):
+            _chmod(os.path.join(root, name), ops)
+
+
+def parse_chmod(specs):
+    """Parse symbolic ``chmod`` specs (e.g. ``"o-w"``) into ops for :func:`chmod_mode`."""
+
     if isinstance(specs, str):
         specs = specs.split(',')
 
@@ -76,24 +90,16 @@ def chmod(path, specs, recurse=False):
 
         ops.append((op, mask, value))
 
-    if not recurse:
-        _chmod(path, ops)
-        return
-
-    for root, dir_names, file_names in os.walk(path):
-        for name in itertools.chain(dir_names, file_names):
-            _chmod(os.path.join(root, name), ops)
-
+    return ops
 
-def _chmod(path, ops):
 
-    st = os.stat(path)
-    new_mode = old_mode = stat.S_IMODE(st.st_mode)
+def chmod_mode(mode, ops):
+    """The permission bits after applying ops from :func:`parse_chmod`."""
 
     for op, mask, value in ops:
 
-        masked   = new_mode & mask
-        unmasked = new_mode & (~mask)
+        masked   = mode & mask
+        unmasked = mode & (~mask)
 
         if op == '+':
             masked |= value
@@ -104,7 +110,16 @@ def _chmod(path, ops):
         else:
             raise ValueError('Unknown chmod op.', op)
 
-        new_mode = masked | unmasked
+        mode = masked | unmasked
+
+    return mode
+
+
+def _chmod(path, ops):
+
+    st = os.stat(path)
+    old_mode = stat.S_IMODE(st.st_mode)
+    new_mode = chmod_mode(old_mode, ops)
 
     if new_mode != old_mode:
         os.chmod(path, new_mode)
@@ -189,6 +204,49 @@ def linktree(src, dst, symlinks=False, ignore=None):
                 names[:] = [x for x in names if x not in dont_walk]
 
 
+def copy_range(src_fh, dst_fh, offset, count):
+    """Append ``count`` bytes from ``offset`` of one open file to another.
+
+    The copy is done by the kernel (via :func:`os.copy_file_range`, or
+    :func:`os.sendfile`) where it can be, falling back to a plain copy.
+
+    """
+
+    dst_fh.flush()
+    src_fd = src_fh.fileno()
+    dst_fd = dst_fh.fileno()
+
+    for name in ('copy_file_range', 'sendfile'):
+        func = getattr(os, name, None)
+        if func is None:
+            continue
+        try:
+            while count > 0:
+                if name == 'sendfile':
+                    copied = func(dst_fd, src_fd, offset, count)
+                else:
+                    copied = func(src_fd, dst_fd, count, offset)
+                if not copied:
+                    break
+                offset += copied
+                count -= copied
+            return
+        except OSError as e:
+            # Not supported between these files (e.g. across filesystems
+            # for some kernels, or when the target isn't a socket on macOS).
+            if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.ENOTSUP, errno.EOPNOTSUPP, errno.ENOTSOCK, errno.EBADF):
+                raise
+
+    src_fh.seek(offset)
+    dst_fh.seek(0, os.SEEK_END)
+    while count > 0:
+        chunk = src_fh.read(min(count, 1024 * 1024))
+        if not chunk:
+            break
+        dst_fh.write(chunk)
+        count -= len(chunk)
+
+
 class HashingWriter(object):
 
     def __init__(self, fh, hasher=None):
@@ -203,6 +261,47 @@ class HashingWriter(object):
         return self._hasher.hexdigest()
 
 
+def archive_tree(archive, root, verbose=False, manifest=None):
+    """Add the contents of a directory to an open :class:`tarfile.TarFile`.
+
+    Paths are relative to the root, and anything other than directories,
+    regular files, and symlinks (e.g. sockets) is skipped. With a
+    :class:`.FileManifest` of the root, its entries are used rather than
+    walking the tree (and the manifest itself is included).
+
+    """
+
+    if manifest is not None:
+        for entry in manifest:
+            if entry.type == 'o':
+                continue
+            if verbose:
+                print('    ' + entry.path + ('/' if entry.type == 'd' else ''))
+            archive.add(os.path.join(root, entry.path), entry.path, recursive=False)
+        if os.path.exists(manifest.path):
+            archive.add(manifest.path, os.path.basename(manifest.path))
+        return
+
+    for dir_path, dir_names, file_names in os.walk(root):
+
+        for dir_name in dir_names:
+            path = os.path.join(dir_path, dir_name)
+            rel_path = os.path.relpath(path, root)
+            if verbose:
+                print('    ' + rel_path + '/')
+            archive.add(path, rel_path, recursive=False)
+
+        for file_name in file_names:
+            path = os.path.join(dir_path, file_name)
+            mode = os.lstat(path).st_mode
+            if not (stat.S_ISREG(mode) or stat.S_ISDIR(mode) or stat.S_ISLNK(mode)):
+                continue
+            rel_path = os.path.relpath(path, root)
+            if verbose:
+                print('    ' + rel_path)
+            archive.add(path, rel_path)
+
+
 def _checksum_file(path, hasher=None):
     hasher = hasher or hashlib.md5()
     with open(path, 'rb') as fh: